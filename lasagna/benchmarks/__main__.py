@@ -0,0 +1,75 @@
+"""
+Run the lasagna benchmarks from the command line:
+
+python -m lasagna.benchmarks --size medium --output report.json
+python -m lasagna.benchmarks --only io compute --compare baseline.json
+"""
+
+import argparse
+import sys
+
+from lasagna.benchmarks import runner
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Time lasagna's loaders, computations and plotting on synthetic data",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--size', choices=sorted(runner.SIZES), default='small',
+                        help='Size of the synthetic data')
+    parser.add_argument('--param', action='append', default=[], metavar='NAME=VALUE',
+                        help='Override one size, e.g. --param points=500000 or --param volume=64,512,512')
+    parser.add_argument('--only', nargs='+', metavar='NAME',
+                        help='Only run these groups (io, compute, render) or benchmarks')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of timed calls of each case')
+    parser.add_argument('--warmup', type=int, default=1,
+                        help='Number of untimed calls before timing')
+    parser.add_argument('-o', '--output', metavar='REPORT',
+                        help='Save the results to this JSON file')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='Compare with the results in this JSON file and exit with an error if any case is slower')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Fraction by which a case may be slower than the baseline')
+    return parser
+
+
+def parse_params(items):
+    """
+    Turn NAME=VALUE strings into a dictionary of sizes. Comma separated values become tuples.
+    """
+    params = {}
+    for item in items:
+        name, _, value = item.partition('=')
+        if not value:
+            raise ValueError("Expected NAME=VALUE, got %s" % item)
+        values = tuple(int(v) for v in value.split(','))
+        params[name.strip()] = values if len(values) > 1 else values[0]
+    return params
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    try:
+        params = parse_params(args.param)
+    except ValueError as err:
+        print(err)
+        return 2
+
+    report = runner.run_benchmarks(size=args.size, params=params, only=args.only,
+                                   repeat=args.repeat, warmup=args.warmup)
+    if args.output:
+        runner.save_report(report, args.output)
+        print("Saved report to %s" % args.output)
+
+    if args.compare:
+        comparison, regressions = runner.compare_reports(runner.load_report(args.compare), report, args.tolerance)
+        runner.print_comparison(comparison, args.tolerance)
+        if regressions:
+            print("%d of %d cases are more than %d%% slower than %s"
+                  % (len(regressions), len(comparison), args.tolerance * 100, args.compare))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,234 @@
+"""
+Running benchmarks and saving their timings.
+
+A benchmark is a generator function registered with the benchmark decorator. It is given a
+BenchmarkContext, prepares its data and yields (case name, function) pairs, one per thing to time.
+Each function is called once to warm up and then repeatedly, and the times are saved in a JSON
+report. Reports from two versions of lasagna can be compared with compare_reports.
+
+A benchmark raises SkipBenchmark if it can not run here (e.g. a file format whose library is not
+installed), which is noted in the report.
+"""
+
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+REPORT_VERSION = 1
+
+# Sizes of the synthetic data
+SIZES = {
+    "small": dict(volume=(64, 128, 128), atlas=(64, 96, 96), areas=30, points=20000, series=10,
+                  lines=200, line_points=100, tree_nodes=20000),
+    "medium": dict(volume=(128, 256, 256), atlas=(128, 160, 160), areas=100, points=200000, series=50,
+                   lines=1000, line_points=200, tree_nodes=200000),
+    "large": dict(volume=(256, 512, 512), atlas=(256, 320, 320), areas=300, points=2000000, series=200,
+                  lines=5000, line_points=400, tree_nodes=1000000),
+}
+
+# group, name and function of each registered benchmark, in the order they were registered
+BENCHMARKS = []
+
+
+class SkipBenchmark(Exception):
+    """
+    Raised by a benchmark that can not run here. The message is the reason.
+    """
+
+
+def benchmark(group):
+    """
+    Decorator registering a benchmark generator function in group (e.g. "io" or "render")
+    """
+
+    def decorator(function):
+        BENCHMARKS.append((group, function.__name__, function))
+        return function
+
+    return decorator
+
+
+class BenchmarkContext(object):
+    """
+    What a benchmark gets to prepare its data: the sizes (params), a temporary directory for the
+    files it writes and, for rendering benchmarks, a Lasagna main window on an offscreen display.
+    """
+
+    def __init__(self, params, workDir):
+        self.params = params
+        self.workDir = workDir
+        self._lasagna = None
+        self._app = None
+
+    def path(self, fname):
+        return os.path.join(self.workDir, fname)
+
+    @property
+    def lasagna(self):
+        """
+        The Lasagna instance, created the first time it is asked for. Raises SkipBenchmark if
+        PyQt5 can not be imported.
+        """
+        if self._lasagna is None:
+            os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+            try:
+                from PyQt5.QtWidgets import QApplication
+                from lasagna.lasagna_object import Lasagna
+            except ImportError as err:
+                raise SkipBenchmark("can not start lasagna: %s" % err)
+            self._app = QApplication.instance() or QApplication([])
+            self._lasagna = Lasagna()
+        return self._lasagna
+
+    def processEvents(self):
+        if self._app is not None:
+            self._app.processEvents()
+
+    def close(self):
+        if self._lasagna is not None:
+            for ingredient in self._lasagna.ingredientList[:]:
+                self._lasagna.removeIngredient(ingredient)
+            # Not close(): closing the main window quits the application
+            self._lasagna.cancelStackLoads()
+            self._lasagna.slicePrefetcher.shutdown()
+            self._lasagna.hide()
+            self.processEvents()
+            self._lasagna = None
+
+
+def time_call(function, repeat=5, warmup=1):
+    """
+    Call function warmup times, then time repeat calls. Returns the times in seconds.
+    """
+    for _ in range(warmup):
+        function()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def run_benchmarks(size="small", params=None, only=None, repeat=5, warmup=1, verbose=True):
+    """
+    Run the registered benchmarks and return a report (a dictionary that can be saved as JSON)
+    size - one of SIZES
+    params - dictionary of sizes replacing those of size
+    only - optional list of group or benchmark names to run. All are run by default.
+    """
+    from lasagna.benchmarks import suite  # Registers the benchmarks
+
+    run_params = dict(SIZES[size])
+    run_params.update(params or {})
+    report = dict(version=REPORT_VERSION, metadata=run_metadata(size, run_params, repeat, warmup), results=[])
+
+    work_dir = tempfile.mkdtemp(prefix="lasagna_benchmarks_")
+    context = BenchmarkContext(run_params, work_dir)
+    try:
+        for group, name, function in BENCHMARKS:
+            if only and group not in only and name not in only:
+                continue
+            for result in _run_one(context, group, name, function, repeat, warmup):
+                report["results"].append(result)
+                if verbose:
+                    print(format_result(result))
+    finally:
+        context.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+
+def _run_one(context, group, name, function, repeat, warmup):
+    """
+    Yield the results of each case of one benchmark
+    """
+    try:
+        for case, call in function(context):
+            times = time_call(call, repeat, warmup)
+            yield dict(group=group, benchmark=name, case=case, times_s=times, min_s=min(times),
+                       median_s=float(np.median(times)), mean_s=float(np.mean(times)))
+    except SkipBenchmark as err:
+        yield dict(group=group, benchmark=name, case=None, skipped=str(err))
+
+
+def run_metadata(size, params, repeat, warmup):
+    """
+    Describe the machine, versions and sizes of a run
+    """
+    import numpy
+
+    return dict(
+        time=time.strftime("%Y-%m-%dT%H:%M:%S"),
+        git_revision=git_revision(),
+        python=sys.version.split()[0],
+        numpy=numpy.__version__,
+        platform=platform.platform(),
+        processor=platform.processor(),
+        cpu_count=os.cpu_count(),
+        size=size,
+        params={key: list(value) if isinstance(value, tuple) else value for key, value in params.items()},
+        repeat=repeat,
+        warmup=warmup,
+    )
+
+
+def git_revision():
+    """
+    Return the git commit of the lasagna source tree, or None if it is not a git checkout
+    """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(__file__),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_result(result):
+    if "skipped" in result:
+        return "%-8s %-40s skipped: %s" % (result["group"], result["benchmark"], result["skipped"])
+    return "%-8s %-40s %10.2f ms (min %.2f ms)" % (result["group"], "%s[%s]" % (result["benchmark"], result["case"]),
+                                                 result["median_s"] * 1000, result["min_s"] * 1000)
+
+
+def save_report(report, fname):
+    with open(fname, "w") as fid:
+        json.dump(report, fid, indent=1)
+
+
+def load_report(fname):
+    with open(fname, "r") as fid:
+        return json.load(fid)
+
+
+def compare_reports(baseline, current, tolerance=0.2):
+    """
+    Compare the median times of the benchmarks run in both reports
+    Returns a list of (benchmark, case, baseline seconds, current seconds, ratio) and the list of
+    those that are more than tolerance (a fraction) slower than the baseline.
+    """
+    baseline_times = {(result["benchmark"], result["case"]): result["median_s"]
+                      for result in baseline["results"] if "skipped" not in result}
+    comparison = []
+    for result in current["results"]:
+        key = (result["benchmark"], result["case"])
+        if "skipped" in result or key not in baseline_times:
+            continue
+        old, new = baseline_times[key], result["median_s"]
+        comparison.append(key + (old, new, new / old if old > 0 else float("inf")))
+    regressions = [row for row in comparison if row[4] > 1 + tolerance]
+    return comparison, regressions
+
+
+def print_comparison(comparison, tolerance=0.2):
+    print("%-50s %12s %12s %8s" % ("benchmark", "baseline ms", "current ms", "ratio"))
+    for name, case, old, new, ratio in comparison:
+        flag = "  SLOWER" if ratio > 1 + tolerance else "  faster" if ratio < 1 - tolerance else ""
+        print("%-50s %12.2f %12.2f %8.2f%s" % ("%s[%s]" % (name, case), old * 1000, new * 1000, ratio, flag))
@@ -0,0 +1,313 @@
+"""
+The lasagna benchmarks. Each times real lasagna code on synthetic data (see synthetic.py):
+
+io       - reading image stacks in each format, point and line files and trees
+compute  - voxel histograms, splitting points into series and finding tree segments
+render   - plotting image stacks, points and lines over a sweep of slices, the image histogram
+           and atlas area highlights. These need PyQt5 and run on an offscreen display.
+"""
+
+import contextlib
+import io
+import os
+
+import numpy as np
+
+from lasagna.benchmarks import synthetic
+from lasagna.benchmarks.runner import benchmark, SkipBenchmark
+
+VOLUME_FORMATS = ("tif", "mhd", "zarr", "nrrd", "nii")
+N_SWEEP_SLICES = 10  # Slices plotted along each axis by the render benchmarks
+
+
+def _quiet(function):
+    """
+    Return function with its printed output thrown away, as the loaders report every file they read
+    """
+
+    def call():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return function()
+
+    return call
+
+
+def _sweep_slices(shape):
+    """
+    Return, for each axis, N_SWEEP_SLICES slices spread evenly through a stack of the given shape
+    """
+    return [np.linspace(0, n - 1, min(n, N_SWEEP_SLICES)).astype(int).tolist() for n in shape]
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# io
+@benchmark("io")
+def load_stack(context):
+    """
+    image_stack_loader.load_stack for each format, followed by reading the middle slice along each
+    axis so that lazy loaders (memory-mapped and chunked stacks) are timed reading some voxels
+    """
+    from lasagna.io_libs import image_stack_loader
+
+    volume = synthetic.make_volume(context.params["volume"])
+    missing = []
+    for fmt in VOLUME_FORMATS:
+        try:
+            fname = synthetic.write_volume(context.workDir, "volume", volume, fmt)
+        except ImportError as err:
+            missing.append("%s (%s)" % (fmt, err))
+            continue
+
+        def load(fname=fname):
+            data = image_stack_loader.load_stack(fname)
+            for axis, n in enumerate(data.shape):
+                np.asarray(data[(slice(None),) * axis + (n // 2,)])
+
+        yield fmt, _quiet(load)
+
+    if missing:
+        raise SkipBenchmark("formats not available here: %s" % ", ".join(missing))
+
+
+@benchmark("io")
+def read_points(context):
+    """
+    Reading sparse points as text, as a binary point cloud and as CellCounter XML
+    """
+    from lasagna.io_libs import sparse_point_io
+
+    params = context.params
+    points = synthetic.make_points(params["points"], params["volume"], params["series"])
+    csv_name = synthetic.write_points_csv(context.path("points.csv"), points)
+    npy_name = sparse_point_io.write_point_cloud(context.path("points.npy"), points[:, :3], points[:, 3])
+    xml_name = synthetic.write_cell_xml(context.path("points.xml"), points)
+
+    yield "csv", lambda: sparse_point_io.read_lasagna_pts(csv_name)
+    yield "npy", lambda: np.asarray(sparse_point_io.read_point_cloud(npy_name)[0])
+    yield "cell_xml", lambda: sparse_point_io.read_cell_xml(xml_name)
+
+
+@benchmark("io")
+def read_lines(context):
+    """
+    Reading a lines file and joining its series into one NaN separated line set, as the lines
+    reader does
+    """
+    from lasagna.io_libs import sparse_point_io
+    from lasagna.utils.point_series import join_series
+
+    params = context.params
+    lines = synthetic.make_lines(params["lines"], params["line_points"], params["volume"])
+    fname = synthetic.write_points_csv(context.path("lines.csv"), lines)
+
+    def read():
+        data = sparse_point_io.read_lasagna_pts(fname)
+        return join_series(data[:, :3], data[:, 3])
+
+    yield "csv", read
+
+
+@benchmark("io")
+def read_tree(context):
+    """
+    tree_parser.parse_file building a Tree and a compact ArrayTree
+    """
+    from lasagna.tree import tree_parser
+
+    ids, parents, positions = synthetic.make_tree(context.params["tree_nodes"], context.params["volume"])
+    fname = synthetic.write_tree_csv(context.path("tree.csv"), ids, parents, positions)
+    header = ["id", "parent", "z", "x", "y"]
+
+    yield "Tree", lambda: tree_parser.parse_file(fname, header_line=header)
+    yield "ArrayTree", lambda: tree_parser.parse_file(fname, header_line=header, compact=True)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# compute
+@benchmark("compute")
+def stack_histogram(context):
+    """
+    Counting the voxels of a stack with one and with all cores and estimating the counts from a
+    sample, and the histogram and default display range taken from the counts
+    """
+    from lasagna.image_processing.histogram import StackHistogram
+
+    volume = synthetic.make_volume(context.params["volume"])
+    n_threads = os.cpu_count() or 1
+
+    yield "count_1_thread", lambda: StackHistogram(volume, nThreads=1)
+    if n_threads > 1:
+        yield "count_%d_threads" % n_threads, lambda: StackHistogram(volume, nThreads=n_threads)
+
+    yield "sample", lambda: StackHistogram(volume, sample=True)
+
+    counts = StackHistogram(volume)
+    yield "histogram", lambda: counts.histogram(bins=256)
+    yield "defaultRange", lambda: counts.defaultRange()
+
+
+@benchmark("compute")
+def split_series(context):
+    """
+    Splitting points into series when they are listed series by series and when they are shuffled
+    """
+    from lasagna.utils import point_series
+
+    params = context.params
+    points = synthetic.make_points(params["points"], params["volume"], params["series"])
+    shuffled = points[np.random.default_rng(0).permutation(len(points))]
+
+    yield "sorted", lambda: list(point_series.split_series(points[:, :3], points[:, 3]))
+    yield "shuffled", lambda: list(point_series.split_series(shuffled[:, :3], shuffled[:, 3]))
+
+
+@benchmark("compute")
+def find_segments(context):
+    """
+    Tree.find_segments and ArrayTree.find_segments on the same neurite-like tree
+    """
+    from lasagna.tree import tree_parser
+    from lasagna.tree.tree import Tree
+
+    ids, parents, positions = synthetic.make_tree(context.params["tree_nodes"], context.params["volume"])
+    tree = Tree()
+    tree.add_node(0)
+    for node_id, parent in zip(ids.tolist(), parents.tolist()):
+        tree.add_node(node_id, parent)
+    array_tree = tree_parser.build_array_tree(ids.tolist(), parents.tolist(), ["z", "x", "y"], list(positions.T))
+
+    yield "Tree", lambda: tree.find_segments()
+    yield "ArrayTree", lambda: array_tree.find_segments()
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# render
+def _plot_sweep(lasagna, ingredient, shape):
+    """
+    Return a function plotting ingredient in each axis at the slices of _sweep_slices
+    """
+    from lasagna.utils.lasagna_qt_helper_functions import find_pyqt_graph_object_name_in_plot_widget
+
+    plot_items = [find_pyqt_graph_object_name_in_plot_widget(axis.view, ingredient.objectName)
+                  for axis in lasagna.axes2D]
+    sweep = _sweep_slices(shape)
+
+    def plot():
+        for axis, plot_item in enumerate(plot_items):
+            for slice_index in sweep[axis]:
+                ingredient.plotIngredient(plot_item, axisToPlot=axis, sliceToPlot=slice_index)
+
+    return plot
+
+
+def _add_ingredient(lasagna, kind, name, data):
+    with contextlib.redirect_stdout(io.StringIO()):
+        lasagna.addIngredient(kind=kind, objectName=name, data=data)
+    ingredient = lasagna.returnIngredientByName(name)
+    ingredient.addToPlots()
+    return ingredient
+
+
+@benchmark("render")
+def plot_sparse_points(context):
+    """
+    sparsepoints.plotIngredient over a sweep of slices along each axis
+    """
+    lasagna = context.lasagna
+    params = context.params
+    points = synthetic.make_points(params["points"], params["volume"])
+    ingredient = _add_ingredient(lasagna, "sparsepoints", "benchmark_points", points[:, :3])
+    try:
+        yield "sweep", _plot_sweep(lasagna, ingredient, params["volume"])
+    finally:
+        lasagna.removeIngredientByName("benchmark_points")
+
+
+@benchmark("render")
+def plot_lines(context):
+    """
+    lines.plotIngredient over a sweep of slices along each axis
+    """
+    from lasagna.utils.point_series import join_series
+
+    lasagna = context.lasagna
+    params = context.params
+    lines = synthetic.make_lines(params["lines"], params["line_points"], params["volume"])
+    ingredient = _add_ingredient(lasagna, "lines", "benchmark_lines", join_series(lines[:, :3], lines[:, 3]))
+    try:
+        yield "sweep", _plot_sweep(lasagna, ingredient, params["volume"])
+    finally:
+        lasagna.removeIngredientByName("benchmark_lines")
+
+
+@benchmark("render")
+def plot_image_stack(context):
+    """
+    imagestack.plotIngredient over a sweep of slices along each axis, and the histogram and
+    default display range shown for the stack
+    """
+    lasagna = context.lasagna
+    volume = synthetic.make_volume(context.params["volume"])
+    with contextlib.redirect_stdout(io.StringIO()):
+        lasagna.addImageStack("benchmark_volume", volume, [1, 1, 1])
+    ingredient = lasagna.returnIngredientByName("benchmark_volume")
+    try:
+        yield "sweep", _plot_sweep(lasagna, ingredient, volume.shape)
+        yield "calcHistogram", ingredient.calcHistogram
+        yield "defaultHistRange", ingredient.defaultHistRange
+    finally:
+        lasagna.removeIngredientByName("benchmark_volume")
+
+
+def _ara_harness(lasagna):
+    """
+    Return an ARA_plotter attached to lasagna without the rest of an atlas plugin
+    """
+    from lasagna.plugins.ara.ara_plotter import ARA_plotter
+
+    class PluginStandIn(object):
+        def __init__(self, lasagna_serving):
+            pass
+
+    class AraHarness(ARA_plotter, PluginStandIn):
+        def __init__(self, lasagna_serving):
+            super(AraHarness, self).__init__(lasagna_serving)
+            self.prefs = self.defaultPrefs()
+            self.data = {}
+            self.makeContourCache()
+            self.addAreaContour()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        return AraHarness(lasagna)
+
+
+@benchmark("render")
+def draw_area_highlight(context):
+    """
+    ARA_plotter.drawAreaHighlight of the area in the middle of an atlas, finding its contours
+    (cold) and taking them from the contour cache (warm)
+    """
+    lasagna = context.lasagna
+    atlas = synthetic.make_atlas(context.params["atlas"], context.params["areas"])
+    with contextlib.redirect_stdout(io.StringIO()):
+        lasagna.addImageStack("benchmark_atlas", atlas, [1, 1, 1])
+    harness = _ara_harness(lasagna)
+    for axis, n in zip(lasagna.axes2D, atlas.shape):
+        axis.currentSlice = n // 2
+    label = int(atlas[tuple(n // 2 for n in atlas.shape)]) or int(atlas.max())
+
+    def draw():
+        harness.drawAreaHighlight(atlas, label)
+        lasagna.redrawScheduler.flush()  # Draw now rather than at the next frame
+
+    def cold():
+        harness.contourCache.clear()
+        draw()
+
+    try:
+        yield "cold", cold
+        yield "warm", draw
+    finally:
+        harness.contourCache.shutdown()
+        harness.removeAreaContour()
+        lasagna.removeIngredientByName("benchmark_atlas")
@@ -0,0 +1,174 @@
+"""
+Synthetic data for the benchmarks: image volumes, atlases, point clouds, line sets and trees of
+any size, and writers putting them in the file formats lasagna reads.
+
+Everything is generated from a seed, so two runs with the same sizes time the same data.
+"""
+
+import os
+
+import numpy as np
+
+
+def make_volume(shape, dtype=np.uint16, seed=0):
+    """
+    Return a volume of the given shape with smooth structure and noise, roughly like a
+    fluorescence image: a few bright blobs on a dimmer background.
+    """
+    rng = np.random.default_rng(seed)
+    grids = np.ogrid[tuple(slice(0, n) for n in shape)]
+    volume = np.zeros(shape, dtype=np.float32)
+    for _ in range(8):
+        centre = [rng.uniform(0, n) for n in shape]
+        width = rng.uniform(0.05, 0.2) * min(shape)
+        blob = 1
+        for grid, c in zip(grids, centre):
+            blob = blob * np.exp(-((grid - c) ** 2) / (2 * width ** 2)).astype(np.float32)
+        volume += blob
+    volume += rng.random(shape, dtype=np.float32) * 0.2
+
+    if np.issubdtype(dtype, np.integer):
+        volume *= 0.8 * np.iinfo(dtype).max / volume.max()
+    return volume.astype(dtype)
+
+
+def make_atlas(shape, n_areas=50, seed=0):
+    """
+    Return a label volume (uint32) of the given shape split into about n_areas areas with
+    labels from 1, surrounded by a border of 0 (outside the brain)
+    """
+    rng = np.random.default_rng(seed)
+    # Areas are the cells of a coarse grid with random labels, made irregular by shifting rows
+    n_cells = max(1, int(round(n_areas ** (1.0 / 3))))
+    cells = rng.integers(1, n_areas + 1, size=(n_cells,) * 3).astype(np.uint32)
+    index = [np.minimum((np.arange(n) * n_cells) // n, n_cells - 1) for n in shape]
+    atlas = cells[np.ix_(*index)]
+    for z in range(shape[0]):
+        atlas[z] = np.roll(atlas[z], int(rng.integers(-shape[1] // 8 - 1, shape[1] // 8 + 1)), axis=0)
+
+    border = [max(1, n // 10) for n in shape]
+    atlas[:border[0]] = 0
+    atlas[-border[0]:] = 0
+    atlas[:, :border[1]] = 0
+    atlas[:, -border[1]:] = 0
+    atlas[:, :, :border[2]] = 0
+    atlas[:, :, -border[2]:] = 0
+    return atlas
+
+
+def make_points(n_points, shape, n_series=1, seed=0):
+    """
+    Return an n_points by 4 array of points (Z, X, Y, series number) spread through a volume of
+    the given shape. Series are listed one after the other, as in files written by lasagna.
+    """
+    rng = np.random.default_rng(seed)
+    points = np.empty((n_points, 4))
+    points[:, :3] = rng.random((n_points, 3)) * (np.array(shape) - 1)
+    points[:, 3] = np.sort(rng.integers(0, n_series, n_points))
+    return points
+
+
+def make_lines(n_lines, points_per_line, shape, seed=0):
+    """
+    Return the points of n_lines random walks of points_per_line points each through a volume of
+    the given shape as an array of Z, X, Y and line number
+    """
+    rng = np.random.default_rng(seed)
+    starts = rng.random((n_lines, 1, 3)) * (np.array(shape) - 1)
+    steps = rng.normal(0, 1, (n_lines, points_per_line, 3))
+    walks = np.clip(starts + np.cumsum(steps, axis=1), 0, np.array(shape) - 1)
+    lines = np.empty((n_lines * points_per_line, 4))
+    lines[:, :3] = walks.reshape(-1, 3)
+    lines[:, 3] = np.repeat(np.arange(n_lines), points_per_line)
+    return lines
+
+
+def make_tree(n_nodes, shape, branch_probability=0.02, seed=0):
+    """
+    Return a neurite-like tree of n_nodes nodes as arrays of node ids (from 1), parent ids (0 for
+    the root) and Z, X, Y positions. Most nodes continue their parent's branch; some start a new one.
+    """
+    rng = np.random.default_rng(seed)
+    ids = np.arange(1, n_nodes + 1)
+    parents = ids - 1
+    branching = rng.random(n_nodes) < branch_probability
+    branching[0] = False
+    parents[branching] = (rng.random(branching.sum()) * (ids[branching] - 1)).astype(int) + 1
+
+    positions = np.empty((n_nodes, 3))
+    positions[0] = np.array(shape) / 2.0
+    steps = rng.normal(0, 1, (n_nodes, 3))
+    for row in range(1, n_nodes):
+        positions[row] = positions[parents[row] - 1] + steps[row]
+    return ids, parents, np.clip(positions, 0, np.array(shape) - 1)
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Writers
+def write_volume(directory, name, data, fmt):
+    """
+    Write volume data to directory in format fmt (tif, mhd, zarr, nrrd or nii) and return the file
+    name to give image_stack_loader.load_stack. Raises ImportError if the format needs a library
+    that is not installed.
+    """
+    from lasagna.io_libs import image_stack_loader
+
+    fname = os.path.join(directory, "%s.%s" % (name, fmt))
+    # The loaders reorder the axes of what they read, so each writer is given the axes in file order
+    if fmt == "tif":
+        import tifffile
+        write = getattr(tifffile, "imwrite", None) or tifffile.imsave
+        write(fname, data.swapaxes(1, 2))
+    elif fmt == "mhd":
+        # mhd_write only updates existing files, so the header is written here
+        raw = np.ascontiguousarray(data.swapaxes(1, 2))
+        raw.tofile(os.path.join(directory, name + ".raw"))
+        element_type = next(met for met, code in image_stack_loader.MET_TYPES.items() if code == raw.dtype.char)
+        image_stack_loader.mhd_write_header_file(fname, dict(ndims=3, dimsize=raw.shape[::-1],
+                                                             elementtype=element_type.upper(),
+                                                             elementdatafile=name + ".raw"))
+    elif fmt == "zarr":
+        image_stack_loader.save_chunked_stack(fname, data)
+    elif fmt == "nrrd":
+        import nrrd
+        nrrd.write(fname, np.ascontiguousarray(data.swapaxes(1, 2)))
+    elif fmt == "nii":
+        import nibabel as nib
+        nib.save(nib.Nifti1Image(np.ascontiguousarray(data.transpose(1, 2, 0)), np.eye(4)), fname)
+    else:
+        raise ValueError("Unknown volume format %s" % fmt)
+    return fname
+
+
+def write_points_csv(fname, points):
+    """
+    Write points in the lasagna text format: comma separated coordinates (and series number)
+    """
+    np.savetxt(fname, points, delimiter=",", fmt="%.6g")
+    return fname
+
+
+def write_cell_xml(fname, points):
+    """
+    Write points (Z, X, Y, marker type) as a CellCounter XML file
+    """
+    with open(fname, "w") as fid:
+        fid.write('<?xml version="1.0" encoding="UTF-8"?>\n<CellCounter_Marker_File>\n<Marker_Data>\n')
+        types = points[:, 3].astype(int)
+        for marker_type in np.unique(types):
+            fid.write("<Marker_Type>\n<Type>%d</Type>\n" % marker_type)
+            for z, x, y in points[types == marker_type, :3].astype(int):
+                fid.write("<Marker><MarkerX>%d</MarkerX><MarkerY>%d</MarkerY><MarkerZ>%d</MarkerZ></Marker>\n"
+                          % (x, y, z))
+            fid.write("</Marker_Type>\n")
+        fid.write("</Marker_Data>\n</CellCounter_Marker_File>\n")
+    return fname
+
+
+def write_tree_csv(fname, ids, parents, positions):
+    """
+    Write a tree in the format read by the tree reader: id, parent id, Z, X, Y
+    """
+    table = np.column_stack((ids, parents, positions))
+    np.savetxt(fname, table, delimiter=",", fmt=["%d", "%d", "%.4f", "%.4f", "%.4f"])
+    return fname
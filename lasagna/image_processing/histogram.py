@@ -0,0 +1,229 @@
+"""
+Exact intensity histograms of image stacks.
+
+A StackHistogram counts every voxel of a stack, one slab of slices at a time so that memory use
+stays small and disk-backed stacks are read sequentially. Slabs can be counted in parallel.
+Integer stacks of up to 16 bits are counted per intensity value, so any histogram derived from
+the counts is exact. Other stacks are counted into fixed, fine bins spanning their intensity range.
+
+The counts are kept, so the histogram plot and the default display range are both derived from
+them without touching the data again, and replacing some slices only requires those slices to be
+re-counted (see StackHistogram.update).
+
+Counting every voxel reads the whole stack, which defeats opening large memory-mapped or chunked
+stacks lazily. Such stacks can instead be sampled (see StackHistogram.countSample): the counts are
+then estimated from a coarser stored resolution level or from slices spread through them.
+"""
+
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from lasagna.image_processing.core_functions import default_hist_range
+
+
+class CountCancelled(Exception):
+    """
+    Raised by a progress function to stop StackHistogram counting. The counts are left incomplete.
+    """
+
+
+class StackHistogram(object):
+    """
+    Voxel intensity counts of an image stack
+    data - the stack. Anything that can be sliced along its first axis (ndarrays, memmaps, chunked volumes)
+    nThreads - number of slabs counted at once
+    slabVoxels - approximate number of voxels counted in one go
+    fineBins - number of bins used for stacks that are not 8 or 16 bit integers
+    sample - if True, estimate the counts from at most about sampleVoxels voxels (see countSample)
+    sampleVoxels - number of voxels read when sampling
+    progress - optional function called with the fraction of slabs counted so far. It may raise
+               CountCancelled to stop counting.
+    """
+
+    def __init__(self, data, nThreads=1, slabVoxels=2 ** 22, fineBins=4096, sample=False, sampleVoxels=2 ** 23,
+                 progress=None):
+        self.nThreads = max(int(nThreads), 1)
+        self.slabVoxels = slabVoxels
+        self.fineBins = fineBins
+        self.sampleVoxels = sampleVoxels
+        if sample:
+            self.countSample(data, progress)
+        else:
+            self.count(data, progress)
+
+    def count(self, data, progress=None):
+        """
+        Count every voxel of data from scratch
+        """
+        self.sampled = False
+        self.shape = tuple(data.shape)
+        self.dtype = np.dtype(data.dtype)
+        self.slabSize = max(1, int(self.slabVoxels // max(1, np.prod(self.shape[1:]))))
+
+        slabs = [slice(i, i + self.slabSize) for i in range(0, self.shape[0], self.slabSize)]
+        self.exact = self.dtype.kind in "bui" and self.dtype.itemsize <= 2
+        if self.exact:
+            # One bin per possible value
+            if self.dtype.kind == "b":
+                self.offset, n_values = 0, 2
+            else:
+                info = np.iinfo(self.dtype)
+                self.offset, n_values = int(info.min), int(info.max) - int(info.min) + 1
+            self.values = np.arange(n_values) + self.offset
+        else:
+            # A first pass finds the range to spread the bins over
+            limits = np.array(list(self._map(lambda slab: _finiteRange(data[slab]), slabs)))
+            low, high = np.nanmin(limits[:, 0]), np.nanmax(limits[:, 1])
+            if not np.isfinite(low):
+                low, high = 0.0, 1.0
+            if high <= low:
+                high = low + 1
+            self.edges = np.linspace(low, high, self.fineBins + 1)
+            self.values = self.edges[:-1]
+
+        self.counts = np.zeros(len(self.values), dtype=np.int64)
+        for n, slab_counts in enumerate(self._map(lambda slab: self._countVoxels(data[slab]), slabs)):
+            self.counts += slab_counts
+            if progress is not None:
+                progress((n + 1) / float(len(slabs)))
+
+    def countSample(self, data, progress=None):
+        """
+        Estimate the counts of data from at most about sampleVoxels of its voxels: its finest
+        stored resolution level that is small enough (e.g. of a multi-scale chunk directory) or
+        else slices spread evenly along its first axis. Only these are read. The counts are scaled
+        up to the size of data. Stacks no larger than the sample are counted in full.
+        """
+        shape = tuple(data.shape)
+        levels = [level for level in getattr(data, "levels", []) if level.size <= self.sampleVoxels]
+        if levels:
+            sample = levels[0]
+        else:
+            n_slices = int(min(shape[0], max(1, self.sampleVoxels // max(1, np.prod(shape[1:])))))
+            if n_slices == shape[0]:
+                self.count(data, progress)
+                return
+            sample = data[np.unique(np.linspace(0, shape[0] - 1, n_slices).round().astype(int))]
+
+        self.count(sample, progress)
+        self.counts = np.round(self.counts * (np.prod(shape, dtype=float) / np.prod(sample.shape))).astype(np.int64)
+        self.shape = shape
+        self.sampled = True
+
+    def update(self, oldData, newData, slices):
+        """
+        Update the counts after the slices (indices along the first axis) of oldData were replaced
+        to give newData. Only those slices of both stacks are read. The stack is counted from scratch
+        if newData has a different shape or type, or if it has values beyond the current bins.
+        """
+        if tuple(newData.shape) != self.shape or np.dtype(newData.dtype) != self.dtype:
+            self.count(newData)
+            return
+
+        slices = np.unique(np.asarray(slices, dtype=int))
+        groups = [slices[i:i + self.slabSize] for i in range(0, len(slices), self.slabSize)]
+
+        if not self.exact:
+            limits = np.array(list(self._map(lambda group: _finiteRange(newData[group]), groups)))
+            if len(limits) and (np.nanmin(limits[:, 0]) < self.edges[0] or np.nanmax(limits[:, 1]) > self.edges[-1]):
+                self.count(newData)
+                return
+
+        for removed in self._map(lambda group: self._countVoxels(oldData[group]), groups):
+            self.counts -= removed
+        for added in self._map(lambda group: self._countVoxels(newData[group]), groups):
+            self.counts += added
+
+    def histogram(self, bins=256):
+        """
+        Return the histogram (y, x) of the stack with bins equal bins spanning its intensity range,
+        as np.histogram(data, bins) would
+        """
+        occupied = np.flatnonzero(self.counts)
+        if len(occupied) == 0:
+            return np.histogram([], bins=bins)
+
+        values = self.values[occupied]
+        if self.exact:
+            value_range = (values[0], values[-1])
+        else:
+            value_range = (values[0], self.edges[occupied[-1] + 1])
+        y, x = np.histogram(values, bins=bins, range=value_range, weights=self.counts[occupied])
+        return y.astype(np.int64), x
+
+    def defaultRange(self, logY=False):
+        """
+        Returns a reasonable value for the maximum plotted value
+        logY if True we log the Y values
+        """
+        y, x = self.histogram(bins=100)
+        y = np.append(y, 0)
+
+        # Remove negative numbers from the calculation. Sometimes these happen with registered images
+        y = y[x > 0]
+        x = x[x > 0]
+        if len(x) == 0:
+            return 1
+
+        if logY:
+            y = np.log10(y + 0.1)
+
+        return default_hist_range(y, x)
+
+    def _countVoxels(self, block):
+        """
+        Return the counts of the voxels in block
+        """
+        block = np.asarray(block).ravel()
+        if self.exact:
+            if self.offset == 0:
+                return np.bincount(block, minlength=len(self.values))
+            return np.bincount(block.astype(np.int32) - self.offset, minlength=len(self.values))
+        return np.histogram(block, bins=self.edges)[0]
+
+    def _map(self, function, items):
+        """
+        Apply function to each item, in parallel if nThreads > 1, and yield the results in order.
+        Only a few items are handed to the threads ahead of the one being yielded, so memory use
+        does not grow with the number of items.
+        """
+        if self.nThreads == 1 or len(items) < 2:
+            for item in items:
+                yield function(item)
+            return
+
+        # Slabs not started yet are dropped if the caller stops early (e.g. CountCancelled)
+        executor = ThreadPoolExecutor(max_workers=self.nThreads)
+        queued = collections.deque()
+        try:
+            for item in items:
+                queued.append(executor.submit(function, item))
+                if len(queued) >= 2 * self.nThreads:
+                    yield queued.popleft().result()
+            while queued:
+                yield queued.popleft().result()
+        finally:
+            for future in queued:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+
+def isDiskBacked(data):
+    """
+    Return True if data are read from disk as they are indexed (memory-mapped or chunked stacks),
+    so that counting every voxel means reading the whole file
+    """
+    return isinstance(data, np.memmap) or not isinstance(data, np.ndarray)
+
+
+def _finiteRange(block):
+    """
+    Return the smallest and largest finite values in block, or NaNs if there are none
+    """
+    block = np.asarray(block)
+    block = block[np.isfinite(block)]
+    if block.size == 0:
+        return np.nan, np.nan
+    return block.min(), block.max()
@@ -3,12 +3,19 @@ This class defines the basic imagestack and instructs lasagna as to how to handl
 """
 
 
+import functools
+import threading
+from concurrent.futures import Future
+
 import numpy as np
 import pyqtgraph as pg
 from PyQt5 import QtGui, QtCore
 
+from lasagna.image_processing.histogram import StackHistogram, isDiskBacked
 from lasagna.ingredients.lasagna_ingredient import lasagna_ingredient
+from lasagna.io_libs.chunked_volume import ChunkedVolume
 from lasagna.io_libs.image_stack_loader import save_stack
+from lasagna.utils import preferences
 
 
 class imagestack(lasagna_ingredient):
@@ -21,6 +28,7 @@ class imagestack(lasagna_ingredient):
         objectName="",
         minMax=None,
         lut="gray",
+        histogram=None,
     ):
         super(imagestack, self).__init__(
             parent,
@@ -34,6 +42,18 @@ class imagestack(lasagna_ingredient):
 
         self.compositionMode = QtGui.QPainter.CompositionMode_Plus
 
+        # Memory all stacks together may use for contiguous copies of the data along axes 1 and 2 (see data())
+        self.maxAxisCopyBytes = preferences.readPreference("axisCopyCacheSizeMB") * 1024 ** 2
+
+        # Voxel intensity counts shared by the histogram plot and the default display range.
+        # They may have been calculated already, e.g. by the thread that loaded the stack.
+        # Disk-backed stacks are sampled rather than read in full (see countHistogramExactly).
+        if histogram is None:
+            self.stackHistogram = StackHistogram(self._data, nThreads=preferences.readPreference("histogramThreads"),
+                                                 sample=isDiskBacked(self._data))
+        else:
+            self.stackHistogram = histogram
+
         # Set reasonable default for plotting the images unless different values were specified
         if minMax is None:
             self.minMax = [0, self.defaultHistRange()]
@@ -113,16 +133,7 @@ class imagestack(lasagna_ingredient):
         if verbose:
             print("Calculating histogram")
 
-        nValsForCalc = 10E6 #Number of values on which to base histogram calculation
-        sampleEverynSamples = self.data().size
-        if self.data().size > nValsForCalc:
-            sampleEverynSamples = int(self.data().size/nValsForCalc)
-            if verbose:
-                print("Histogram based on one value every %d" % sampleEverynSamples)
-        else:
-            sampleEverynSamples=1
-
-        y, x = np.histogram(self.data()[::sampleEverynSamples], bins=256)
+        y, x = self.stackHistogram.histogram(bins=256)
         x = x[0:-1]  # chop off last value
         if verbose:
             print("Done")
@@ -153,13 +164,82 @@ class imagestack(lasagna_ingredient):
         Returns data formated in the correct way for plotting in the single axes that requested it.
         axisToPlot defines the data dimension along which we are plotting the data.
         specifically, axisToPlot is the dimension that is treated as the z-axis
+
+        For axes 1 and 2 the swapped view is badly strided, which makes every slice slow to copy.
+        So, if it fits in the memory cap, a contiguous copy is made in a background thread the first
+        time such an axis is requested. The strided view is returned until the copy is ready.
+        Copies are discarded when _data is assigned. Only stacks held in memory are copied: memory-
+        mapped and chunked stacks are read from disk a slice at a time and are never copied.
+        """
+        self._collectAxisCopies()
+        if axisToPlot in self._axisCopies:
+            return self._axisCopies[axisToPlot]
+
+        data = self._data.swapaxes(0, axisToPlot)
+        in_memory = isinstance(self._data, np.ndarray) and not isinstance(self._data, np.memmap)
+        if (axisToPlot != 0 and in_memory and axisToPlot not in self._axisCopyJobs
+                and axisToPlot not in self._axisCopyFailures):
+            stacks = self.parent.returnIngredientByType("imagestack") or []
+            used_bytes = sum([stack.axisCopyBytes() for stack in stacks if stack is not self])
+            if used_bytes + self.axisCopyBytes() + data.nbytes <= self.maxAxisCopyBytes:
+                self._startAxisCopy(axisToPlot, data)
+        return data
+
+    def _startAxisCopy(self, axisToPlot, view):
+        """
+        Make a contiguous copy of view in a worker thread for axis axisToPlot. The thread only sets
+        the result of a Future: the copy is moved into _axisCopies by _collectAxisCopies, on the
+        thread that plots, so the dictionaries are never changed while they are read.
         """
-        return self._data.swapaxes(0, axisToPlot)
+        future = Future()
+        self._axisCopyJobs[axisToPlot] = (view.nbytes, future)
+
+        def copy():
+            try:
+                future.set_result(np.ascontiguousarray(view))
+            except Exception as err:
+                future.set_exception(err)
+
+        threading.Thread(target=copy, daemon=True).start()
+
+    def _collectAxisCopies(self):
+        """
+        Keep the per-axis copies that have been made. Axes whose copy failed (e.g. for lack of
+        memory) are not copied again and keep using the strided view.
+        """
+        for axis, (_, future) in list(self._axisCopyJobs.items()):
+            if not future.done():
+                continue
+            del self._axisCopyJobs[axis]
+            if future.exception() is None:
+                self._axisCopies[axis] = future.result()
+            else:
+                self._axisCopyFailures.add(axis)
+                print("Could not copy %s along axis %d: %s" % (self.objectName, axis, future.exception()))
+
+    def axisCopyBytes(self):
+        """
+        Return the memory used by the contiguous per-axis copies of the data, including copies
+        being made
+        """
+        return (sum([copy.nbytes for copy in self._axisCopies.values()])
+                + sum([n_bytes for n_bytes, _ in self._axisCopyJobs.values()]))
+
+    def dataChanged(self):
+        """
+        Discard the per-axis copies, which no longer match _data
+        """
+        self._axisCopies = {}
+        self._axisCopyJobs = {}  # axis: (size in bytes, Future) of copies being made
+        self._axisCopyFailures = set()
 
     def plotIngredient(self, pyqtObject, axisToPlot=0, sliceToPlot=0):
         """
         Plots the ingredient onto pyqtObject along axisAxisToPlot,
-        onto the object with which it is associated
+        onto the object with which it is associated.
+        Only the visible part of the slice (plus a margin) is sent to pyqtObject, taken from the
+        coarsest pyramid level that still has at least one voxel per screen pixel. The ImageItem
+        is then scaled and offset so the image sits in full resolution voxel coordinates.
         """
 
         data = self.data(axisToPlot)
@@ -173,69 +253,226 @@ class imagestack(lasagna_ingredient):
         else:
             pyqtObject.setVisible(True)
 
+        request = self.planeRequest(pyqtObject, axisToPlot, sliceToPlot)
+        prefetcher = getattr(self.parent, "slicePrefetcher", None)
+        if prefetcher is None:
+            image = self.readPlane(request)
+        else:
+            image = prefetcher.get(request["key"], functools.partial(self.readPlane, request))
+
         pyqtObject.setImage(
-            data[sliceToPlot],
+            image,
             levels=self.minMax,
             compositionMode=self.compositionMode,
             lut=self.setColorMap(self.lut),
         )
+        pyqtObject.setRect(QtCore.QRectF(*request["rect"]))
 
-    def defaultHistRange(self, logY=False, verbose=False):
+        # Remember what was drawn so that refreshForView can skip redundant redraws
+        pyqtObject.renderedView = request["view"] + (request["coverage"],)
+
+    def planeRequest(self, pyqtObject, axisToPlot=0, sliceToPlot=0):
         """
-        Returns a reasonable values for the maximum plotted value.
-        logY if True we log the Y values
+        Work out what plotIngredient shows for sliceToPlot given the current view of pyqtObject:
+        the visible part of the slice (plus a margin), taken from the coarsest pyramid level that
+        still has at least one voxel per screen pixel. Returns a dict with:
+        key - identifies the image for the slice prefetcher
+        level, region - what readPlane reads
+        rect - where the image goes, in full resolution voxel coordinates
+        view, coverage - what refreshForView needs to decide whether a redraw is necessary
         """
+        data = self.data(axisToPlot)
+        sliceToPlot = min(max(sliceToPlot, 0), data.shape[0] - 1)
+
+        level, factors, stride = self.pyramidLevel(axisToPlot, self.viewPixelSize(pyqtObject))
+        x0, x1, y0, y1 = self.visibleRegion(pyqtObject, data.shape[1:], margin=0.5)
+
+        # Convert the region to voxels of the chosen level, aligned to the stride
+        lx0 = int(x0 // (factors[1] * stride)) * stride
+        ly0 = int(y0 // (factors[2] * stride)) * stride
+        lx1 = min(int(np.ceil(x1 / factors[1])), level.shape[1])
+        ly1 = min(int(np.ceil(y1 / factors[2])), level.shape[2])
+        level_slice = min(int(sliceToPlot // factors[0]), level.shape[0] - 1)
+        region = (level_slice, lx0, lx1, ly0, ly1, stride)
+
+        n_x = len(range(lx0, lx1, stride))
+        n_y = len(range(ly0, ly1, stride))
+        return {
+            "key": (self.dataVersion, axisToPlot, factors) + region,
+            "level": level,
+            "region": region,
+            "rect": (lx0 * factors[1], ly0 * factors[2], n_x * stride * factors[1], n_y * stride * factors[2]),
+            "view": (axisToPlot, sliceToPlot, factors, stride),
+            "coverage": (lx0 * factors[1], min(lx1 * factors[1], data.shape[1]),
+                         ly0 * factors[2], min(ly1 * factors[2], data.shape[2])),
+        }
 
-        if verbose:
-            print("Determining default histogram range")
-
-        nValsForCalc = 1E6 #Number of values on which to base histogram calculation
-        sampleEverynSamples = self.data().size
-        if self.data().size > nValsForCalc:
-            sampleEverynSamples = int(self.data().size/nValsForCalc)
-            if verbose:
-                print("Histogram based on one value every %d" % sampleEverynSamples)
-        else:
-            sampleEverynSamples=1
+    def readPlane(self, request):
+        """
+        Read the image described by a planeRequest. May be called from a worker thread.
+        """
+        level_slice, lx0, lx1, ly0, ly1, stride = request["region"]
+        return np.ascontiguousarray(request["level"][level_slice, lx0:lx1:stride, ly0:ly1:stride])
 
+    def prefetchJobs(self, pyqtObject, axisToPlot, slices):
+        """
+        Return (key, read) tuples for the slice prefetcher: one for each slice in slices that
+        lies within the stack, as it would be plotted in the current view of pyqtObject.
+        """
+        n_slices = self.data(axisToPlot).shape[0]
+        jobs = []
+        for this_slice in slices:
+            if 0 <= this_slice < n_slices:
+                request = self.planeRequest(pyqtObject, axisToPlot, this_slice)
+                jobs.append((request["key"], functools.partial(self.readPlane, request)))
+        return jobs
+
+    def refreshForView(self, pyqtObject, axisToPlot=0, sliceToPlot=0):
+        """
+        Re-plot after the view range of the axis changed, but only if the visible region is not
+        already covered by what was last drawn or if the zoom calls for a different pyramid level.
+        """
+        rendered = getattr(pyqtObject, "renderedView", None)
+        if rendered is not None:
+            _, factors, stride = self.pyramidLevel(axisToPlot, self.viewPixelSize(pyqtObject))
+            x0, x1, y0, y1 = self.visibleRegion(pyqtObject, self.data(axisToPlot).shape[1:])
+            rx0, rx1, ry0, ry1 = rendered[4]
+            if (
+                rendered[:4] == (axisToPlot, sliceToPlot, factors, stride)
+                and rx0 <= x0 and x1 <= rx1 and ry0 <= y0 and y1 <= ry1
+            ):
+                return
+
+        self.plotIngredient(pyqtObject, axisToPlot, sliceToPlot)
+
+    def pyramidLevels(self, axisToPlot=0):
+        """
+        Return the resolution levels of the stack as a list of (data, factors) tuples, finest first.
+        factors is the size of a voxel of that level in full resolution voxels along each dimension.
+        The first level is the stack itself. Further levels exist only for stacks that were loaded
+        with a stored pyramid (e.g. multi-scale chunk directories).
+        """
+        data = self.data(axisToPlot)
+        levels = [(data, (1.0, 1.0, 1.0))]
+        for level in getattr(data, "levels", []):
+            levels.append((level, tuple(n / float(m) for n, m in zip(data.shape, level.shape))))
+        return levels
 
-        y, x = np.histogram(self.data()[::sampleEverynSamples], bins=100)
-        y = np.append(y, 0)
+    def pyramidLevel(self, axisToPlot=0, pixelSize=(1, 1)):
+        """
+        Choose what to plot given the size of a screen pixel in voxels along x and y.
+        Returns the coarsest stored level whose voxels are no larger than a screen pixel, its
+        voxel size (see pyramidLevels) and the power of two by which to further stride that level.
+        Strided views of in-memory stacks are free, so these need no stored levels.
+        """
+        level, factors = self.pyramidLevels(axisToPlot)[0]
+        for this_level, these_factors in self.pyramidLevels(axisToPlot)[1:]:
+            if these_factors[1] <= pixelSize[0] and these_factors[2] <= pixelSize[1]:
+                level, factors = this_level, these_factors
 
-        # Remove negative numbers from the calculation. Sometimes these happen with registered images
-        y = y[x > 0]
-        x = x[x > 0]
+        remaining = min(pixelSize[0] / factors[1], pixelSize[1] / factors[2])
+        stride = 2 ** int(np.floor(np.log2(remaining))) if remaining >= 2 else 1
+        return level, factors, stride
 
-        if logY:
-            y = np.log10(y + 0.1)
+    def viewPixelSize(self, pyqtObject):
+        """
+        Return the size of a screen pixel in voxels along x and y for the view box showing pyqtObject
+        """
+        view_box = pyqtObject.getViewBox()
+        if view_box is None:
+            return 1, 1
+        pixel_size = view_box.viewPixelSize()
+        if not np.all(np.isfinite(pixel_size)) or min(pixel_size) <= 0:
+            return 1, 1
+        return pixel_size
+
+    def visibleRegion(self, pyqtObject, planeShape, margin=0):
+        """
+        Return the (x0, x1, y0, y1) voxel bounds of the part of a plane of shape planeShape that is
+        visible in the view box showing pyqtObject, clipped to the plane. margin enlarges the region
+        on each side by that fraction of the visible width and height, so small pans need no redraw.
+        """
+        view_box = pyqtObject.getViewBox()
+        if view_box is None or any(view_box.autoRangeEnabled()):
+            # An auto-ranging view box fits itself to the plotted image, so it must see all of it
+            return 0, planeShape[0], 0, planeShape[1]
+
+        (x0, x1), (y0, y1) = view_box.viewRange()
+        x_margin = (x1 - x0) * margin
+        y_margin = (y1 - y0) * margin
+        x0 = int(min(max(np.floor(x0 - x_margin), 0), planeShape[0]))
+        x1 = int(min(max(np.ceil(x1 + x_margin), 0), planeShape[0]))
+        y0 = int(min(max(np.floor(y0 - y_margin), 0), planeShape[1]))
+        y1 = int(min(max(np.ceil(y1 + y_margin), 0), planeShape[1]))
+
+        # Keep at least one voxel so there is always an image to plot
+        x0, y0 = min(x0, planeShape[0] - 1), min(y0, planeShape[1] - 1)
+        return x0, max(x1, x0 + 1), y0, max(y1, y0 + 1)
+
+    def valueAt(self, axisToPlot, sliceToPlot, x, y):
+        """
+        Return the full resolution voxel value at position x,y of slice sliceToPlot along axisToPlot.
+        Returns 0 outside the stack. (The plotted image may be cropped or downsampled, so it
+        can not be used to look up voxel values.)
+        """
+        data = self.data(axisToPlot)
+        if sliceToPlot is None:
+            return 0
+        if not (0 <= sliceToPlot < data.shape[0] and 0 <= x < data.shape[1] and 0 <= y < data.shape[2]):
+            return 0
+        return data[sliceToPlot, x, y]
 
-        # I'm sure this isn't the most robust approach but it works for now
-        thresh = 0.925  # find values greater than this proportion
+    def defaultHistRange(self, logY=False, verbose=False):
+        """
+        Returns a reasonable values for the maximum plotted value.
+        logY if True we log the Y values
+        """
 
-        m = x * y
-        vals = np.cumsum(m) / np.sum(m)
+        if verbose:
+            print("Determining default histogram range")
 
-        vals = vals > thresh
+        max_value = self.stackHistogram.defaultRange(logY=logY)
 
         if verbose:
             print("Done")
 
-        return x[vals.tolist().index(True)]
+        return max_value
+
+    def countHistogramExactly(self):
+        """
+        Count every voxel of a stack whose histogram was estimated from a sample. This reads the
+        whole stack, so is only done when asked for.
+        """
+        if not self.stackHistogram.sampled:
+            return
+        self.stackHistogram.count(self._data)
+        self.histogram = self.calcHistogram()
 
-    def changeData(self, imageData, imageAbsPath, recalculateDefaultHistRange=False):
+    def changeData(self, imageData, imageAbsPath, recalculateDefaultHistRange=False, changedSlices=None):
         """
         Replace the current image stack with imageData. 
         Must also supply imageAbsPath.
+        If only some slices (along the first axis) differ from the current stack, list them in
+        changedSlices and only those are re-counted for the histogram.
         """
 
-        if not isinstance(imageData, np.ndarray):
+        if not isinstance(imageData, (np.ndarray, ChunkedVolume)):
             return False
 
+        if changedSlices is None:
+            if isDiskBacked(imageData):
+                self.stackHistogram.countSample(imageData)
+            else:
+                self.stackHistogram.count(imageData)
+        else:
+            self.stackHistogram.update(self._data, imageData, changedSlices)
+        self.histogram = self.calcHistogram()
+
         self._data = imageData
         self.fnameAbsPath = imageAbsPath
 
         if recalculateDefaultHistRange:
-            self.defaultHistRange()
+            self.minMax = [0, self.defaultHistRange()]
 
         return True
 
@@ -269,9 +506,11 @@ class imagestack(lasagna_ingredient):
             )
             return
 
-        self._data = np.swapaxes(self._data, 2, axisToRotate)
-        self._data = np.rot90(self._data)
-        self._data = np.swapaxes(self._data, 2, axisToRotate)
+        # Equivalent to np.rot90 but written with indexing and swapaxes so that it
+        # also works on chunked volumes without reading them into RAM
+        self._data = self._data.swapaxes(2, axisToRotate)
+        self._data = self._data[:, ::-1].swapaxes(0, 1)
+        self._data = self._data.swapaxes(2, axisToRotate)
 
     def swapAxes(self, ax1, ax2):
         """
@@ -281,7 +520,7 @@ class imagestack(lasagna_ingredient):
             print("Axes to swap out of range. ")
             return
 
-        self._data = np.swapaxes(self._data, ax1, ax2)
+        self._data = self._data.swapaxes(ax1, ax2)
 
     def removeFromList(self):
         super(imagestack, self).removeFromList()
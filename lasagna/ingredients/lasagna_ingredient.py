@@ -7,9 +7,13 @@ areas, etc, etc. This superclass is inherited by ingredient files and helps
 define interactions between the data and Lasagna.
 """
 
+import itertools
 import os
 from PyQt5 import QtGui, QtCore
 
+# Every assignment to an ingredient's _data gets a new number from here (see lasagna_ingredient.dataVersion)
+_dataVersions = itertools.count()
+
 
 class lasagna_ingredient(object):
     '''
@@ -48,6 +52,28 @@ class lasagna_ingredient(object):
             None
         )  # The ingredient color (e.g. colour of the stack or lines or points)
 
+    @property
+    def _data(self):
+        """
+        The raw data. Assigning new data also gives the ingredient a new dataVersion, which
+        keys anything cached from the data (e.g. prefetched slices) so stale copies are never used.
+        Data modified in place keep their version.
+        """
+        return self._rawData
+
+    @_data.setter
+    def _data(self, data):
+        self._rawData = data
+        self.dataVersion = next(_dataVersions)
+        self.dataChanged()
+
+    def dataChanged(self):
+        """
+        Called whenever _data is assigned. Ingredients that keep state derived from
+        their data (e.g. copies or indexes) override this to discard it.
+        """
+        pass
+
     def fname(self):
         """ Strip the absolute path and return only the file name as as a string
 
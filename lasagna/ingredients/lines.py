@@ -15,16 +15,15 @@ line_reader_plugin that creates the menu entry in the file menu,
 loads the data from the csv file, and calls lines.py
 """
 
-import warnings  # to disable some annoying NaN-related warnings
-
 import numpy as np
 import pyqtgraph as pg
 from PyQt5 import QtGui, QtWidgets
-from matplotlib import cm
 from numpy import linspace
 
 from lasagna.ingredients.lasagna_ingredient import lasagna_ingredient
+from lasagna.io_libs.sparse_point_io import split_line_series, write_point_cloud
 from lasagna.utils import preferences
+from lasagna.utils.slab_index import SlabIndex
 
 
 class lines(lasagna_ingredient):
@@ -52,20 +51,24 @@ class lines(lasagna_ingredient):
         this_number = (
             self.parent.points_Model.rowCount() - 1
         ) % number_of_colors  # FIXME: rename
+        from matplotlib import cm  # matplotlib is slow to import, so only do it once the colours are needed
+
         cm_subsection = linspace(0, 1, number_of_colors)
         colors = [cm.jet(x) for x in cm_subsection]
         color = colors[this_number]
         self.color = [color[0] * 255, color[1] * 255, color[2] * 255]
 
-    def data(self, axisToPlot=0):
+    def data(self, axisToPlot=0, rows=None):
         """
         lines data are an n by 3 array where each row defines the location
         of a single point in x, y, and z
+        rows optionally selects the points to return
         """
         if not len(self._data):  # may be an array of a list
             return False
 
-        data = np.delete(self._data, axisToPlot, 1)
+        points = self._data if rows is None else np.asarray(self._data)[rows]
+        data = np.delete(points, axisToPlot, 1)
         if axisToPlot == 2:
             data = np.fliplr(data)
 
@@ -80,40 +83,49 @@ class lines(lasagna_ingredient):
             print("lines.py not proceeding because pyqtObject is false")
             return
 
-        # check if there are data on the plot. Use `is False` because np.array == False returns an array
-        if self.data() is False or len(self.data()) == 0:
+        # check if there are data on the plot
+        if self._data is None or len(self._data) == 0:
             pyqtObject.setData([], [])  # make sure there are no data left on the plot
             return
 
-        # Ensure our z dimension is a whole number
-        z = np.round(self._data[:, axisToPlot])
-
-        data = self.data(axisToPlot)
-
-        # Find points within this z-plane +/- a certain region
+        # Find points within this z-plane +/- a certain region. Points are rounded to whole layers
+        # and the NaN rows separating line series are never in range.
         z_range = self.parent.viewZ_spinBoxes[axisToPlot].value() - 1
         from_layer = sliceToPlot - z_range
         to_layer = sliceToPlot + z_range
+        rows, _ = self.slabIndex().query(axisToPlot, from_layer, to_layer)
 
-        # Now filter the data list by this Z range. Points that will not be plotted are replaced with nan
-        warnings.simplefilter(
-            action="ignore", category=RuntimeWarning
-        )  # To block weird run-time warnings that aren't of interest produced by the following two lines  # FIXME: use context manager
-        data[z < from_layer, :] = np.nan
-        data[z > to_layer, :] = np.nan
-
-        # If we have only NaNs we should not plot.
-        if not np.all(np.isnan(data)):
-            pyqtObject.setData(
-                x=data[:, 0],
-                y=data[:, 1],
-                pen=pg.mkPen(color=self.symbolBrush(), width=self.lineWidth),
-                antialias=True,
-                connect="finite",
-            )
-            pyqtObject.setVisible(True)
-        else:
+        # If no points are in range we should not plot.
+        if len(rows) == 0:
             pyqtObject.setVisible(False)
+            return
+
+        # Keep the original order and only join points that were neighbours in it, so lines
+        # are broken wherever a point is out of range or a series ends
+        rows = np.sort(rows)
+        data = self.data(axisToPlot, rows)
+        connect = np.append(np.diff(rows) == 1, False)
+
+        pyqtObject.setData(
+            x=data[:, 0],
+            y=data[:, 1],
+            pen=pg.mkPen(color=self.symbolBrush(), width=self.lineWidth),
+            antialias=True,
+            connect=connect,
+        )
+        pyqtObject.setVisible(True)
+
+    def slabIndex(self):
+        """
+        Returns the index used to find the points near a slice. It is built on first use
+        after the data are assigned.
+        """
+        if self._slabIndex is None:
+            self._slabIndex = SlabIndex(self._data)
+        return self._slabIndex
+
+    def dataChanged(self):
+        self._slabIndex = None
 
     def addToList(self):
         """
@@ -130,19 +142,26 @@ class lines(lasagna_ingredient):
             print(("lines.color can not cope with type " + str(type(self.color))))
 
     def save(self, path=None):
-        """Save sparse point in "pts" format (basic coordinates, space separated)"""
+        """Save lines in the format line_reader reads (series number and coordinates, comma
+        separated), or in lasagna's binary point cloud format if path ends with .npy"""
         fname = self.objectName + '.csv'
         if path is None:
-            path, _ = QtWidgets.QFileDialog.getSaveFileName(
-                self.parent, "File to save %s" % fname, fname
+            path, file_filter = QtWidgets.QFileDialog.getSaveFileName(
+                self.parent, "File to save %s" % fname, fname,
+                "Text Files (*.csv);; Point clouds (*.npy)"
             )
-            # getSaveFileName also returns the selected filter "All file (*)" for instance.
-            # Ignore the second output
+            # getSaveFileName also returns the selected filter
+            if "*.npy" in file_filter and path and not path.endswith(".npy"):
+                path += ".npy"
         if not path:
             return
-        with open(path, "w") as F:
-            for c in self.raw_data():
-                F.write(",".join(["%s" % i for i in c]) + "\n")
+        series, coords = split_line_series(self.raw_data())
+        if path.endswith(".npy"):
+            write_point_cloud(path, coords, series=series)
+        else:
+            with open(path, "w") as F:
+                for s, c in zip(series, coords):
+                    F.write(",".join(["%d" % s] + ["%s" % i for i in c]) + "\n")
         print("%s saved as %s" % (fname, path))
 
     # ---------------------------------------------------------------
@@ -3,12 +3,14 @@ This class overlays points on top of the image stacks.
 """
 
 import numpy as np
+import pyqtgraph as pg
 from PyQt5 import QtGui, QtCore, QtWidgets
-from matplotlib import cm
 from numpy import linspace
 
 from lasagna.ingredients.lasagna_ingredient import lasagna_ingredient
+from lasagna.io_libs.sparse_point_io import write_point_cloud
 from lasagna.utils import preferences
+from lasagna.utils.slab_index import SlabIndex
 
 
 class sparsepoints(lasagna_ingredient):
@@ -24,6 +26,7 @@ class sparsepoints(lasagna_ingredient):
         self.symbolSize = int(self.parent.markerSize_spinBox.value())
         self.alpha = int(self.parent.markerAlpha_spinBox.value())
         self.lineWidth = None  # Not used right now
+        self._brushCache = {}  # QBrush objects keyed by (color, alpha). See symbolBrushes()
 
         self.build_model_for_list(objectName)
         self.model = self.parent.points_Model
@@ -35,21 +38,25 @@ class sparsepoints(lasagna_ingredient):
         this_number = (
             self.parent.points_Model.rowCount() - 1
         ) % number_of_colors  # FIXME: rename
+        from matplotlib import cm  # matplotlib is slow to import, so only do it once the colours are needed
+
         cm_subsection = linspace(0, 1, number_of_colors)
         colors = [cm.jet(x) for x in cm_subsection]
         color = colors[this_number]
         self.color = [color[0] * 255, color[1] * 255, color[2] * 255]
 
-    def data(self, axisToPlot=0):
+    def data(self, axisToPlot=0, rows=None):
         """
         Sparse point data are an n by 3 array where each row defines the location
         of a single point in x, y, and z
+        rows optionally selects the points to return
         """
 
         if self._data is None or not len(self._data):
             return False
 
-        data = np.delete(self._data, axisToPlot, 1)
+        points = self._data if rows is None else np.asarray(self._data)[rows]
+        data = np.delete(points, axisToPlot, 1)
         if axisToPlot == 2:
             data = np.fliplr(data)
 
@@ -63,46 +70,43 @@ class sparsepoints(lasagna_ingredient):
         if not pyqtObject:
             return
 
-        # check if there is data. Use `is False` because np.array == False returns an array
-        if self.data() is False or len(self.data()) == 0:
+        # check if there is data
+        if self._data is None or len(self._data) == 0:
             pyqtObject.setData([], [])  # make sure there is no left data on plot
             return
 
-        z = np.round(self._data[:, axisToPlot])
-
-        data = self.data(axisToPlot)
-
         # Find points within this z-plane +/- a certain region
         z_range = self.parent.viewZ_spinBoxes[axisToPlot].value() - 1
         from_layer = sliceToPlot - z_range
         to_layer = sliceToPlot + z_range
-        data = data[(z >= from_layer) * (z <= to_layer), :]
-        z = z[(z >= from_layer) * (z <= to_layer)]
+        rows, z = self.slabIndex().query(axisToPlot, from_layer, to_layer)
+        data = self.data(axisToPlot, rows)
+        distance = np.abs(z - sliceToPlot)
 
-        # Add points, making points further from the current
-        # layer less prominent
+        # Make points further from the current layer smaller and less opaque
         # TODO: make this settable by the user via the YAML or UI elements
-        data_to_add = []
-        for i in range(len(data)):
-            # Get size for out-of layer points
-            size = self.symbolSize - abs(z[i] - sliceToPlot) * 2
-            if size < 1:
-                size = 1
-            # Get opacity for out-of layer points
-            alpha = self.alpha - abs(z[i] - sliceToPlot) * 20
-            if alpha < 10:
-                alpha = 10
-
-            data_to_add.append(
-                {
-                    "pos": (data[i, 0], data[i, 1]),
-                    "symbol": self.symbol,
-                    "brush": self.symbolBrush(alpha=alpha),
-                    "size": size,
-                }
-            )
+        sizes = np.maximum(self.symbolSize - distance * 2, 1)
+        alphas = np.maximum(self.alpha - distance * 20, 10)
+
+        pyqtObject.setData(
+            x=data[:, 0],
+            y=data[:, 1],
+            symbol=self.symbol,
+            size=sizes,
+            brush=self.symbolBrushes(alphas),
+        )
+
+    def slabIndex(self):
+        """
+        Returns the index used to find the points near a slice. It is built on first use
+        after the data are assigned.
+        """
+        if self._slabIndex is None:
+            self._slabIndex = SlabIndex(self._data)
+        return self._slabIndex
 
-        pyqtObject.setData(data_to_add)
+    def dataChanged(self):
+        self._slabIndex = None
 
     def addToList(self):
         """
@@ -126,20 +130,40 @@ class sparsepoints(lasagna_ingredient):
                 ("sparsepoints.color can not cope with type " + str(type(self.color)))
             )
 
+    def symbolBrushes(self, alphas):
+        """
+        Returns an array holding one QBrush per value in alphas. Points of equal
+        opacity share a brush, and brushes are cached across redraws.
+        """
+        levels, level_of_point = np.unique(np.round(alphas).astype(int), return_inverse=True)
+        brushes = np.empty(len(levels), dtype=object)
+        for i, alpha in enumerate(levels):
+            key = (tuple(self.color), alpha)
+            if key not in self._brushCache:
+                self._brushCache[key] = pg.mkBrush(self.symbolBrush(alpha=int(alpha)))
+            brushes[i] = self._brushCache[key]
+        return brushes[level_of_point.ravel()]
+
     def save(self, path=None):
-        """Save sparse point in "pts" format (basic coordinates, space separated)"""
+        """Save sparse point in "pts" format (basic coordinates, comma separated), or in
+        lasagna's binary point cloud format if path ends with .npy"""
         fname = self.objectName + '.csv'
         if path is None:
-            path, _ = QtWidgets.QFileDialog.getSaveFileName(
-                self.parent, "File to save %s" % fname, fname
+            path, file_filter = QtWidgets.QFileDialog.getSaveFileName(
+                self.parent, "File to save %s" % fname, fname,
+                "Text Files (*.csv);; Point clouds (*.npy)"
             )
-            # getSaveFileName also returns the selected filter "All file (*)" for instance.
-            # Ignore the second output
+            # getSaveFileName also returns the selected filter
+            if "*.npy" in file_filter and path and not path.endswith(".npy"):
+                path += ".npy"
         if not path:
             return
-        with open(path, "w") as F:
-            for c in self.raw_data():
-                F.write(",".join(["%s" % i for i in c]) + "\n")
+        if path.endswith(".npy"):
+            write_point_cloud(path, self.raw_data())
+        else:
+            with open(path, "w") as F:
+                for c in self.raw_data():
+                    F.write(",".join(["%s" % i for i in c]) + "\n")
         print("%s saved as %s" % (fname, path))
 
     # ---------------------------------------------------------------
@@ -3,10 +3,26 @@ import sys
 
 import json
 
+import numpy as np
+
+from lasagna.tree.tree_parser import build_array_tree
+from lasagna.utils.data_type_from_string import convert_column
+
 """
-Dumps ARA JSON as a flattened file that we can feed into our tree reader
+Reads the ARA structure ontology JSON, either as a flattened file that we can feed into our
+tree reader (import_data) or directly as a compact labels tree (import_tree).
+
+import_tree walks the ontology with an explicit stack, so deep ontologies can not hit the
+recursion limit, and caches the columns it reads in a binary sidecar file next to the JSON
+(the JSON file name plus LABELS_CACHE_SUFFIX). The cache holds the size and modification time of
+the JSON it was made from and is re-made whenever those change, so repeat loads of an atlas
+skip parsing the JSON altogether.
 """
 
+# The data columns of each structure and the JSON keys they are read from
+COLUMNS = (('atlas_id', 'atlas_id'), ('acronym', 'acronym'), ('name', 'name'), ('color', 'color_hex_triplet'))
+LABELS_CACHE_SUFFIX = '.labels.npz'
+
 
 def is_valid_json_file_path(fname):
     if not os.path.exists(fname):
@@ -33,22 +49,127 @@ def import_data(fname, verbose=False):
     return flattened_tree, col_names
 
 
-def flatten_tree(obj, flattened_tree=''):
-    if obj['parent_structure_id'] is None:
-        obj['parent_structure_id'] = 0
+def import_tree(fname, use_cache=True):
+    """
+    Import the ARA JSON in fname as an ArrayTree whose node ids are the structure ids and whose
+    data columns are atlas_id, acronym, name and color. As with tree_parser.parse_file, the
+    tree's root has id 0 and no data. The result is the tree that parse_file would make from
+    the output of import_data, without the text round trip.
+    use_cache - read from and write to the binary cache next to fname
+    """
+    if not is_valid_json_file_path(fname):
+        return
+
+    columns = _read_cache(fname) if use_cache else None
+    if columns is None:
+        with open(fname) as f:
+            obj = json.load(f)
+        columns = read_structures(obj['msg'][0])
+        if use_cache:
+            _write_cache(fname, columns)
+
+    names = [name for name, _ in COLUMNS]
+    return build_array_tree(columns['id'].tolist(), columns['parent'].tolist(), names,
+                            [columns[name] for name in names])
+
+
+def walk_structures(obj):
+    """
+    Yield structure obj and all those below it, parents before children, in the order of the JSON
+    """
+    stack = [obj]
+    while stack:
+        structure = stack.pop()
+        yield structure
+        stack.extend(reversed(structure.get('children', [])))
+
+
+def read_structures(obj):
+    """
+    Return the ids, parent ids and data columns of structure obj and all those below it as a
+    dictionary of arrays. Data columns are typed as tree_parser.parse_file would type them.
+    """
+    values = dict((name, []) for name in ('id', 'parent') + tuple(name for name, _ in COLUMNS))
+    for structure in walk_structures(obj):
+        values['id'].append(structure['id'])
+        values['parent'].append(structure['parent_structure_id'] or 0)
+        for name, key in COLUMNS:
+            values[name].append(str(structure[key]))
 
-    flattened_tree += "{id}|{parent_id}|{atlas_id}|{acronym}|{name}|{color}\n".format(
-            id=obj['id'],
-            parent_id=obj['parent_structure_id'],
-            atlas_id=obj['atlas_id'],
-            acronym=obj['acronym'],
-            name=obj['name'],
-            color=obj['color_hex_triplet'])
+    columns = {'id': np.array(values['id'], dtype=np.int64), 'parent': np.array(values['parent'], dtype=np.int64)}
+    for name, _ in COLUMNS:
+        columns[name] = convert_column(values[name])
+    return columns
 
-    for child in obj.get('children', []):
-        flattened_tree = flatten_tree(child, flattened_tree=flattened_tree)  # FIXME: check if shouldn't bee +=
 
-    return flattened_tree
+def labels_cache_path(fname):
+    """
+    Return the path of the binary cache of the ARA JSON file fname
+    """
+    return fname + LABELS_CACHE_SUFFIX
+
+
+def _json_signature(fname):
+    """
+    Return the size and modification time of fname, which identify the version cached
+    """
+    info = os.stat(fname)
+    return np.array([info.st_size, info.st_mtime])
+
+
+def _read_cache(fname):
+    """
+    Return the columns cached for fname, or None if there is no cache or it is out of date
+    """
+    cache_fname = labels_cache_path(fname)
+    if not os.path.exists(cache_fname):
+        return None
+    try:
+        with np.load(cache_fname) as cache:
+            if not np.array_equal(cache['signature'], _json_signature(fname)):
+                return None
+            columns = dict((name, cache[name]) for name in cache.files if name != 'signature')
+    except (OSError, ValueError, KeyError) as err:
+        print("Could not read labels cache %s: %s" % (cache_fname, err))
+        return None
+
+    # Text is cached as fixed width unicode. Return it as Python strings, as read_structures does.
+    for name, column in columns.items():
+        if column.dtype.kind == 'U':
+            columns[name] = np.array(column.tolist(), dtype=object)
+    return columns
+
+
+def _write_cache(fname, columns):
+    """
+    Cache columns next to fname. Failure is not an error: the JSON is simply parsed next time.
+    """
+    arrays = dict((name, column.astype(str) if column.dtype == object else column) for name, column in columns.items())
+    cache_fname = labels_cache_path(fname)
+    try:
+        # Write to a temporary file first so an interrupted write never leaves a broken cache
+        with open(cache_fname + '.tmp', 'wb') as fid:
+            np.savez(fid, signature=_json_signature(fname), **arrays)
+        os.replace(cache_fname + '.tmp', cache_fname)
+    except OSError as err:
+        print("Could not write labels cache %s: %s" % (labels_cache_path(fname), err))
+
+
+def flatten_tree(obj, flattened_tree=''):
+    """
+    Return the structure obj and all those below it as lines of "|" separated text, one per structure,
+    appended to flattened_tree
+    """
+    lines = [flattened_tree]
+    for structure in walk_structures(obj):
+        lines.append("{id}|{parent_id}|{atlas_id}|{acronym}|{name}|{color}\n".format(
+            id=structure['id'],
+            parent_id=structure['parent_structure_id'] or 0,
+            atlas_id=structure['atlas_id'],
+            acronym=structure['acronym'],
+            name=structure['name'],
+            color=structure['color_hex_triplet']))
+    return ''.join(lines)
 
 
 # ----------------------------------------------------------------------------
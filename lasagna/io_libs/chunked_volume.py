@@ -0,0 +1,531 @@
+"""
+Out-of-core image volumes stored as a directory of chunks.
+
+A ChunkedVolume behaves enough like a 3-D numpy array (shape, dtype, indexing, swapaxes)
+for the imagestack ingredient to use it in place of one, but voxels are only read from disk
+for the chunks that cover the requested region. Decoded chunks are kept in one process-wide
+LRU cache whose size is capped by the "chunkCacheSizeMB" preference, so the memory used by
+all chunked volumes together never exceeds that budget.
+
+Multi-page TIFFs can also be read lazily, one page per chunk (see open_tiff_stack).
+
+The on-disk layout of chunked stacks is that of a Zarr (v2) array: a directory holding a ".zarray" JSON file
+and one file per chunk named "i.j.k". Uncompressed, zlib and gzip chunks are handled with
+the standard library. Other compressors need the optional numcodecs package.
+A multi-scale group (a directory whose ".zattrs" lists one array per resolution level, as
+written by write_chunked_pyramid) opens as the full resolution volume with the coarser
+levels attached, so zoomed-out views need not read every full resolution chunk.
+"""
+
+import gzip
+import itertools
+import json
+import os
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from lasagna.utils import preferences
+
+ZARRAY_FILE_NAME = ".zarray"
+ZATTRS_FILE_NAME = ".zattrs"
+ZGROUP_FILE_NAME = ".zgroup"
+DEFAULT_CHUNKS = (64, 64, 64)
+
+
+# -------------------------------------------------------------------------------------------
+#   *Chunk cache*
+class ChunkCache(object):
+    """
+    Least-recently-used cache of decoded chunks with a hard limit on the number of bytes held.
+    Keys are (store uid, chunk index) tuples. The cache may be used from several threads.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = int(max_bytes)
+        self.n_bytes = 0
+        self._chunks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return the cached chunk for key, or None if it is not in the cache
+        """
+        with self._lock:
+            chunk = self._chunks.get(key)
+            if chunk is not None:
+                self._chunks.move_to_end(key)
+            return chunk
+
+    def put(self, key, chunk):
+        """
+        Add a chunk, evicting the least recently used chunks until the budget is respected.
+        Chunks larger than the whole budget are not cached.
+        """
+        if chunk.nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._chunks:
+                self.n_bytes -= self._chunks.pop(key).nbytes
+            self._chunks[key] = chunk
+            self.n_bytes += chunk.nbytes
+            while self.n_bytes > self.max_bytes:
+                _, evicted = self._chunks.popitem(last=False)
+                self.n_bytes -= evicted.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._chunks.clear()
+            self.n_bytes = 0
+
+
+_chunk_cache = None
+
+
+def get_chunk_cache():
+    """
+    Return the process-wide chunk cache, creating it on first use
+    """
+    global _chunk_cache
+    if _chunk_cache is None:
+        _chunk_cache = ChunkCache(preferences.readPreference("chunkCacheSizeMB") * 1024 ** 2)
+    return _chunk_cache
+
+
+# -------------------------------------------------------------------------------------------
+#   *Chunk stores*
+# A store has a path, a unique uid (which keys its chunks in the cache), shape, chunks (the chunk
+# shape), dtype and a read_chunk method returning the chunk at a given chunk grid position.
+_store_uids = itertools.count()
+
+
+class ZarrDirectoryStore(object):
+    """
+    Reads the chunks of a Zarr (v2) array held in a directory
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.uid = next(_store_uids)
+
+        with open(os.path.join(path, ZARRAY_FILE_NAME), "r") as fid:
+            meta = json.load(fid)
+
+        self.shape = tuple(meta["shape"])
+        self.chunks = tuple(meta["chunks"])
+        self.dtype = np.dtype(meta["dtype"])
+        self.order = meta.get("order", "C")
+        self.fill_value = meta.get("fill_value") or 0
+        self.compressor = meta.get("compressor")
+        self.filters = meta.get("filters") or []
+        self.dimension_separator = meta.get("dimension_separator", ".")
+
+    def read_chunk(self, chunk_index):
+        """
+        Return the chunk at chunk_index (a tuple of chunk grid coordinates) as a read-only array.
+        Chunks that were never written are filled with the fill value.
+        """
+        chunk_path = os.path.join(self.path, self.dimension_separator.join(map(str, chunk_index)))
+        if not os.path.exists(chunk_path):
+            chunk = np.full(self.chunks, self.fill_value, dtype=self.dtype)
+            chunk.flags.writeable = False
+            return chunk
+
+        with open(chunk_path, "rb") as fid:
+            raw = fid.read()
+
+        raw = self._decode(raw)
+        return np.frombuffer(raw, dtype=self.dtype).reshape(self.chunks, order=self.order)
+
+    def _decode(self, raw):
+        """
+        Undo the compression and filters of a chunk file
+        """
+        codecs = list(self.filters)
+        if self.compressor is not None:
+            codecs.append(self.compressor)
+
+        for config in reversed(codecs):
+            if config["id"] == "zlib":
+                raw = zlib.decompress(raw)
+            elif config["id"] == "gzip":
+                raw = gzip.decompress(raw)
+            else:
+                try:
+                    import numcodecs
+                except ImportError:
+                    raise IOError(
+                        "Chunks in {} use the {} codec, which needs numcodecs. "
+                        "Use `pip install numcodecs` to get it.".format(self.path, config["id"])
+                    )
+                raw = numcodecs.get_codec(config).decode(raw)
+        return raw
+
+
+class TiffPageStore(object):
+    """
+    Reads a multi-page TIFF stack one page at a time, each page being one chunk.
+    tiff is an open tifffile.TiffFile whose first series is a 3-D stack with one page per plane.
+    """
+
+    def __init__(self, path, tiff):
+        self.path = path
+        self.uid = next(_store_uids)
+
+        series = tiff.series[0]
+        self.shape = tuple(series.shape)
+        self.chunks = (1,) + self.shape[1:]
+        self.dtype = np.dtype(series.dtype)
+        self._tiff = tiff  # The file stays open for as long as the store exists
+        self._pages = series.pages
+        self._lock = threading.Lock()  # TiffFile reads are not thread-safe
+
+    def read_chunk(self, chunk_index):
+        with self._lock:
+            page = self._pages[chunk_index[0]].asarray()
+        return page.reshape(self.chunks)
+
+
+# -------------------------------------------------------------------------------------------
+#   *Chunked volume*
+class ChunkedVolume(object):
+    """
+    A lazily indexed view onto a chunk store.
+
+    Indexing that keeps all three dimensions (e.g. flipping with [::-1] or re-ordering planes)
+    returns another ChunkedVolume without reading anything. Indexing that drops a dimension
+    (e.g. taking a plane) reads only the chunks that cover the selection and returns an ndarray.
+
+    levels is a list of coarser ChunkedVolumes of the same data, finest first. Swapping axes
+    and flipping whole axes are applied to them too. Any other view drops them.
+    """
+
+    def __init__(self, store, index=None, axes=None, levels=None):
+        self.store = store
+        self.levels = levels or []
+
+        # One selector per store axis: either an int or a 1-D array of indices along that axis
+        if index is None:
+            index = tuple(np.arange(n) for n in store.shape)
+        self._index = index
+
+        # The store axes that remain (those not selected with an int) in the order of the view
+        if axes is None:
+            axes = tuple(a for a in range(len(index)) if not _is_int(index[a]))
+        self._axes = axes
+
+    # ---------------------------------------------------------------
+    # Array-like properties
+    @property
+    def shape(self):
+        return tuple(len(self._index[a]) for a in self._axes)
+
+    @property
+    def ndim(self):
+        return len(self._axes)
+
+    @property
+    def dtype(self):
+        return self.store.dtype
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return "ChunkedVolume(shape={}, dtype={}, path={})".format(self.shape, self.dtype, self.store.path)
+
+    def __array__(self, dtype=None, copy=None):
+        data = self.read()
+        if dtype is not None:
+            data = data.astype(dtype, copy=False)
+        return data
+
+    # ---------------------------------------------------------------
+    # Views
+    def swapaxes(self, axis1, axis2):
+        axes = list(self._axes)
+        axes[axis1], axes[axis2] = axes[axis2], axes[axis1]
+        levels = [level.swapaxes(axis1, axis2) for level in self.levels]
+        return ChunkedVolume(self.store, self._index, tuple(axes), levels)
+
+    def transpose(self, *axes):
+        if not axes:
+            axes = tuple(reversed(range(self.ndim)))
+        elif len(axes) == 1 and not _is_int(axes[0]):
+            axes = axes[0]
+        levels = [level.transpose(axes) for level in self.levels]
+        return ChunkedVolume(self.store, self._index, tuple(self._axes[a] for a in axes), levels)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        # Expand any Ellipsis and pad missing dimensions with full slices
+        if any(k is Ellipsis for k in key):
+            n = key.index(Ellipsis)
+            key = key[:n] + (slice(None),) * (self.ndim - len(key) + 1) + key[n + 1:]
+        if len(key) > self.ndim:
+            raise IndexError("too many indices for a volume with {} dimensions".format(self.ndim))
+        key = key + (slice(None),) * (self.ndim - len(key))
+
+        index = list(self._index)
+        for view_axis, k in enumerate(key):
+            store_axis = self._axes[view_axis]
+            if _is_int(k):
+                index[store_axis] = int(index[store_axis][k])
+            else:
+                index[store_axis] = index[store_axis][k]
+        index = tuple(index)
+        axes = tuple(a for a in self._axes if not _is_int(index[a]))
+
+        if len(axes) < self.store_ndim:
+            return ChunkedVolume(self.store, index, axes).read()
+
+        # Whole-axis flips map directly onto the coarser levels. Other selections do not.
+        if all(isinstance(k, slice) and k in (slice(None), slice(None, None, -1)) for k in key):
+            levels = [level[key] for level in self.levels]
+        else:
+            levels = []
+        return ChunkedVolume(self.store, index, axes, levels)
+
+    @property
+    def store_ndim(self):
+        return len(self.store.shape)
+
+    # ---------------------------------------------------------------
+    # Reading
+    def read(self):
+        """
+        Read the selected voxels from the chunks that cover them and return them as an ndarray
+        """
+        cache = get_chunk_cache()
+        chunks = self.store.chunks
+
+        # For each store axis, the chunks needed and where their voxels go in the output
+        per_axis = []
+        for a, selector in enumerate(self._index):
+            idx = np.atleast_1d(selector)
+            chunk_ids = idx // chunks[a]
+            per_axis.append(
+                [
+                    (c, _as_index(np.flatnonzero(chunk_ids == c)), _as_index(idx[chunk_ids == c] - c * chunks[a]))
+                    for c in np.unique(chunk_ids)
+                ]
+            )
+
+        out = np.empty([len(np.atleast_1d(s)) for s in self._index], dtype=self.dtype)
+        for combination in itertools.product(*per_axis):
+            chunk_index = tuple(int(c[0]) for c in combination)
+            key = (self.store.uid, chunk_index)
+            chunk = cache.get(key)
+            if chunk is None:
+                chunk = self.store.read_chunk(chunk_index)
+                cache.put(key, chunk)
+
+            out[_combine([c[1] for c in combination])] = chunk[_combine([c[2] for c in combination])]
+
+        # Drop the axes selected with an int and put the rest in the order of the view
+        out = out[tuple(0 if _is_int(s) else slice(None) for s in self._index)]
+        remaining = [a for a in range(len(self._index)) if not _is_int(self._index[a])]
+        out = out.transpose([remaining.index(a) for a in self._axes])
+        if out.ndim == 0:
+            return out[()]
+        return out
+
+
+def _is_int(value):
+    return isinstance(value, (int, np.integer))
+
+
+def _as_index(indices):
+    """
+    Return a slice if indices are evenly spaced and increasing, otherwise the indices themselves.
+    Slices keep the copies in ChunkedVolume.read cheap for the usual case of contiguous reads.
+    """
+    if len(indices) == 1:
+        return slice(int(indices[0]), int(indices[0]) + 1)
+    steps = np.diff(indices)
+    if steps[0] > 0 and np.all(steps == steps[0]):
+        return slice(int(indices[0]), int(indices[-1]) + 1, int(steps[0]))
+    return indices
+
+
+def _combine(selectors):
+    """
+    Combine per-axis selectors into one index. Index arrays are broadcast against each other
+    with np.ix_ so that they select a block rather than pairs of coordinates.
+    """
+    if all(isinstance(s, slice) for s in selectors):
+        return tuple(selectors)
+    arrays = [np.arange(s.start, s.stop, s.step or 1) if isinstance(s, slice) else s for s in selectors]
+    return np.ix_(*arrays)
+
+
+# -------------------------------------------------------------------------------------------
+#   *File handling*
+def is_chunked_stack(fname):
+    """
+    Return True if fname is a chunk directory or multi-scale group, or the .zarray
+    or .zattrs file inside one
+    """
+    if os.path.basename(fname) in (ZARRAY_FILE_NAME, ZATTRS_FILE_NAME):
+        fname = os.path.dirname(fname)
+    return os.path.isfile(os.path.join(fname, ZARRAY_FILE_NAME)) or _multiscale_paths(fname) is not None
+
+
+def open_chunked_stack(fname):
+    """
+    Open the chunk directory or multi-scale group fname (or the directory holding the
+    .zarray or .zattrs file fname) as a ChunkedVolume
+    """
+    if os.path.basename(fname) in (ZARRAY_FILE_NAME, ZATTRS_FILE_NAME):
+        fname = os.path.dirname(fname)
+
+    if os.path.isfile(os.path.join(fname, ZARRAY_FILE_NAME)):
+        return ChunkedVolume(ZarrDirectoryStore(fname))
+
+    paths = _multiscale_paths(fname)
+    levels = [ChunkedVolume(ZarrDirectoryStore(path)) for path in paths]
+    return ChunkedVolume(levels[0].store, levels=levels[1:])
+
+
+def open_tiff_stack(fname):
+    """
+    Open a 3-D multi-page TIFF without reading its image data.
+    Uncompressed, contiguous stacks are memory-mapped. Other stacks are returned as a ChunkedVolume
+    that reads a page when a slice needs it. Opening reads no pages: the histogram of the stack is
+    estimated from a sample of pages (see StackHistogram.countSample). Returns None for TIFFs that are not simple 3-D stacks
+    (e.g. single images, RGB or hyperstacks), which should be read with tifffile.imread.
+    """
+    import tifffile
+
+    try:
+        im = tifffile.memmap(fname, mode="c")
+        if im.ndim == 3:
+            return im
+        return None
+    except ValueError:
+        pass  # Not memory-mappable, e.g. compressed or not contiguous
+
+    tiff = tifffile.TiffFile(fname)
+    series = tiff.series[0]
+    if len(series.shape) != 3 or len(series.pages) != series.shape[0]:
+        tiff.close()
+        return None
+    return ChunkedVolume(TiffPageStore(fname, tiff))
+
+
+def _multiscale_paths(fname):
+    """
+    Return the array directories of the multi-scale group fname, finest first,
+    or None if fname is not a multi-scale group
+    """
+    attrs_file = os.path.join(fname, ZATTRS_FILE_NAME)
+    if not os.path.isfile(attrs_file):
+        return None
+
+    with open(attrs_file, "r") as fid:
+        attrs = json.load(fid)
+    try:
+        return [os.path.join(fname, dataset["path"]) for dataset in attrs["multiscales"][0]["datasets"]]
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+def write_chunked_stack(fname, data, chunks=DEFAULT_CHUNKS, compressor="zlib"):
+    """
+    Write the 3-D array data to the chunk directory fname.
+    data is written one chunk at a time, so it can be a memory-mapped or chunked volume
+    larger than RAM. compressor is either None or "zlib".
+    """
+    if not os.path.exists(fname):
+        os.makedirs(fname)
+
+    dtype = np.dtype(data.dtype)
+    meta = {
+        "zarr_format": 2,
+        "shape": list(data.shape),
+        "chunks": list(chunks),
+        "dtype": dtype.str,
+        "compressor": None if compressor is None else {"id": compressor, "level": 1},
+        "fill_value": 0,
+        "order": "C",
+        "filters": None,
+    }
+    with open(os.path.join(fname, ZARRAY_FILE_NAME), "w") as fid:
+        json.dump(meta, fid, indent=2)
+
+    grid = [range(0, n, c) for n, c in zip(data.shape, chunks)]
+    for starts in itertools.product(*grid):
+        region = tuple(slice(s, s + c) for s, c in zip(starts, chunks))
+        block = np.asarray(data[region])
+
+        # Edge chunks are padded to the full chunk size, as Zarr expects
+        chunk = np.zeros(chunks, dtype=dtype)
+        chunk[tuple(slice(0, n) for n in block.shape)] = block
+        raw = chunk.tobytes()
+        if compressor == "zlib":
+            raw = zlib.compress(raw, 1)
+
+        chunk_name = ".".join(str(s // c) for s, c in zip(starts, chunks))
+        with open(os.path.join(fname, chunk_name), "wb") as fid:
+            fid.write(raw)
+
+
+def write_chunked_pyramid(fname, data, min_size=512, chunks=DEFAULT_CHUNKS, compressor="zlib"):
+    """
+    Write data as a multi-scale group: the full resolution array in fname/0 and successive
+    2x downsampled (block-averaged) arrays in fname/1, fname/2, ... until no dimension
+    is larger than min_size. Each level is built from the previous one as written to disk,
+    so memory use is bounded by the chunk size rather than the size of data.
+    """
+    if not os.path.exists(fname):
+        os.makedirs(fname)
+
+    paths = ["0"]
+    write_chunked_stack(os.path.join(fname, "0"), data, chunks, compressor)
+    level = open_chunked_stack(os.path.join(fname, "0"))
+    while max(level.shape) > min_size:
+        paths.append(str(len(paths)))
+        write_chunked_stack(os.path.join(fname, paths[-1]), _DownsampledByTwo(level), chunks, compressor)
+        level = open_chunked_stack(os.path.join(fname, paths[-1]))
+
+    with open(os.path.join(fname, ZGROUP_FILE_NAME), "w") as fid:
+        json.dump({"zarr_format": 2}, fid)
+    with open(os.path.join(fname, ZATTRS_FILE_NAME), "w") as fid:
+        json.dump({"multiscales": [{"version": "0.1", "datasets": [{"path": p} for p in paths]}]}, fid, indent=2)
+
+
+class _DownsampledByTwo(object):
+    """
+    Averages 2x2x2 blocks of a volume one region at a time. Only provides what
+    write_chunked_stack needs: shape, dtype and indexing with a tuple of slices.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.dtype = np.dtype(data.dtype)
+        self.shape = tuple((n + 1) // 2 for n in data.shape)
+
+    def __getitem__(self, region):
+        source = np.asarray(self.data[tuple(slice(2 * r.start, 2 * r.stop) for r in region)], dtype=np.float64)
+
+        # Odd edges are padded by repeating the last voxel so that every block holds 8 voxels
+        source = np.pad(source, [(0, n % 2) for n in source.shape], mode="edge")
+        nz, nx, ny = [n // 2 for n in source.shape]
+        block = source.reshape(nz, 2, nx, 2, ny, 2).mean(axis=(1, 3, 5))
+
+        if self.dtype.kind in "iu":
+            block = np.round(block)
+        return block.astype(self.dtype)
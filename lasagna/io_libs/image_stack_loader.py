@@ -1,10 +1,9 @@
 """
-Read MHD stacks (using the vtk library) or TIFF stacks
+Read MHD, TIFF, NRRD, NII and chunked (Zarr) stacks
 @author: Rob Campbell - Basel - git<a>raacampbell.com
 https://github.com/sainsburywellcomecentre/lasagna
 """
 
-import imp  # to look for the presence of a module. Python 3 will require importlib
 import os
 import re
 import struct
@@ -12,11 +11,9 @@ import warnings
 
 import numpy as np
 
-from lasagna.utils import preferences, path_utils
-
-with warnings.catch_warnings():
-    warnings.simplefilter("ignore")
-    import nibabel as nib
+from lasagna.io_libs import chunked_volume
+from lasagna.utils import preferences
+from lasagna.utils.profiler import profiled
 
 # -------------------------------------------------------------------------------------------
 #   *General methods*
@@ -37,7 +34,22 @@ DATA_TYPES = {
     "uint": "I",
 }
 
+# ElementType values used by MHD files that do not have a DataType field
+MET_TYPES = {
+    "met_char": "b",
+    "met_uchar": "B",
+    "met_short": "h",
+    "met_ushort": "H",
+    "met_int": "i",
+    "met_uint": "I",
+    "met_long": "l",
+    "met_ulong": "L",
+    "met_float": "f",
+    "met_double": "d",
+}
+
 
+@profiled(category="loader")
 def load_stack(fname):
     """
     load_stack determines the data type from the file extension determines what data are to be
@@ -51,17 +63,21 @@ def load_stack(fname):
         return nrrd_read(fname)
     elif fname.lower().endswith(".nii"):
         return load_nii_stack(fname)
+    elif chunked_volume.is_chunked_stack(fname):
+        return load_chunked_stack(fname)
     else:
         print("\n\n*{} NOT LOADED. DATA TYPE NOT KNOWN\n\n".format(fname))
 
 
 def save_stack(fname, data, fmt="tif"):
     """Save the image data
-    Works only for tif for now
+    Works for tif and chunked (zarr) stacks
     """
     fmt = fmt.lower().strip().strip(".")
     if fmt in ("tif", "tiff"):
         save_tiff_stack(fname, data)
+    elif fmt == "zarr":
+        save_chunked_stack(fname, data)
     else:
         raise NotImplementedError
 
@@ -72,7 +88,7 @@ def image_filter():
     As image formats are added (or removed) from this module, this
     string should be manually modified accordingly.
     """
-    return "Images (*.mhd *.tiff *.tif *.nrrd *.nrd *.nii)"
+    return "Images (*.mhd *.tiff *.tif *.nrrd *.nrd *.nii *.zarray *.zattrs)"
 
 
 def get_voxel_spacing(fname, fall_back_mode=False):
@@ -130,10 +146,13 @@ def load_tiff_stack(fname, use_lib_tiff=False):
         print("Loading: " + tiff.get_info() + " with libtiff\n")
         im = np.asarray(samples[0])
     else:
+        # Simple 3-D stacks are opened lazily: memory-mapped or read page by page as slices are shown
         print("Loading: " + fname + " with tifffile\n")
-        from tifffile import imread
+        im = chunked_volume.open_tiff_stack(fname)
+        if im is None:
+            from tifffile import imread
 
-        im = imread(fname)
+            im = imread(fname)
 
     im = im.swapaxes(1, 2)
     print(
@@ -153,6 +172,28 @@ def save_tiff_stack(fname, data, use_lib_tiff=False):
     imsave(str(fname), data.swapaxes(1, 2))
 
 
+# -------------------------------------------------------------------------------------------
+#   *Chunked (Zarr) handling methods*
+def load_chunked_stack(fname):
+    """
+    Open a chunk directory without reading the voxels. The returned ChunkedVolume
+    only reads the chunks covering the slices that are actually plotted.
+    """
+    im = chunked_volume.open_chunked_stack(fname)
+    im = im.swapaxes(1, 2)
+    print(
+        "opened chunked image of size: cols: %d, rows: %d, layers: %d"
+        % (im.shape[1], im.shape[2], im.shape[0])
+    )
+    return im
+
+
+def save_chunked_stack(fname, data):
+    """Save data as a multi-resolution chunk directory, one chunk at a time
+    """
+    chunked_volume.write_chunked_pyramid(str(fname), data.swapaxes(1, 2))
+
+
 # -------------------------------------------------------------------------------------------
 #   *NII handling methods*
 def load_nii_stack(fname):
@@ -161,6 +202,10 @@ def load_nii_stack(fname):
     """
     if not check_file_exists(fname, "load_nii_stack"):
         return
+    with warnings.catch_warnings():  # nibabel is slow to import, so only do it when a NII stack is read
+        warnings.simplefilter("ignore")
+        import nibabel as nib
+
     nii_img = nib.load(fname)
     im = nii_img.get_data()
     print(
@@ -176,42 +221,46 @@ def load_nii_stack(fname):
 def mhd_read(fname, fall_back_mode=False):
     """ Read an MHD image file
 
-    Read an MHD file using either VTK (if available) or the slower-built in reader
+    The built-in reader memory-maps the raw file, so it is used whenever it can cope with
+    the data. VTK is only needed for compressed raw files.
     if fallBackMode is true we force use of the built-in reader
     """
+    if not check_file_exists(fname, "mhd_read"):
+        return False
 
-    if not fall_back_mode:
-        # Attempt to load vtk
-        try:
-            imp.find_module("vtk")
-            import vtk  # Seems not exist currently for Python 3 (Jan 2017)
-            from vtk.util.numpy_support import vtk_to_numpy
-        except ImportError:
-            print(
-                "Failed to find VTK. Falling back to built in (but slower) MHD reader"
-            )
-            fall_back_mode = True
-
-    if fall_back_mode:
+    if fall_back_mode or not mhd_is_compressed(mhd_read_header_file(fname)):
         return mhd_read_fallback(fname)
-    else:
-        # use VTK
-        imr = vtk.vtkMetaImageReader()
-        imr.SetFileName(fname)
-        imr.Update()
-
-        im = imr.GetOutput()
-
-        rows, cols, z = im.GetDimensions()
-        sc = im.GetPointData().GetScalars()
-        a = vtk_to_numpy(sc)
-        a = a.reshape(z, cols, rows)
-        a = a.swapaxes(1, 2)
-        print(
-            "Using VTK to read MHD image of size: cols: %d, rows: %d, layers: %d"
-            % (rows, cols, z)
-        )
-        return a
+
+    # Compressed raw data can not be memory-mapped
+    try:
+        import vtk
+        from vtk.util.numpy_support import vtk_to_numpy
+    except ImportError:
+        print("{} holds compressed data, which can only be read with VTK. Not importing data".format(fname))
+        return False
+
+    imr = vtk.vtkMetaImageReader()
+    imr.SetFileName(fname)
+    imr.Update()
+
+    im = imr.GetOutput()
+
+    rows, cols, z = im.GetDimensions()
+    sc = im.GetPointData().GetScalars()
+    a = vtk_to_numpy(sc)
+    a = a.reshape(z, cols, rows)
+    a = a.swapaxes(1, 2)
+    print(
+        "Using VTK to read MHD image of size: cols: %d, rows: %d, layers: %d"
+        % (rows, cols, z)
+    )
+    return a
+
+
+def mhd_is_compressed(header):
+    """ Return True if the MHD header says the raw file is compressed
+    """
+    return str(header.get("compresseddata", "")).strip().lower() == "true"
 
 
 def mhd_write(im_stack, fname):
@@ -266,43 +315,46 @@ def mhd_read_fallback(fname):
 
 def mhd_read_raw_file(fname, header):
     """
-    Raw .raw file associated with the MHD header file
+    Memory-map the .raw file associated with the MHD header file. No voxel data are read here:
+    the returned array is a view onto the file and planes are read from disk as they are indexed.
+    The mapping is copy-on-write, so modifying the array never alters the file.
     CAUTION: this may not adhere to MHD specs! Report bugs to author.
     """
-
-    if "headersize" in header and header["headersize"] > 0:
-        print(
-            "\n\n **MHD reader can not currently cope with header information in .raw file. "
-            "Contact the author** \n\n"
-        )
-        return False
-
-    # Set the endian type correctly
-    endian = "<"  # default little endian
-    if "byteorder" in header and header["byteorder"].lower == "true":
-        endian = ">"  # big endian
-
-    format_type = get_format_type_from_mhd_header(header)
-    if not format_type:
+    dtype = get_dtype_from_mhd_header(header)
+    if not dtype:
         print("\nCan not find data format type in MHD file. **CONTACT AUTHOR**\n")
         return False
 
-    path_to_file = path_utils.stripTrailingFileFromPath(fname)
-    print(header["elementdatafile"])  # TODO: CLEAN THIS SHIT
-
-    raw_fname = os.path.join(path_to_file, header["elementdatafile"])
-    with open(raw_fname, "rb") as fid:
-        data = fid.read()
-
-    dim_size = header["dimsize"]
-    # from: http://stackoverflow.com/questions/26542345/reading-data-from-a-16-bit-unsigned-big-endian-raw-image-file-in-python
-    fmt = "{}{}{}".format(endian, (int(np.prod(dim_size))), format_type)
-    pix = np.asarray(struct.unpack(fmt, data))
+    raw_fname = os.path.join(os.path.dirname(fname), header["elementdatafile"])
+    if not check_file_exists(raw_fname, "mhd_read_raw_file"):
+        return False
 
     # Round it to keep python 3 happy
-    dim_size = [round(d) for d in dim_size]
+    dim_size = [int(round(d)) for d in header["dimsize"]]
+    shape = (dim_size[2], dim_size[1], dim_size[0])
+    n_bytes = int(np.prod(shape)) * dtype.itemsize
+    file_size = os.path.getsize(raw_fname)
+
+    # HeaderSize is the number of bytes to skip at the start of the raw file.
+    # A value of -1 means the data are at the end of the file after a header of unknown length.
+    offset = int(header.get("headersize", 0))
+    if offset < 0:
+        offset = file_size - n_bytes
+
+    if offset < 0 or offset + n_bytes > file_size:
+        print(
+            "{} is {} bytes but the MHD header describes {} bytes of data after a {} byte header. "
+            "Not importing data".format(raw_fname, file_size, n_bytes, max(offset, 0))
+        )
+        return False
 
-    return pix.reshape((dim_size[2], dim_size[1], dim_size[0])).swapaxes(1, 2)
+    data = np.memmap(raw_fname, dtype=dtype, mode="c", offset=offset, shape=shape)
+    data = data.swapaxes(1, 2)
+    print(
+        "Memory-mapped MHD image of size: cols: %d, rows: %d, layers: %d"
+        % (data.shape[1], data.shape[2], data.shape[0])
+    )
+    return data
 
 
 def get_format_type_from_mhd_header(header):
@@ -321,13 +373,32 @@ def get_format_type_from_mhd_header(header):
     # If we couldn't find it, look in the ElenentType field
     if not format_type:
         if "elementtype" in header:
-            datatype = header["elementtype"].lower()
-            if datatype == "met_short":
-                format_type = "h"
+            format_type = MET_TYPES.get(header["elementtype"].lower(), False)
 
     return format_type
 
 
+def get_dtype_from_mhd_header(header):
+    """ Return the numpy dtype, including byte order, of the data described by an MHD header
+
+    Returns False if the data format can not be determined.
+    """
+    format_type = get_format_type_from_mhd_header(header)
+    if not format_type:
+        return False
+
+    endian = "<"  # default little endian
+    for key in ("elementbyteordermsb", "binarydatabyteordermsb"):
+        if str(header.get(key, "")).strip().lower() == "true":
+            endian = ">"  # big endian
+
+    # Once a byte order is given, struct format codes have standard sizes (e.g. "l" is 4 bytes)
+    # but numpy codes stay platform dependent, so build the dtype from the kind and the size.
+    n_bytes = struct.calcsize(endian + format_type)
+    kind = np.dtype(format_type.replace("c", "b")).kind
+    return np.dtype("{}{}{}".format(endian, kind, n_bytes))
+
+
 def mhd_write_raw_file(im_stack, fname, info=None):
     """
     Write raw MHD file.
@@ -470,30 +541,18 @@ def mhd_get_ratios(fname):
     """
     Get relative axis ratios from MHD file defined by fname
     """
-    if not check_file_exists(fname, mhd_get_ratios):
+    if not check_file_exists(fname, "mhd_get_ratios"):
         return
 
-    try:
-        # Attempt to use the vtk module to read the element spacing
-        imp.find_module("vtk")
-        import vtk
-
-        imr = vtk.vtkMetaImageReader()
-        imr.SetFileName(fname)
-        imr.Update()
-
-        im = imr.GetOutput()
-        spacing = im.GetSpacing()
-    except ImportError:
-        # If the vtk module fails, we try to read the spacing using the built-in reader
-        info = mhd_read_header_file(fname)
-        if "elementspacing" in info:
-            spacing = info["elementspacing"]
-        else:
-            print(
-                "Failed to find spacing info in MHA file. Using default axis length values"
-            )
-            return preferences.readPreference("defaultAxisRatios")  # defaults
+    # The spacing is in the header, so there is no need to read the image data
+    info = mhd_read_header_file(fname)
+    if "elementspacing" in info:
+        spacing = info["elementspacing"]
+    else:
+        print(
+            "Failed to find spacing info in MHA file. Using default axis length values"
+        )
+        return preferences.readPreference("defaultAxisRatios")  # defaults
 
     if not spacing:
         print(
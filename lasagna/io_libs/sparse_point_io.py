@@ -1,33 +1,45 @@
 """
 Functions to read and write points files
 
+The point readers parse whole files with NumPy, returning points as a single float array
+with one row per point, in lasagna order (Z, X, Y) unless stated otherwise. The transformix
+and vv readers return lists.
+
 TODO: The read functions have different outputs. We should decide on one
 """
 import os
+import warnings
 import yaml
 import xml.etree.ElementTree as ET
 
+import numpy as np
+
+
+def _load_table(file_name, n_cols=None, **kwargs):
+    """
+    Read a table of numbers from a text file with np.loadtxt. Returns an n by m float array,
+    which has no rows (and n_cols columns) if the file has no data.
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", UserWarning)  # loadtxt warns about empty files
+        data = np.loadtxt(str(file_name), dtype=float, ndmin=2, **kwargs)
+    if data.size == 0:
+        return np.empty((0, n_cols if n_cols is not None else 0))
+    return data
+
 
 def read_pts_file(file_name):
     """ Read an elastix pts file
 
     :param str file_name:
-    :return list pts_coord: list of list with pts coordinates
+    :return ndarray pts_coord: n by 3 array with pts coordinates
     :return tuple pts_type: coordinate system, 'point' or 'index'
     """
 
-    pts_coord = []
     with open(file_name, "r") as in_file:
         pts_type = in_file.readline().strip()
         npts = int(in_file.readline().strip())
-        for line in in_file.readlines():
-            line = line.strip()
-            if not line:  # skip last empty line
-                break
-            coords = [float(c) for c in line.split(" ")]
-            pts_coord.append(
-                [coords[i] for i in [2, 0, 1]]
-            )  # reorder in lasagna order (Z,X,Y)
+    pts_coord = _load_table(file_name, n_cols=3, skiprows=2)[:, [2, 0, 1]]  # reorder in lasagna order (Z,X,Y)
     if len(pts_coord) != npts:
         print(
             "!!! Warning found %i points but file says there are %i!!!"
@@ -39,49 +51,118 @@ def read_pts_file(file_name):
 def read_cell_xml(file_path, masiv_order=True):
     """Read the xml file generated by niftynet classifier
 
-    if masiv_order is True (default) return the cells as Z, X, Y otherwise X, Y, Z"""
+    if masiv_order is True (default) return the cells as Z, X, Y otherwise X, Y, Z
+    Returns an n by 4 integer array, the last column being the marker type"""
+
+    chunks = list(iter_cell_xml(file_path, masiv_order=masiv_order, chunk_size=None))
+    if not chunks:
+        return np.empty((0, 4), dtype=np.int64)
+    return np.concatenate(chunks)
+
+
+def iter_cell_xml(file_path, masiv_order=True, chunk_size=100000):
+    """Read the xml file generated by niftynet classifier (or Fiji's CellCounter) as it is parsed
+
+    Yields n by 4 integer arrays of cells (see read_cell_xml) of at most chunk_size rows, in file
+    order, so that the first cells can be used before the whole file is read. Each marker type is
+    gathered in its own buffer and a chunk never mixes types. If chunk_size is None each marker
+    type comes as one chunk. Elements are discarded once read, so memory use does not grow with
+    the size of the file."""
 
     if masiv_order:
         x, y, z = [1, 2, 0]
     else:
         x, y, z = [0, 1, 2]
-    tree = ET.parse(file_path)
-    root = tree.getroot()
-    for marker_data in root:
-        if marker_data.tag == "Marker_Data":
-            break
-    pts_type = []
-    for marker_type in marker_data:
-        if marker_type.tag != "Marker_Type":
-            print(
-                "Found something unexpected in the file (%s). Ignoring"
-                % marker_type.tag
-            )
+    column_of_tag = {"MarkerX": x, "MarkerY": y, "MarkerZ": z}
+
+    path = []  # tags of the open elements
+    marker_type = None  # the open Marker_Type element
+    type_name = None
+    buffers = {}  # one growable buffer per marker type
+    coords = [0, 0, 0]
+    for event, element in ET.iterparse(str(file_path), events=("start", "end")):
+        if event == "start":
+            if element.tag == "Marker_Type" and path[-1:] == ["Marker_Data"]:
+                marker_type = element
+                type_name = None
+                buffer = _GrowableArray(4, np.int64)
+            path.append(element.tag)
             continue
-        type_data = []
-        type_name = None
-        for element in marker_type:
+
+        path.pop()
+        parent = path[-1] if path else None
+        if marker_type is None:
+            if parent == "Marker_Data":
+                print("Found something unexpected in the file (%s). Ignoring" % element.tag)
+                element.clear()
+            continue
+
+        if parent == "Marker":
+            if element.tag not in column_of_tag:
+                raise IOError("Unexpected tag: %s" % element.tag)
+            coords[column_of_tag[element.tag]] = int(element.text)
+        elif parent == "Marker_Type":
             if element.tag == "Type":
                 type_name = int(element.text)
+                # Markers listed before their type go in the type's buffer now that it is known
+                pending, buffer = buffer, buffers.setdefault(type_name, _GrowableArray(4, np.int64))
+                if pending is not buffer and len(pending):
+                    buffer.extend(pending.take(), type_name)
             elif element.tag == "Marker":
-                coords = [None, None, None]
-                for dim in element:
-                    if dim.tag == "MarkerX":
-                        coords[x] = int(dim.text)
-                    elif dim.tag == "MarkerY":
-                        coords[y] = int(dim.text)
-                    elif dim.tag == "MarkerZ":
-                        coords[z] = int(dim.text)
-                    else:
-                        raise IOError("Unexpected tag: %s" % dim.tag)
-                type_data.append(coords)
+                buffer.append(coords + [-1 if type_name is None else type_name])
+                element.clear()
+                if len(marker_type) > 1024 and type_name is not None:
+                    del marker_type[:]  # drop the markers read so far
+                if chunk_size and type_name is not None and len(buffer) >= chunk_size:
+                    yield buffer.take()
             else:
-                raise IOError("Unexpected tag: %s" % dim.tag)
-        if type_name is None:
-            raise IOError("Could not find the type of that marker")
-        # make the output directly usable by lasagna
-        pts_type.extend([c + [type_name] for c in type_data])
-    return pts_type
+                raise IOError("Unexpected tag: %s" % element.tag)
+        elif element is marker_type:
+            if type_name is None:
+                raise IOError("Could not find the type of that marker")
+            if len(buffer):
+                yield buffer.take()
+            marker_type.clear()
+            marker_type = None
+
+
+class _GrowableArray(object):
+    """
+    Preallocated n by n_cols array that doubles in size when it is full
+    """
+
+    def __init__(self, n_cols, dtype=float, capacity=1024):
+        self._array = np.empty((capacity, n_cols), dtype=dtype)
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def _reserve(self, n_rows):
+        if self._length + n_rows > len(self._array):
+            capacity = max(2 * len(self._array), self._length + n_rows)
+            array = np.empty((capacity, self._array.shape[1]), dtype=self._array.dtype)
+            array[:self._length] = self._array[:self._length]
+            self._array = array
+
+    def append(self, row):
+        self._reserve(1)
+        self._array[self._length] = row
+        self._length += 1
+
+    def extend(self, rows, last_column=None):
+        """Append the rows of an array, optionally setting their last column to last_column"""
+        self._reserve(len(rows))
+        self._array[self._length:self._length + len(rows)] = rows
+        if last_column is not None:
+            self._array[self._length:self._length + len(rows), -1] = last_column
+        self._length += len(rows)
+
+    def take(self):
+        """Return a copy of the rows appended so far and empty the buffer"""
+        rows = self._array[:self._length].copy()
+        self._length = 0
+        return rows
 
 
 def read_transformix_output(file_path):
@@ -146,7 +227,7 @@ def read_vv_txt_landmarks(file_path):
     """ Read a VV landmark file
 
     :param str file_path:
-    :return:
+    :return: list of [Z, X, Y] landmark coordinates as strings
     """
     # read the vv file
     with open(file_path, "r") as in_file:
@@ -189,19 +270,84 @@ def read_masiv_roi(file_path):
 def read_lasagna_pts(fname):
     """ Read default lasagna pts format
 
-    It is just a list of space separated coordinante
+    It is just a list of comma separated coordinates, one point per line, optionally with
+    the point's series number in a fourth column
 
     :param str fname: path to file (usually .pts)
-    :return data: a list of coordinates
+    :return data: an n by 3 (or 4) array of coordinates
     """
-    with open(str(fname), "r") as fid:
-        contents = fid.read()
-
-    # a list of strings with each string being one line from the file
-    as_list = contents.split("\n")
-    data = []
-    for i in range(len(as_list)):
-        if not as_list[i]:
-            continue
-        data.append([float(x) for x in as_list[i].split(",")])
-    return data
+    return _load_table(fname, n_cols=3, delimiter=",")
+
+
+def write_point_cloud(fname, coords, series=None, attributes=None):
+    """ Write points in lasagna's binary point cloud format
+
+    The file is a NumPy .npy file holding a structured array with one record per point: the
+    coordinates in field "zxy", the optional series number in field "series" and one field per
+    point attribute. It can be memory mapped when read (see read_point_cloud).
+
+    :param str fname: target file. ".npy" is added if needed
+    :param coords: n by 3 array of coordinates in lasagna order (Z, X, Y)
+    :param series: optional array of n series numbers
+    :param dict attributes: optional dictionary of arrays with one value per point
+    :return str fname: the file written
+    """
+    coords = np.asarray(coords, dtype=float)
+    if coords.ndim != 2 or coords.shape[1] != 3:
+        raise ValueError("Coordinates should be an n by 3 array")
+    fields = [("zxy", coords.dtype, (3,))]
+    columns = {"zxy": coords}
+    if series is not None:
+        columns["series"] = np.asarray(series)
+        fields.append(("series", columns["series"].dtype))
+    for name, values in (attributes or {}).items():
+        if name in columns:
+            raise ValueError("Attribute name %s is reserved" % name)
+        columns[name] = np.asarray(values)
+        fields.append((str(name), columns[name].dtype, columns[name].shape[1:]))
+
+    records = np.empty(len(coords), dtype=fields)
+    for name, values in columns.items():
+        records[name] = values
+
+    if not fname.endswith(".npy"):
+        fname += ".npy"
+    np.save(fname, records)
+    return fname
+
+
+def read_point_cloud(fname, mmap_mode="r"):
+    """ Read points in lasagna's binary point cloud format (see write_point_cloud)
+
+    A plain n by 3 (or 4) array saved with np.save is read too, as a lasagna pts file would be.
+
+    :param str fname: path to the .npy file
+    :param str mmap_mode: passed to np.load. By default the arrays returned are read-only views
+                          of the file, which is only read when they are used
+    :return coords: n by 3 array of coordinates (Z, X, Y)
+    :return series: array of n series numbers, or None if the file has none
+    :return dict attributes: the other per-point arrays, by name
+    """
+    records = np.load(fname, mmap_mode=mmap_mode)
+    if records.dtype.names is None:
+        if records.ndim != 2 or records.shape[1] not in (3, 4):
+            raise IOError("%s is not a point cloud: found an array of shape %s" % (fname, records.shape))
+        return records[:, :3], records[:, 3] if records.shape[1] == 4 else None, {}
+
+    names = records.dtype.names
+    if "zxy" not in names:
+        raise IOError("%s is not a point cloud: it has no zxy field" % fname)
+    attributes = {name: records[name] for name in names if name not in ("zxy", "series")}
+    return records["zxy"], records["series"] if "series" in names else None, attributes
+
+
+def split_line_series(data):
+    """ Split the points of a lines ingredient into series
+
+    :param data: n by 3 array of points where line series are separated by rows of NaNs
+    :return series: the series number of each point, counting from 0
+    :return coords: the points without the separators
+    """
+    data = np.asarray(data, dtype=float)
+    separators = np.isnan(data).all(axis=1)
+    return np.cumsum(separators)[~separators], data[~separators]
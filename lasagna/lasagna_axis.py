@@ -2,12 +2,14 @@
 this file describes a class that handles the axis behavior for the lasagna viewer
 """
 
+import numpy as np
 import pyqtgraph as pg
 
 
 from lasagna.ingredients.imagestack import imagestack as lasagna_imagestack
 from lasagna.utils.lasagna_qt_helper_functions import find_pyqt_graph_object_name_in_plot_widget
 from lasagna.utils import preferences
+from lasagna.utils.profiler import profiled, timer
 
 
 class projection2D():
@@ -47,9 +49,15 @@ class projection2D():
         # The currently plotted slice
         self.currentSlice = None
 
+        # The number of slices ahead of the current one that are read in the background (see prefetchSlices)
+        self.nSlicesToPrefetch = preferences.readPreference('prefetchSlices')
+
         # Link the progressLayer signal to a slot that will move through image layers as the wheel is turned
         self.view.getViewBox().progressLayer.connect(self.wheel_layer_slot)
 
+        # Image stacks only plot the visible region at a zoom-dependent resolution, so refresh them on zoom or pan
+        self.view.getViewBox().sigRangeChanged.connect(self.view_range_changed_slot)
+
     def addItemToPlotWidget(self, ingredient):
         """
         Adds an ingredient to the PlotWidget as an item (i.e. the ingredient manages the process of 
@@ -162,12 +170,16 @@ class projection2D():
         print("NEED TO WRITE lasagna.axis.hideItem()")
         return
 
-    def updatePlotItems_2D(self, ingredientsList, sliceToPlot=None, resetToMiddleLayer=False):
+    @profiled(category="redraw")
+    def updatePlotItems_2D(self, ingredientsList, sliceToPlot=None, resetToMiddleLayer=False, previousSlice=None):
         """
         Update all plot items on axis, redrawing so everything associated with a specified 
         slice (sliceToPlot) is shown. This is done based upon a list of ingredients
+        previousSlice - the slice shown before, if it is no longer currentSlice (see RedrawScheduler.requestSlice)
         """
         verbose = False
+        if previousSlice is None:
+            previousSlice = self.currentSlice
 
         # loop through all plot items searching for imagestack items (these need to be plotted first)
         for ingredient in ingredientsList:
@@ -191,16 +203,19 @@ class projection2D():
                 if verbose:
                     print("lasagna_axis.updatePlotItems_2D - plotting ingredient " + ingredient.objectName)
 
-                ingredient.plotIngredient(
-                    pyqtObject=find_pyqt_graph_object_name_in_plot_widget(self.view,
-                                                                          ingredient.objectName,
-                                                                          verbose=verbose),
-                    axisToPlot=self.axisToPlot,
-                    sliceToPlot=self.currentSlice
-                )
+                with timer("plotIngredient[%s]" % ingredient.objectName, "ingredient", axis=self.axisToPlot):
+                    ingredient.plotIngredient(
+                        pyqtObject=find_pyqt_graph_object_name_in_plot_widget(self.view,
+                                                                              ingredient.objectName,
+                                                                              verbose=verbose),
+                        axisToPlot=self.axisToPlot,
+                        sliceToPlot=self.currentSlice
+                    )
                 # * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * *
 
-        # the image is now displayed
+        # the image is now displayed. Start reading the next slices in the direction we are moving.
+        if previousSlice is not None and self.currentSlice != previousSlice and not resetToMiddleLayer:
+            self.prefetchSlices(int(np.sign(self.currentSlice - previousSlice)))
 
         # loop through all plot items searching for non-image items (these need to be overlaid on top of the image)
         for ingredient in ingredientsList:
@@ -208,13 +223,32 @@ class projection2D():
                 if verbose:
                     print("lasagna_axis.updatePlotItems_2D - plotting ingredient " + ingredient.objectName)
 
-                ingredient.plotIngredient(
-                    pyqtObject=find_pyqt_graph_object_name_in_plot_widget(self.view,
-                                                                          ingredient.objectName,
-                                                                          verbose=verbose),
-                    axisToPlot=self.axisToPlot,
-                    sliceToPlot=self.currentSlice
-                )
+                with timer("plotIngredient[%s]" % ingredient.objectName, "ingredient", axis=self.axisToPlot):
+                    ingredient.plotIngredient(
+                        pyqtObject=find_pyqt_graph_object_name_in_plot_widget(self.view,
+                                                                              ingredient.objectName,
+                                                                              verbose=verbose),
+                        axisToPlot=self.axisToPlot,
+                        sliceToPlot=self.currentSlice
+                    )
+
+    def prefetchSlices(self, direction):
+        """
+        Ask the slice prefetcher to read the next image stack slices in direction (1 or -1) in
+        worker threads, so that they are ready by the time the wheel or the mouse gets there.
+        """
+        prefetcher = getattr(self.lasagna, 'slicePrefetcher', None)
+        if prefetcher is None or self.nSlicesToPrefetch < 1:
+            return
+
+        slices = [self.currentSlice + direction * (i + 1) for i in range(self.nSlicesToPrefetch)]
+        jobs = []
+        for ingredient in self.lasagna.ingredientList:
+            if isinstance(ingredient, lasagna_imagestack):
+                item = find_pyqt_graph_object_name_in_plot_widget(self.view, ingredient.objectName)
+                if item:
+                    jobs.extend(ingredient.prefetchJobs(item, self.axisToPlot, slices))
+        prefetcher.prefetch(self, jobs)
 
     def updateDisplayedSlices_2D(self, ingredients, slicesToPlot):
         """
@@ -224,8 +258,15 @@ class projection2D():
         """
         # self.updatePlotItems_2D(ingredients)  # TODO: Not have this here. This should be set when the mouse enters the axis and then not changed.
                                                # Like this it doesn't work if we are to change the displayed slice in the current axis using the mouse wheel.
-        self.linkedYprojection.updatePlotItems_2D(ingredients, slicesToPlot[0])
-        self.linkedXprojection.updatePlotItems_2D(ingredients, slicesToPlot[1])
+        scheduler = getattr(self.lasagna, 'redrawScheduler', None)
+        if scheduler is None:
+            self.linkedYprojection.updatePlotItems_2D(ingredients, slicesToPlot[0])
+            self.linkedXprojection.updatePlotItems_2D(ingredients, slicesToPlot[1])
+            return
+
+        # Mouse moves come faster than frames, so only the last position of each frame is drawn
+        scheduler.requestSlice(self.linkedYprojection.axisToPlot, slicesToPlot[0])
+        scheduler.requestSlice(self.linkedXprojection.axisToPlot, slicesToPlot[1])
 
     def getMousePositionInCurrentView(self, pos):
         # TODO: figure out what pos is and where best to put it. Then can integrate this call into updateDisplayedSlices
@@ -239,13 +280,40 @@ class projection2D():
         """
         Set the X and Y limits of the axis to nicely frame the data 
         """
-        self.view.autoRange()
+        # Image stacks may be plotted cropped to the view, so frame the full stacks rather than the plotted items
+        stacks = self.lasagna.returnIngredientByType('imagestack')
+        if not stacks:
+            self.view.autoRange()
+            return
+
+        shapes = [stack.data(self.axisToPlot).shape for stack in stacks]
+        self.view.setRange(xRange=(0, max([shape[1] for shape in shapes])),
+                           yRange=(0, max([shape[2] for shape in shapes])))
 
     # ------------------------------------------------------
     # slots
+    def view_range_changed_slot(self):
+        """
+        Refresh the image stacks after a zoom or pan so the plotted pyramid level and region follow the view
+        """
+        if self.currentSlice is None:
+            return
+
+        for ingredient in self.lasagna.ingredientList:
+            if isinstance(ingredient, lasagna_imagestack):
+                item = find_pyqt_graph_object_name_in_plot_widget(self.view, ingredient.objectName)
+                if item:
+                    ingredient.refreshForView(pyqtObject=item,
+                                              axisToPlot=self.axisToPlot,
+                                              sliceToPlot=self.currentSlice)
+
     def wheel_layer_slot(self):
         """
         Handle the wheel action that allows the user to move through stack layers
         """
-        self.updatePlotItems_2D(self.lasagna.ingredientList,
-                                sliceToPlot=round(self.currentSlice + self.view.getViewBox().progressBy))  # round creates an int that supresses a warning in p3
+        slice_to_plot = round(self.currentSlice + self.view.getViewBox().progressBy)  # round creates an int that supresses a warning in p3
+        scheduler = getattr(self.lasagna, 'redrawScheduler', None)
+        if scheduler is None:
+            self.updatePlotItems_2D(self.lasagna.ingredientList, sliceToPlot=slice_to_plot)
+        else:
+            scheduler.requestSlice(self.axisToPlot, slice_to_plot)
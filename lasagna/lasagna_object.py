@@ -16,7 +16,12 @@ from PyQt5.QtWidgets import qApp, QMainWindow
 from lasagna import lasagna_mainWindow, lasagna_axis, ingredients
 from lasagna.io_libs import image_stack_loader
 from lasagna.plugins import plugin_handler
+from lasagna.plugins.io.io_plugin_base import LazyIoPlugin
+from lasagna.redraw_scheduler import RedrawScheduler
+from lasagna.slice_prefetcher import SlicePrefetcher
+from lasagna.stack_load_worker import StackLoadWorker
 from lasagna.utils import preferences, path_utils
+from lasagna.utils.profiler import profiled, profiler
 from lasagna.utils.lasagna_qt_helper_functions import (
     find_pyqt_graph_object_name_in_plot_widget,
 )
@@ -88,6 +93,12 @@ class Lasagna(QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
             self.graphicsView_2,
             self.graphicsView_3,
         ]
+        # Image stack slices are read ahead of the displayed ones in worker threads (see projection2D.prefetchSlices)
+        self.slicePrefetcher = SlicePrefetcher(
+            preferences.readPreference("prefetchCacheSizeMB") * 1024 ** 2,
+            preferences.readPreference("prefetchThreads"),
+        )
+
         self.axes2D = []
         print("")
         for i in range(len(self.graphicsViews)):
@@ -152,6 +163,9 @@ class Lasagna(QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
         self.axes2D[1].linkedXprojection = self.axes2D[2]
         self.axes2D[1].linkedYprojection = self.axes2D[0]
 
+        # Slots that change what is shown ask for a redraw, which happens at most once per frame (see requestRedraw)
+        self.redrawScheduler = RedrawScheduler(self)
+
         # UI elements updated during mouse moves over an axis
         self.crossHairVLine = None
         self.crossHairHLine = None
@@ -164,6 +178,14 @@ class Lasagna(QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
         )  # A list defining voxel (Z,X,Y) in which the mouse cursor is currently positioned [see mouseMoved()]
         self.statusBarText = None
 
+        # Image stacks being loaded in worker threads (see loadImageStackAsync) and a status bar button to cancel them
+        self.stackLoadWorkers = {}
+        self.stackLoadProgress = {}
+        self.cancelStackLoadButton = QtWidgets.QPushButton("Cancel loading")
+        self.cancelStackLoadButton.clicked.connect(self.cancelStackLoads)
+        self.cancelStackLoadButton.hide()
+        self.statusBar.addPermanentWidget(self.cancelStackLoadButton)
+
         # Ensure that the menu on OS X appears the same as in Linux and Windows
         self.menuBar.setNativeMenuBar(False)
 
@@ -206,28 +228,34 @@ class Lasagna(QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
         io_paths = list(set(io_paths))  # remove duplicate paths
 
         print("Adding IO module paths to Python path")
-        io_plugins, io_plugin_paths = plugin_handler.find_plugins(io_paths)
+        io_plugins = plugin_handler.plugin_manifest(io_paths)
         for p in io_paths:
             sys.path.append(p)  # append to system path
             print(p)
 
         # Add *load actions* to the Load ingredients sub-menu and add loader modules here
         # TODO: currently we only have code to handle load actions as no save actions are available
+        # Loaders are imported when first used unless the manifest lacks what the menu needs
+        # or they have hooks.
         self.loadActions = (
             {}
         )  # actions must be attached to the lasagna object or they won't function
         for io_module in io_plugins:
-            io_class, io_name = plugin_handler.get_plugin_instance_from_file_name(
-                io_module, attribute_to_import="loaderClass"
-            )
-            if io_class is None:
-                continue
-            this_instance = io_class(self)
+            attributes = io_module["attributes"]
+            if "objectName" in attributes and "icon_name" in attributes and not attributes.get("hooks"):
+                this_instance = LazyIoPlugin(self, io_module["module_name"], attributes)
+            else:
+                io_class, io_name = plugin_handler.get_plugin_instance_from_file_name(
+                    io_module["file_name"], attribute_to_import="loaderClass"
+                )
+                if io_class is None:
+                    continue
+                this_instance = io_class(self)
             self.loadActions[this_instance.objectName] = this_instance
             print(
                 (
                     "Added %s to load menu as object name %s"
-                    % (io_module, this_instance.objectName)
+                    % (io_module["file_name"], this_instance.objectName)
                 )
             )
         print("")
@@ -313,7 +341,8 @@ class Lasagna(QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
         # 1. Get a list of all plugins in the plugins path and add their directories to the Python path
         plugin_paths = preferences.readPreference("pluginPaths")
 
-        plugins, plugin_paths = plugin_handler.find_plugins(plugin_paths)
+        plugins = plugin_handler.plugin_manifest(plugin_paths)
+        plugin_paths = plugin_handler.find_plugins(plugin_paths)[1]
         print("Adding plugin paths to Python path:")
         self.pluginSubMenus = {}
         for (
@@ -330,6 +359,8 @@ class Lasagna(QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
             self.menuPlugins.addAction(self.pluginSubMenus[dir_name].menuAction())
 
         # 2. Add each plugin to a dictionary where the keys are plugin name and values are instances of the plugin.
+        # Plugin modules are listed in the manifest and only imported when the plugin is started, so
+        # until then the value is None.
         print("")
         self.plugins = (
             {}
@@ -338,19 +369,12 @@ class Lasagna(QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
             {}
         )  # A dictionary where keys are plugin names and values are QActions associated with a plugin
         for plugin in plugins:
-            # Get the module name and class
-            plugin_class, plugin_name = plugin_handler.get_plugin_instance_from_file_name(
-                plugin, None
-            )
-            if plugin_class is None:
-                continue
+            plugin_name = plugin["module_name"]
 
             # Get the name of the directory in which the plugin resides so we can add it to the right sub-menu
-            dir_name = os.path.dirname(plugin_class.__file__).split(os.path.sep)[-1]
+            dir_name = plugin["directory"]
 
-            # create instance of the plugin object and add to the self.plugins dictionary
-            print(("Creating reference to class " + plugin_name + ".plugin"))
-            self.plugins[plugin_name] = plugin_class.plugin
+            self.plugins[plugin_name] = None
 
             # create an action associated with the plugin and add to the self.pluginActions dictionary
             print(("Creating menu QAction for " + plugin_name))
@@ -392,9 +416,19 @@ class Lasagna(QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
 
     def startPlugin(self, pluginName):
         print(("Starting " + pluginName))
-        self.plugins[pluginName] = self.plugins[pluginName](
-            self
-        )  # Create an instance of the plugin object
+        if self.plugins[pluginName] is None:  # Not imported yet
+            plugin_class, _ = plugin_handler.get_plugin_instance_from_file_name(
+                pluginName + ".py", None
+            )
+            if plugin_class is None:
+                self.pluginActions[pluginName].setChecked(False)
+                self.statusBar.showMessage("Could not load plugin {}".format(pluginName))
+                return
+            self.plugins[pluginName] = plugin_class.plugin
+        with profiler.timer("startPlugin[%s]" % pluginName, "plugin"):
+            self.plugins[pluginName] = self.plugins[pluginName](
+                self
+            )  # Create an instance of the plugin object
 
     def stopPlugin(self, pluginName):
         print(("Stopping " + pluginName))
@@ -430,6 +464,10 @@ class Lasagna(QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
                 if hook is None:
                     print("Skipping empty hook in hook list")
                     continue
+                elif profiler.enabled:
+                    # One timer per hook method, e.g. info_box_plugin.hook_updateMainWindowOnMouseMove_End
+                    with profiler.timer("%s.%s" % (hook.__module__, hook.__name__), "hook"):
+                        hook(*args)
                 else:
                     hook(*args)
             except Exception as err:
@@ -438,13 +476,14 @@ class Lasagna(QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     # File menu and methods associated with loading the base image stack.
+    @profiled(category="loader")
     def loadImageStack(self, fnameToLoad):
         """
         Loads an image image stack.
         """
         self.runHook(self.hooks["loadImageStack_Start"])
 
-        if not os.path.isfile(fnameToLoad):
+        if not os.path.exists(fnameToLoad):
             msg = "Unable to find " + fnameToLoad
             print(msg)
             self.statusBar.showMessage(msg)
@@ -455,22 +494,106 @@ class Lasagna(QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
         # TODO: The axis swap likely shouldn't be hard-coded here
         loaded_image_stack = image_stack_loader.load_stack(fnameToLoad)
 
-        if len(loaded_image_stack) == 0 and not loaded_image_stack:
+        if loaded_image_stack is None or loaded_image_stack is False or len(loaded_image_stack) == 0:
             return False
 
+        self.addImageStack(fnameToLoad, loaded_image_stack, image_stack_loader.get_voxel_spacing(fnameToLoad))
+
+    def loadImageStackAsync(self, fnameToLoad):
+        """
+        Loads an image stack in a worker thread, so the GUI stays responsive and several stacks
+        can load at once. Progress is shown in the status bar, from where loads can be cancelled.
+        The stack is added to the axes once it is ready. Use loadImageStack to load synchronously.
+        """
+        if not os.path.exists(fnameToLoad):
+            msg = "Unable to find " + fnameToLoad
+            print(msg)
+            self.statusBar.showMessage(msg)
+            return False
+
+        if fnameToLoad in self.stackLoadWorkers:
+            self.statusBar.showMessage(fnameToLoad + " is already loading")
+            return False
+
+        print(("Loading image stack " + fnameToLoad + " in the background"))
+
+        worker = StackLoadWorker(fnameToLoad)
+        worker.setAutoDelete(False)  # We keep a reference in stackLoadWorkers until it finishes
+        worker.signals.progress.connect(self.stackLoadProgressSlot)
+        worker.signals.finished.connect(self.stackLoadFinishedSlot)
+        worker.signals.failed.connect(self.stackLoadFailedSlot)
+        self.stackLoadWorkers[fnameToLoad] = worker
+        self.cancelStackLoadButton.show()
+        QtCore.QThreadPool.globalInstance().start(worker)
+        return True
+
+    def stackLoadProgressSlot(self, fname, step, percent):
+        """
+        Show the progress of all background stack loads in the status bar
+        """
+        self.stackLoadProgress[fname] = "%s: %s (%d%%)" % (os.path.basename(fname.rstrip(os.path.sep)), step, percent)
+        self.statusBar.showMessage("Loading " + ", ".join(list(self.stackLoadProgress.values())))
+
+    def stackLoadFinishedSlot(self, fname, result):
+        """
+        Add a stack loaded in the background to the ingredients and the axes
+        """
+        worker = self.stackLoadWorkers.pop(fname, None)
+        self.stackLoadProgress.pop(fname, None)
+        if not self.stackLoadWorkers:
+            self.cancelStackLoadButton.hide()
+        if worker is None or worker.cancelled:
+            return
+
+        self.runHook(self.hooks["loadImageStack_Start"])
+        self.addImageStack(
+            fname,
+            result["data"],
+            result["axisRatios"],
+            minMax=result["minMax"],
+            histogram=result["histogram"],
+        )
+        self.initialiseAxes()
+        self.statusBar.showMessage("Loaded " + fname)
+
+    def stackLoadFailedSlot(self, fname, reason):
+        self.stackLoadWorkers.pop(fname, None)
+        self.stackLoadProgress.pop(fname, None)
+        if not self.stackLoadWorkers:
+            self.cancelStackLoadButton.hide()
+
+        msg = "Did not load {}: {}".format(fname, reason)
+        print(msg)
+        self.statusBar.showMessage(msg)
+
+    def cancelStackLoads(self):
+        """
+        Cancel all image stacks that are loading in the background
+        """
+        for worker in list(self.stackLoadWorkers.values()):
+            worker.cancel()
+        if self.stackLoadWorkers:
+            self.statusBar.showMessage("Cancelling loading")
+
+    def addImageStack(self, fnameToLoad, loaded_image_stack, ax_ratio, **kwargs):
+        """
+        Add a loaded image stack to the ingredients and the axes. kwargs (e.g. a precomputed
+        minMax or histogram) are passed on to the imagestack constructor.
+        This finishes both loadImageStack and background loads, so it runs the loadImageStack_End hook.
+        """
         # Set up default values in tabs
         # It's ok to load images of different sizes but their voxel sizes need to be the same
-        ax_ratio = image_stack_loader.get_voxel_spacing(fnameToLoad)
         for i in range(len(ax_ratio)):
             self.axisRatioLineEdits[i].setText(str(ax_ratio[i]))
 
-        # Add to the ingredients list
-        obj_name = fnameToLoad.split(os.path.sep)[-1]
+        # Add to the ingredients list. Chunked stacks are directories, so may end with a separator
+        obj_name = fnameToLoad.rstrip(os.path.sep).split(os.path.sep)[-1]
         self.addIngredient(
             objectName=obj_name,
             kind="imagestack",
             data=loaded_image_stack,
             fname=fnameToLoad,
+            **kwargs
         )
 
         # Add item to all three 2D plots
@@ -517,9 +640,8 @@ class Lasagna(QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
         if fname is None:
             return
 
-        if os.path.isfile(fname):
-            self.loadImageStack(str(fname))
-            self.initialiseAxes()
+        if os.path.exists(fname):
+            self.loadImageStackAsync(str(fname))  # the axes are initialised when the stack is ready
         else:
             self.statusBar.showMessage("Unable to find " + str(fname))
 
@@ -596,8 +718,7 @@ class Lasagna(QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
         """
         self.runHook(self.hooks["loadRecentFileSlot_Start"])
         fname = str(self.sender().text())
-        self.loadImageStack(fname)
-        self.initialiseAxes()
+        self.loadImageStackAsync(fname)  # the axes are initialised when the stack is ready
 
     def quitLasagna(self):
         """
@@ -611,6 +732,8 @@ class Lasagna(QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
                 ].confirmOnClose:  # TODO: handle cases where plugins want confirmation to close
                     self.stopPlugin(thisPlugin)
 
+        self.cancelStackLoads()
+        self.slicePrefetcher.shutdown()
         qApp.quit()
         if self.embed_console:
             from prompt_toolkit.application.current import get_app
@@ -622,12 +745,13 @@ class Lasagna(QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
 
     # ------------------------------------------------------------------------
     # Ingredient handling methods
-    def addIngredient(self, kind="", objectName="", data=None, fname=""):
+    def addIngredient(self, kind="", objectName="", data=None, fname="", **kwargs):
         """
         Adds an ingredient to the list of ingredients.
         Scans the list of ingredients to see if an ingredient is already present.
         If so, it removes it before adding a new one with the same name.
         ingredients are classes that are defined in the ingredients package
+        Any further keyword arguments are passed to the ingredient constructor.
         """
 
         print(
@@ -652,7 +776,7 @@ class Lasagna(QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
         )  # make an ingredient of type "kind"
         self.ingredientList.append(
             ingredient_class_obj(
-                parent=self, fnameAbsPath=fname, data=data, objectName=objectName
+                parent=self, fnameAbsPath=fname, data=data, objectName=objectName, **kwargs
             )
         )
 
@@ -824,6 +948,7 @@ class Lasagna(QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
         """
         Updates all 2D plot elements in an axis.
         """
+        self.redrawScheduler.cancel()  # Everything is redrawn now
         [
             axis.updatePlotItems_2D(
                 self.ingredientList,
@@ -833,6 +958,14 @@ class Lasagna(QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
             for axis in self.axes2D
         ]
 
+    def requestRedraw(self, ingredients=None, axes=None):
+        """
+        Redraw ingredients (names or instances, all if None) in axes (indices, all if None) at the
+        next display frame. Requests made before then are drawn together, so use this rather than
+        update_2D_plot_ingredients_in_axes in slots that may be called many times a second.
+        """
+        self.redrawScheduler.requestRedraw(ingredients, axes)
+
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     # Slots for image stack tab
     # In each case, we set the values of the currently selected ingredient using the spinbox value
@@ -847,14 +980,19 @@ class Lasagna(QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
         if not ingredient:
             return
         self.returnIngredientByName(ingredient).alpha = int(value)
-        self.initialiseAxes()
+        self.requestRedraw(ingredient)
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     # Slots for points tab
     # In each case, we set the values of the currently selected ingredient using the spinbox value
     # TODO: this is an example of code that is not flexible. These UI elements should be created by the ingredient
     def viewZ_spinBoxes_slot(self):
-        self.update_2D_plot_ingredients_in_axes()
+        # The z spread only matters to the points and lines plotted in the axis of the spin box
+        axes = [self.viewZ_spinBoxes.index(self.sender())] if self.sender() in self.viewZ_spinBoxes else None
+        sparse = [ingredient for ingredient in self.ingredientList
+                  if not isinstance(ingredient, ingredients.imagestack.imagestack)]
+        if sparse:
+            self.requestRedraw(sparse, axes)
 
     def markerSymbol_comboBox_slot(self, index):
         symbol = str(self.markerSymbol_comboBox.currentText())
@@ -862,28 +1000,28 @@ class Lasagna(QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
         if not ingredient:
             return
         ingredient.symbol = symbol
-        self.update_2D_plot_ingredients_in_axes()
+        self.requestRedraw(ingredient)
 
     def markerSize_spinBox_slot(self, spinBoxValue):
         ingredient = self.returnIngredientByName(self.selectedPointsName())
         if not ingredient:
             return
         ingredient.symbolSize = spinBoxValue
-        self.update_2D_plot_ingredients_in_axes()
+        self.requestRedraw(ingredient)
 
     def markerAlpha_spinBox_slot(self, spinBoxValue):
         ingredient = self.returnIngredientByName(self.selectedPointsName())
         if not ingredient:
             return
         ingredient.alpha = spinBoxValue
-        self.update_2D_plot_ingredients_in_axes()
+        self.requestRedraw(ingredient)
 
     def lineWidth_spinBox_slot(self, spinBoxValue):
         ingredient = self.returnIngredientByName(self.selectedPointsName())
         if not ingredient:
             return
         ingredient.lineWidth = spinBoxValue
-        self.update_2D_plot_ingredients_in_axes()
+        self.requestRedraw(ingredient)
 
     def markerColor_pushButton_slot(self):
         ingredient = self.returnIngredientByName(self.selectedPointsName())
@@ -893,7 +1031,7 @@ class Lasagna(QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
         col = QtWidgets.QColorDialog.getColor()
         rgb = [col.toRgb().red(), col.toRgb().green(), col.toRgb().blue()]
         ingredient.color = rgb
-        self.update_2D_plot_ingredients_in_axes()
+        self.requestRedraw(ingredient)
 
     def selectedPointsName(self):
         """
@@ -1096,16 +1234,14 @@ class Lasagna(QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
         pixel_values = []
 
         # Get the pixel intensity of all displayed image layers under the mouse
-        # The following assumes that images have their origin at (0,0)
+        # Values come from the stacks, as the plotted images may be cropped or downsampled
+        axis = self.axes2D[self.inAxis]
         for thisImageItem in image_items:
-            im_shape = thisImageItem.image.shape
-
-            if x < 0 or y < 0:
-                pixel_values.append(0)
-            elif x >= im_shape[0] or y >= im_shape[1]:
+            stack = self.returnIngredientByName(thisImageItem.objectName)
+            if not stack:
                 pixel_values.append(0)
             else:
-                pixel_values.append(thisImageItem.image[x, y])
+                pixel_values.append(stack.valueAt(axis.axisToPlot, axis.currentSlice, x, y))
 
         # Build a text string to house these values
         value_str = ""
@@ -1130,6 +1266,7 @@ class Lasagna(QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
         self.last_button_click_in_axis = event[0].button()
         self.runHook(self.hooks["axisClicked"], self.axes2D[axis_id])
 
+    @profiled(category="interaction")
     def updateMainWindowOnMouseMove(self, axis):
         """
         Update UI elements on the screen (but not the plotted images) as the user moves the mouse across an axis
@@ -1269,6 +1406,12 @@ class Lasagna(QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
         action = QtWidgets.QAction("Save", self)
         action.triggered.connect(self.saveLayerStack_Slot)
         menu.addAction(action)
+
+        ingredient = self.returnIngredientByName(self.selectedStackName())
+        if ingredient and ingredient.stackHistogram.sampled:
+            action = QtWidgets.QAction("Count histogram exactly", self)
+            action.triggered.connect(self.countHistogramExactly_Slot)
+            menu.addAction(action)
         menu.exec_(self.imageStackLayers_TreeView.viewport().mapToGlobal(position))
 
     def changeImageStackColorMap_Slot(self):
@@ -1299,6 +1442,17 @@ class Lasagna(QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
         else:
             print("no save method for {}".format(obj_name))
 
+    def countHistogramExactly_Slot(self):
+        """
+        Replace the sampled histogram of the selected stack with one counted from every voxel
+        """
+        ingredient = self.returnIngredientByName(self.selectedStackName())
+        if not ingredient:
+            return
+        print("Counting every voxel of " + ingredient.objectName)
+        ingredient.countHistogramExactly()
+        self.plotImageStackHistogram()
+
     def stacksInTreeList(self):
         """
         Goes through the list of image stack layers in the QTreeView list
@@ -1377,6 +1531,7 @@ class Lasagna(QMainWindow, lasagna_mainWindow.Ui_lasagna_mainWindow):
                     max_x,
                 ]  # ensures levels stay set during all plot updates that follow
 
+    @profiled(category="interaction")
     def mouseMoved(self, evt):
         """
         Update the UI as the mouse interacts with one of the axes
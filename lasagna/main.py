@@ -25,7 +25,9 @@ import sys
 import argparse
 from PyQt5.QtWidgets import QApplication
 import pyqtgraph as pg
+from lasagna.lasagna_axis import projection2D
 from lasagna.lasagna_object import Lasagna
+from lasagna.utils.profiler import profiler, showFrameTimeOverlay
 
 
 def get_parser():
@@ -40,9 +42,9 @@ def get_parser():
                         help='File name(s) of image stacks to load')
 
     parser.add_argument('-S', '--sparse-points', dest='sparse_points', type=str, nargs='+',
-                        help='File names of sparse points file(s) to load')
+                        help='File names of sparse points file(s) to load (text or .npy point clouds)')
     parser.add_argument('-L', '--lines', type=str, nargs='+',
-                        help='File names of lines file(s) to load')
+                        help='File names of lines file(s) to load (text or .npy point clouds)')
     parser.add_argument('-T', '--tree', type=str, nargs='+',
                         help='File names of tree file(s) to load')
 
@@ -53,6 +55,11 @@ def get_parser():
                         help='Start a ipython console')
     parser.add_argument('-D', '--demo', action='store_true',
                         help='Load demo images')
+    parser.add_argument('--profile', nargs='?', const='lasagna_trace.json', default=None, metavar='TRACE_FILE',
+                        help='Time hooks, redraws and loaders, print a summary on exit and save every timed call '
+                             'to TRACE_FILE (default lasagna_trace.json) in the Chrome trace format')
+    parser.add_argument('--frame-times', dest='frame_times', action='store_true',
+                        help='Show the time taken by recent redraws in the main window (enables profiling)')
     return parser
 
 
@@ -76,12 +83,18 @@ def download_sample_stacks():
 
 # Set up the figure window
 def main(im_stack_fnames_to_load=None, sparse_points_to_load=None, lines_to_load=None, trees_to_load=None,
-         plugin_to_start=None, embed_console=False):
+         plugin_to_start=None, embed_console=False, profile_trace=None, show_frame_times=False):
+
+    if profile_trace is not None or show_frame_times:
+        profiler.enable()
 
     app = QApplication([])
 
-    tasty = Lasagna(embed_console=embed_console)
+    with profiler.timer('startup', 'startup'):
+        tasty = Lasagna(embed_console=embed_console)
     tasty.app = app
+    if show_frame_times:
+        tasty.frameTimeOverlay = showFrameTimeOverlay(tasty, projection2D.updatePlotItems_2D.timerName)
 
     # Data from command line input if the user specified this
     if im_stack_fnames_to_load is not None:
@@ -131,8 +144,21 @@ def main(im_stack_fnames_to_load=None, sparse_points_to_load=None, lines_to_load
         cfg.InteractiveShellApp.gui = 'qt5'
         import IPython
         IPython.start_ipython(config=cfg, argv=[], user_ns=dict(tasty=tasty, app=app))
+        write_profile(profile_trace)
     else:
-        sys.exit(app.exec_())
+        status = app.exec_()
+        write_profile(profile_trace)
+        sys.exit(status)
+
+
+def write_profile(profile_trace):
+    """
+    Print the timings and save them as a trace if profiling was asked for
+    """
+    if profile_trace is None:
+        return
+    profiler.printSummary()
+    profiler.writeChromeTrace(profile_trace)
 
 
 def run():
@@ -148,7 +174,8 @@ def run():
 
     main(im_stack_fnames_to_load=img_stack_fnames_to_load, sparse_points_to_load=args.sparse_points,
          lines_to_load=args.lines, trees_to_load=args.tree,
-         plugin_to_start=args.plugin, embed_console=args.console)
+         plugin_to_start=args.plugin, embed_console=args.console,
+         profile_trace=args.profile, show_frame_times=args.frame_times)
 
 
 # Start Qt event loop unless running in interactive mode.
@@ -17,6 +17,7 @@ from lasagna.plugins.ara import ara_explorer_UI
 
 # For contour drawing
 from lasagna.plugins.ara.ara_plugin_base import AraPluginBase
+from lasagna.plugins.ara.contour_cache import load_contour_sidecar
 
 
 class plugin(AraPluginBase, ara_explorer_UI.Ui_ara_explorer):
@@ -144,7 +145,7 @@ class plugin(AraPluginBase, ara_explorer_UI.Ui_ara_explorer):
         if self.data["currentlyLoadedAtlasName"]:
             self.lasagna.removeIngredientByName(self.data["currentlyLoadedAtlasName"])
 
-        self.data["labels"] = self.loadLabels(paths["labels"])  # see ARA_plotter.py
+        self.setLabels(self.loadLabels(paths["labels"]))  # see ARA_plotter.py
 
         self.addAreaDataToTreeView(
             self.data["labels"],
@@ -155,6 +156,9 @@ class plugin(AraPluginBase, ara_explorer_UI.Ui_ara_explorer):
         self.lasagna.loadImageStack(paths["atlas"])
 
         self.data["currentlyLoadedAtlasName"] = paths["atlas"].split(os.path.sep)[-1]
+        _, atlas_stack = self.get_atlas_image_stack()
+        if atlas_stack is not None:
+            self.contourCache.useSidecar(atlas_stack, load_contour_sidecar(paths["atlas"]))
 
         self.data["template"] = paths["template"]
         if os.path.exists(paths["template"]):
@@ -205,24 +209,14 @@ class plugin(AraPluginBase, ara_explorer_UI.Ui_ara_explorer):
 
     def AreaName2NodeID(self, thisTree, name, nodeID=None):
         """
-        Searches the tree for a brain area called name and returns the node ID (atlas index value)
-        Breaks out of the search loop if the area is found and propagates the value back through
-        the recursive function calls
+        Returns the node ID (atlas index value) of the brain area called name, or False if there
+        is none. The name is looked up in the label table compiled from thisTree when the labels
+        were loaded.
         """
-        if nodeID is None:
-            nodeID = self.rootNode
-
-        children = thisTree[nodeID].children
-        for child in sorted(children):
-            if thisTree[child].data["name"] == name:
-                return child
-            else:
-                return_val = self.AreaName2NodeID(
-                    thisTree=thisTree, name=name, nodeID=child
-                )
-                if return_val:
-                    return return_val
-        return False
+        node_id = self.labelTable.idOfName(name) if self.labelTable is not None else None
+        if node_id is None:
+            return False
+        return node_id
 
     def highlightSelectedAreaFromList(self):
         """
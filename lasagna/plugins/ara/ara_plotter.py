@@ -6,10 +6,11 @@ This enables more than one plugin to use these features.
 
 import numpy as np
 import pyqtgraph as pg
-# For contour drawing
-from skimage import measure
 
 from lasagna.tree import tree_parser
+# For contour drawing
+from lasagna.plugins.ara.contour_cache import ContourCache
+from lasagna.plugins.ara.label_table import LabelTable
 # For handling the labels files
 from lasagna.io_libs import ara_json
 
@@ -20,6 +21,7 @@ class ARA_plotter(object):  # must inherit LasagnaPlugin first
        
         self.lasagna = lasagna_serving
         self.contourName = 'aracontour'  # The ingredient name for the ARA contour
+        self.labelTable = None  # Compiled from the labels tree by setLabels
 
     # --------------------------------------
     # File handling and housekeeping methods
@@ -34,19 +36,25 @@ class ARA_plotter(object):  # must inherit LasagnaPlugin first
         Header must include at least the name of the area. So we can get, e.g. 
         'name': 'Entorhinal area, lateral part, layer 2'
 
-        The JSON should be the raw JSON from the ARA website
+        The JSON should be the raw JSON from the ARA website. It is parsed once and then
+        read from a binary cache next to it (see ara_json.import_tree)
 
         Returns the labels as a tree structure that can be indexed by ID
         """
 
         if fname.lower().endswith('.csv'):
             col_sep = self.guessFileSep(fname)
-            return tree_parser.parse_file(fname, col_sep=col_sep)
+            return tree_parser.parse_file(fname, col_sep=col_sep, compact=True)
 
         if fname.lower().endswith('.json'):
-            flattened, col_names = ara_json.import_data(fname)
-            table = flattened.split('\n')
-            return tree_parser.parse_file(table, col_sep='|', header_line=col_names)
+            return ara_json.import_tree(fname)
+
+    def setLabels(self, labels):
+        """
+        Store the labels tree returned by loadLabels and compile the lookup table used to name areas
+        """
+        self.data['labels'] = labels
+        self.labelTable = LabelTable(labels) if labels else None
 
     def guessFileSep(self, fname):
         """
@@ -72,6 +80,8 @@ class ARA_plotter(object):  # must inherit LasagnaPlugin first
             'loadFirstAtlasOnStartup': True,
             'enableNameInStatusBar': True,
             'enableOverlay': True,
+            'contourCacheSizeMB': 256,
+            'contourThreads': 1,
             }
 
     # --------------------------------------
@@ -104,29 +114,17 @@ class ARA_plotter(object):  # must inherit LasagnaPlugin first
 
         im_shape = imageStack.shape
         pos = self.lasagna.mousePositionInStack
-        
-        verbose = False
-        if verbose:
-            print("Mouse is in %d,%d,%d and image size is %d,%d,%d" %
-                  (pos[0], pos[1], pos[2], im_shape[0], im_shape[1], im_shape[2]))
 
         # Detect if the mouse is outside of the atlas
-        value = 0
-        for i in range(len(im_shape)):
-            if pos[i] < 0 or pos[i] >= im_shape[i]:
-                if verbose:
-                    print("NOT IN RANGE: pos: %d shape %d" % (pos[i], im_shape[i]))
-                area = 'outside image area'
-                value = -1
-                break
-
-        # If value is still zero we're inside the atlas image area
-        if value == 0:
+        if not all(0 <= p < s for p, s in zip(pos, im_shape)):
+            area = 'outside image area'
+            value = -1
+        else:
             value = imageStack[pos[0], pos[1], pos[2]]
             if value == 0:
                 area = 'outside brain'
-            elif value in self.data['labels'].nodes:
-                area = self.data['labels'][value].data['name']
+            elif self.labelTable is not None and value in self.labelTable:
+                area = self.labelTable.name(value)
             else:
                 area = 'UNKNOWN'
 
@@ -135,22 +133,41 @@ class ARA_plotter(object):  # must inherit LasagnaPlugin first
 
         return value
 
+    def makeContourCache(self):
+        """
+        Create the cache of area contours using the sizes in the plugin preferences
+        """
+        defaults = self.defaultPrefs()
+        size_mb = self.prefs.get('contourCacheSizeMB', defaults['contourCacheSizeMB'])
+        n_threads = self.prefs.get('contourThreads', defaults['contourThreads'])
+        self.contourCache = ContourCache(size_mb * 1024 ** 2, nThreads=n_threads)
+
+    def prefetchContours(self, imageStack):
+        """
+        Have the contours of all areas in the current slices found in the background.
+        This runs on every mouse move. The cache ignores requests for the planes it already has.
+        """
+        if imageStack is None or not imageStack.shape:
+            return
+        planes = [(ax_num, axis.currentSlice) for ax_num, axis in enumerate(self.lasagna.axes2D)
+                  if axis.currentSlice is not None and 0 <= axis.currentSlice < imageStack.shape[ax_num]]
+        if not planes:
+            return
+        self.contourCache.prefetch(imageStack, planes)
+
     def getContoursFromAxis(self, imageStack, axisNumber=-1, value=-1):
         """
-        Return a contours array from the axis indexed by integer axisNumber
-        i.e. one of the three axes
-        """        
+        Return the contours of area value in the current slice of the axis indexed by integer
+        axisNumber (i.e. one of the three axes) as an n by 3 array of stack coordinates.
+        Each contour is terminated by a row of NaNs.
+        """
         if axisNumber == -1:
             return False
 
-        imageStack = np.swapaxes(imageStack, 0, axisNumber)
         this_slice = self.lasagna.axes2D[axisNumber].currentSlice  # This is the current slice in this axis
-        tmp_image = np.array(imageStack[this_slice])  # So this is the image associated with that slice
-
-        # Make a copy of the image and set values lower than our value to a greater number
-        # since the countour finder will draw around everything less than our value
-        tmp_image[tmp_image < value] = value+10
-        return measure.find_contours(tmp_image, value)
+        if this_slice is None or this_slice < 0 or this_slice >= imageStack.shape[axisNumber]:
+            return np.empty((0, 3))
+        return self.contourCache.contours(imageStack, axisNumber, this_slice, value)
 
     def drawAreaHighlight(self, imageStack, value, highlightOnlyCurrentAxis=False):
         """
@@ -159,39 +176,25 @@ class ARA_plotter(object):  # must inherit LasagnaPlugin first
         if value <= 0:
             return
 
-        nans = np.array([np.nan, np.nan, np.nan]).reshape(1, 3)
-        all_contours = nans
+        all_contours = [np.array([np.nan, np.nan, np.nan]).reshape(1, 3)]
 
         for ax_num in range(len(self.lasagna.axes2D)):
             contours = self.getContoursFromAxis(imageStack, axisNumber=ax_num, value=value)
-            if (highlightOnlyCurrentAxis and ax_num != self.lasagna.inAxis) or not contours:
+            if (highlightOnlyCurrentAxis and ax_num != self.lasagna.inAxis) or not len(contours):
                 tmp_nan = np.array([np.nan, np.nan, np.nan]).reshape(1, 3)
                 tmp_nan[0][ax_num] = self.lasagna.axes2D[ax_num].currentSlice  # ensure nothing is plotted in this layer
-                all_contours = np.append(all_contours, tmp_nan, axis=0)
+                all_contours.append(tmp_nan)
                 continue
 
-            # print "Plotting area %d in plane %d" % (value,self.lasagna.axes2D[ax_num].currentSlice)
-            for contour in contours:
-                tmp = np.ones(contour.shape[0]*3).reshape(contour.shape[0], 3)*self.lasagna.axes2D[ax_num].currentSlice
-
-                if ax_num == 0:
-                    tmp[:, 1:] = contour
-                elif ax_num == 1:
-                    tmp[:, 0] = contour[:, 0]
-                    tmp[:, 2] = contour[:, 1]
-                elif ax_num == 2:
-                    tmp[:, 1] = contour[:, 0]
-                    tmp[:, 0] = contour[:, 1]
-
-                tmp = np.append(tmp, nans, axis=0)  # Terminate each contour with nans so that they are not  linked
-                all_contours = np.append(all_contours, tmp, axis=0)
+            all_contours.append(contours)
 
             if highlightOnlyCurrentAxis:
                 self.lastValue = value
-            
-        # Replace the data in the ingredient so they are plotted
-        self.lasagna.returnIngredientByName(self.contourName)._data = all_contours
-        self.lasagna.initialiseAxes()
+
+        # Replace the data in the ingredient. Only the contour needs redrawing, at the next frame.
+        self.lasagna.returnIngredientByName(self.contourName)._data = np.concatenate(all_contours)
+        self.lasagna.requestRedraw(self.contourName)
+        self.prefetchContours(imageStack)
 
     def setARAcolors(self):
         # Make up a disjointed colormap
@@ -19,6 +19,7 @@ class AraPluginBase(ARA_plotter, LasagnaPlugin, PyQt5.QtWidgets.QWidget):
         # Read file locations from preferences file (creating a default file if none exists)
         self.pref_file = get_lasagna_pref_dir() + 'ARA_plugin_prefs.yml'  # FIXME: should be in prefs module
         self.prefs = preferences.loadAllPreferences(prefFName=self.pref_file, defaultPref=self.defaultPrefs())  # FIXME: should be in prefs module
+        self.makeContourCache()  # from ARA_plotter
 
         # The last value the mouse hovered over. When this changes, we re-calculate the contour
         self.lastValue = -1
@@ -167,8 +168,11 @@ class AraPluginBase(ARA_plotter, LasagnaPlugin, PyQt5.QtWidgets.QWidget):
         value = self.writeAreaNameInStatusBar(image_stack, self.statusBarName_checkBox.isChecked())
 
         # Highlight the brain area we are mousing over by drawing a boundary around it
-        if self.lastValue != value and self.highlightArea_checkBox.isChecked():
-            self.drawAreaHighlight(image_stack, value)  # Inherited from ARA_plotter
+        if self.highlightArea_checkBox.isChecked():
+            if self.lastValue != value:
+                self.drawAreaHighlight(image_stack, value)  # Inherited from ARA_plotter
+            else:
+                self.prefetchContours(image_stack)  # Inherited from ARA_plotter
 
     def hook_deleteLayerStack_Slot_End(self):
         """
@@ -195,6 +199,7 @@ class AraPluginBase(ARA_plotter, LasagnaPlugin, PyQt5.QtWidgets.QWidget):
         """
         # remove the currently loaded ARA (if present)
         self.lasagna.removeIngredientByName('aracontour')
+        self.contourCache.shutdown()
 
         if self.data['currentlyLoadedAtlasName']:
             self.lasagna.removeIngredientByName(self.data['currentlyLoadedAtlasName'])
@@ -0,0 +1,378 @@
+"""
+Cache of brain area contours for the ARA highlight.
+
+Highlighting an area draws its outline in the current slice of each of the three axes. Finding
+those outlines means thresholding the slice and running the contour finder, which is too slow to
+repeat on every mouse move. A ContourCache keeps the outlines it has found keyed by
+(atlas, axis, slice, label) in a least-recently-used cache with a fixed memory budget, and
+worker threads fill it with the outlines of every area in the slices currently on display. So
+highlighting an area is usually a dictionary lookup per axis.
+
+Outlines are stored as n by 3 arrays of stack coordinates with each contour terminated by a row
+of NaNs, which is the format the lines ingredient plots.
+
+The outlines of every area in every slice of an atlas can also be found once, ahead of time, and
+written to a sidecar directory next to the atlas file (see write_contour_sidecar). The ARA plugins
+memory-map the sidecar when they load the atlas, so even the first highlight of an area needs no
+contour finding. To make the sidecar of an atlas run:
+python -m lasagna.plugins.ara.contour_cache /path/to/atlas.mhd
+"""
+
+import itertools
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import ndimage
+from skimage import measure
+
+from lasagna.io_libs.chunked_volume import ChunkCache
+from lasagna.io_libs.image_stack_loader import mhd_read_header_file
+
+_atlas_uids = itertools.count()
+
+# The stack columns that the row and column of a contour point in a slice along each axis map to
+PLANE_COLUMNS = {0: [1, 2], 1: [0, 2], 2: [1, 0]}
+
+
+class ContourCache(object):
+    """
+    Bounded cache of area outlines filled by a pool of worker threads
+    maxBytes - memory budget of the cache
+    nThreads - number of slices whose outlines are found at once
+    """
+
+    def __init__(self, maxBytes, nThreads=1):
+        self.cache = ChunkCache(maxBytes)
+        self._executor = ThreadPoolExecutor(max_workers=max(int(nThreads), 1))
+        self._queued = {}  # (atlas uid, axis, slice): future of each plane handed to the workers
+        self._wanted = None  # The planes of the last prefetch
+        self._lock = threading.Lock()
+        self._atlas = None
+        self._atlasUid = None
+        self._sidecar = None
+
+    def atlasUid(self, atlas):
+        """
+        Return the uid of the atlas volume. Only the outlines of the most recently used atlas are
+        kept: seeing a different atlas clears the cache.
+        """
+        if atlas is not self._atlas:
+            self.clear()
+            self._atlas = atlas
+            self._atlasUid = next(_atlas_uids)
+        return self._atlasUid
+
+    def contours(self, atlas, axis, sliceIndex, label):
+        """
+        Return the outline of area label in slice sliceIndex of atlas along axis, finding it now
+        if it is not cached. The array has no rows if the area is not in that slice.
+        """
+        key = (self.atlasUid(atlas), axis, sliceIndex, int(label))
+        if self._sidecar is not None:
+            return self._sidecar.outline(axis, sliceIndex, label)
+
+        outline = self.cache.get(key)
+        if outline is not None:
+            return outline
+
+        outline = stack_outline(area_contours(axis_plane(atlas, axis, sliceIndex), label), axis, sliceIndex)
+        self.cache.put(key, outline)
+        return outline
+
+    def prefetch(self, atlas, planes):
+        """
+        Queue finding the outlines of every area in the planes of atlas, a list of (axis, slice)
+        tuples. Queued planes that are no longer wanted are cancelled, so scrolling through the
+        stack does not leave the workers on slices that have gone from view. Asking again for the
+        same planes (e.g. on every mouse move) does nothing.
+        """
+        uid = self.atlasUid(atlas)
+        if self._sidecar is not None:
+            return
+        wanted = [(uid, axis, sliceIndex) for axis, sliceIndex in planes]
+        with self._lock:
+            if wanted == self._wanted:
+                return
+            self._wanted = wanted
+            for key, future in list(self._queued.items()):
+                if key not in wanted and future.cancel():
+                    del self._queued[key]
+
+            for key in wanted:
+                if key not in self._queued:  # Planes that were already outlined stay in _queued
+                    self._queued[key] = self._executor.submit(self._outlineSlice, atlas, *key)
+
+    def useSidecar(self, atlas, sidecar):
+        """
+        Take the outlines of the areas in atlas from sidecar, a ContourSidecar, rather than finding
+        them. This lasts until a different atlas is used.
+        """
+        self.atlasUid(atlas)
+        if sidecar is not None and tuple(sidecar.shape) != np.shape(atlas):
+            print("Contour sidecar %s does not match the shape of the atlas. Not using it" % sidecar.path)
+            return
+        self._sidecar = sidecar
+
+    def _outlineSlice(self, atlas, uid, axis, sliceIndex):
+        """
+        Runs in a worker thread
+        """
+        plane = axis_plane(atlas, axis, sliceIndex)
+        for label, contours in all_area_contours(plane):
+            key = (uid, axis, sliceIndex, label)
+            if self.cache.get(key) is None:
+                self.cache.put(key, stack_outline(contours, axis, sliceIndex))
+
+    def clear(self):
+        """
+        Cancel all queued work and empty the cache
+        """
+        with self._lock:
+            for future in self._queued.values():
+                future.cancel()
+            self._queued.clear()
+            self._wanted = None
+        self.cache.clear()
+        self._atlas = None
+        self._sidecar = None
+
+    def shutdown(self):
+        """
+        Cancel all queued work and stop the worker threads
+        """
+        self.clear()
+        self._executor.shutdown(wait=False)
+
+
+def axis_plane(atlas, axis, sliceIndex):
+    """
+    Return slice sliceIndex of the atlas volume along axis as a 2-D array
+    """
+    return np.asarray(np.swapaxes(atlas, 0, axis)[sliceIndex])
+
+
+def area_contours(plane, label, box=None):
+    """
+    Return the contours around the pixels of plane equal to label, as skimage.measure.find_contours
+    returns them. Only the bounding box of the area (plus a one pixel margin) is searched: box is
+    that bounding box as a pair of slices, found here if not supplied.
+    """
+    if box is None:
+        rows, cols = np.nonzero(plane == label)
+        if len(rows) == 0:
+            return []
+        box = (slice(rows.min(), rows.max() + 1), slice(cols.min(), cols.max() + 1))
+
+    top = max(box[0].start - 1, 0)
+    left = max(box[1].start - 1, 0)
+    crop = np.array(plane[top:box[0].stop + 1, left:box[1].stop + 1])
+
+    # Set values lower than our value to a greater number
+    # since the countour finder will draw around everything less than our value
+    crop[crop < label] = label + 10
+    return [contour + (top, left) for contour in measure.find_contours(crop, label)]
+
+
+def all_area_contours(plane):
+    """
+    Yield (label, contours) for every non-zero label in plane
+    """
+    labels, compact = np.unique(plane, return_inverse=True)
+    compact = compact.reshape(plane.shape) + 1  # find_objects wants labels counting up from 1
+    for n, box in enumerate(ndimage.find_objects(compact)):
+        if box is None or labels[n] == 0:
+            continue
+        yield labels[n].item(), area_contours(plane, labels[n], box)
+
+
+def plane_points(contours):
+    """
+    Stack contours into one n by 2 array in which each contour is terminated by a row of NaNs
+    """
+    if not contours:
+        return np.empty((0, 2))
+    nan_row = np.full((1, 2), np.nan)
+    return np.concatenate([piece for contour in contours for piece in (contour, nan_row)])
+
+
+def plane_to_stack(points, axis, sliceIndex):
+    """
+    Convert an n by 2 array of points in slice sliceIndex along axis to stack coordinates.
+    Rows of NaNs are kept as such.
+    """
+    outline = np.full((len(points), 3), np.nan)
+    outline[:, PLANE_COLUMNS[axis]] = points
+    outline[~np.isnan(outline[:, PLANE_COLUMNS[axis][0]]), axis] = sliceIndex
+    return outline
+
+
+def stack_outline(contours, axis, sliceIndex):
+    """
+    Convert contours found in slice sliceIndex along axis to stack coordinates, stacking them into
+    one n by 3 array in which each contour is terminated by a row of NaNs
+    """
+    return plane_to_stack(plane_points(contours), axis, sliceIndex)
+
+
+# -------------------------------------------------------------------------------------------
+#   *Contour sidecars*
+# A sidecar is a directory named after the atlas file with the suffix SIDECAR_SUFFIX. It holds a
+# JSON file describing the atlas it was made from and, for each axis n, four .npy files:
+# axis<n>_slices and axis<n>_labels list the (slice, label) pairs present, sorted, and the
+# outline of pair i is rows axis<n>_offsets[i] to axis<n>_offsets[i+1] of axis<n>_points, an
+# m by 2 array of in-slice coordinates with a row of NaNs after each contour.
+SIDECAR_SUFFIX = ".contours"
+SIDECAR_META_FILE_NAME = "contours.json"
+SIDECAR_ARRAYS = ("slices", "labels", "offsets", "points")
+
+
+def contour_sidecar_path(atlas_fname):
+    """
+    Return the path of the contour sidecar of atlas file atlas_fname
+    """
+    return atlas_fname.rstrip(os.path.sep) + SIDECAR_SUFFIX
+
+
+def _atlas_file_signature(atlas_fname):
+    """
+    Return the size and modification time of the atlas file, used to tell when a sidecar is stale.
+    The voxels of an MHD atlas are in the file named by its header, so that file is included too.
+    """
+    info = os.stat(atlas_fname)
+    signature = {"atlasSize": info.st_size, "atlasMtime": info.st_mtime}
+
+    if atlas_fname.lower().endswith(".mhd"):
+        data_file = mhd_read_header_file(atlas_fname).get("elementdatafile")
+        if data_file is not None:
+            data_file = os.path.join(os.path.dirname(atlas_fname), data_file)
+            if os.path.exists(data_file):
+                info = os.stat(data_file)
+                signature.update(dataSize=info.st_size, dataMtime=info.st_mtime)
+    return signature
+
+
+class ContourSidecar(object):
+    """
+    The memory-mapped outlines of every area in every slice of an atlas
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, SIDECAR_META_FILE_NAME), "r") as fid:
+            self.meta = json.load(fid)
+        self.shape = tuple(self.meta["shape"])
+
+        self._axes = []
+        for axis in range(len(self.shape)):
+            self._axes.append([np.load(os.path.join(path, "axis%d_%s.npy" % (axis, name)), mmap_mode="r")
+                               for name in SIDECAR_ARRAYS])
+
+    def outline(self, axis, sliceIndex, label):
+        """
+        Return the outline of area label in slice sliceIndex along axis as an n by 3 array of
+        stack coordinates. The array has no rows if the area is not in that slice.
+        """
+        slices, labels, offsets, points = self._axes[axis]
+        first = np.searchsorted(slices, sliceIndex, side="left")
+        last = np.searchsorted(slices, sliceIndex, side="right")
+        i = first + np.searchsorted(labels[first:last], label)
+        if i == last or labels[i] != label:
+            return np.empty((0, 3))
+        return plane_to_stack(points[offsets[i]:offsets[i + 1]], axis, sliceIndex)
+
+
+def load_contour_sidecar(atlas_fname):
+    """
+    Return the ContourSidecar of atlas file atlas_fname, or None if it has none or it is out of
+    date. Sidecars are made with write_contour_sidecar.
+    """
+    path = contour_sidecar_path(atlas_fname)
+    if not os.path.exists(os.path.join(path, SIDECAR_META_FILE_NAME)):
+        print("No contour sidecar for %s. Make one with: python -m lasagna.plugins.ara.contour_cache %s"
+              % (atlas_fname, atlas_fname))
+        return None
+
+    sidecar = ContourSidecar(path)
+    signature = _atlas_file_signature(atlas_fname)
+    if any(sidecar.meta.get(key) != value for key, value in signature.items()):
+        print("Contour sidecar %s is older than its atlas. Not using it" % path)
+        return None
+    return sidecar
+
+
+def write_contour_sidecar(atlas_fname, nThreads=1, progress=None):
+    """
+    Find the outlines of every area in every slice along all three axes of the atlas in file
+    atlas_fname and write them to its sidecar (see contour_sidecar_path)
+    nThreads - number of slices outlined at once
+    progress - optional function called with the axis and the fraction of its slices done
+    """
+    # The outlines must be in the coordinates of the stack as Lasagna loads it
+    from lasagna.io_libs import image_stack_loader
+
+    atlas = image_stack_loader.load_stack(atlas_fname)
+    if atlas is None or atlas is False:
+        print("Could not read atlas %s" % atlas_fname)
+        return False
+
+    path = contour_sidecar_path(atlas_fname)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    elif os.path.exists(os.path.join(path, SIDECAR_META_FILE_NAME)):
+        os.remove(os.path.join(path, SIDECAR_META_FILE_NAME))
+
+    with ThreadPoolExecutor(max_workers=max(int(nThreads), 1)) as executor:
+        for axis in range(atlas.ndim):
+            n_slices = atlas.shape[axis]
+            outline_slice = lambda sliceIndex, axis=axis: list(all_area_contours(axis_plane(atlas, axis, sliceIndex)))
+
+            slices, labels, lengths, points = [], [], [], []
+            for sliceIndex, areas in enumerate(executor.map(outline_slice, range(n_slices))):
+                for label, contours in areas:
+                    these_points = plane_points(contours).astype(np.float32)
+                    slices.append(sliceIndex)
+                    labels.append(label)
+                    lengths.append(len(these_points))
+                    points.append(these_points)
+                if progress is not None:
+                    progress(axis, (sliceIndex + 1) / float(n_slices))
+
+            arrays = {
+                "slices": np.array(slices, dtype=np.int32),
+                "labels": np.array(labels, dtype=atlas.dtype),
+                "offsets": np.append(0, np.cumsum(lengths, dtype=np.int64)),
+                "points": np.concatenate(points) if points else np.empty((0, 2), dtype=np.float32),
+            }
+            for name in SIDECAR_ARRAYS:
+                np.save(os.path.join(path, "axis%d_%s.npy" % (axis, name)), arrays[name])
+
+    # Written last, so an interrupted run leaves no usable sidecar
+    meta = {"shape": list(atlas.shape)}
+    meta.update(_atlas_file_signature(atlas_fname))
+    with open(os.path.join(path, SIDECAR_META_FILE_NAME), "w") as fid:
+        json.dump(meta, fid)
+    return path
+
+
+# ----------------------------------------------------------------------------
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: python -m lasagna.plugins.ara.contour_cache ATLAS_FILE [N_THREADS]")
+        sys.exit()
+
+    atlas_file = sys.argv[1]
+    n_threads = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+
+    def report(axis, done):
+        sys.stdout.write("\rAxis %d: %d%%" % (axis, 100 * done))
+        if done == 1:
+            sys.stdout.write("\n")
+        sys.stdout.flush()
+
+    sidecar_path = write_contour_sidecar(atlas_file, nThreads=n_threads, progress=report)
+    if sidecar_path:
+        print("Wrote contours to %s" % sidecar_path)
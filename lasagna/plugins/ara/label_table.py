@@ -0,0 +1,160 @@
+"""
+Lookup tables for the areas of an atlas.
+
+The area labels are loaded as a tree (see ARA_plotter.loadLabels), which is the right structure
+for building the area list but slow to query on every mouse move. A LabelTable is compiled from
+the tree once, when the atlas is loaded. It holds the name, acronym, colour and parent of every
+area in arrays indexed by row, a table from label id to row, a name to id dictionary and an index
+of the lower case names for prefix and substring searches.
+"""
+
+import bisect
+
+import numpy as np
+
+from lasagna.tree.array_tree import ArrayTree
+
+# Label ids up to this value are mapped to rows with an array rather than a dictionary
+DENSE_ID_LIMIT = 2 ** 22
+
+
+class LabelTable(object):
+    """
+    Compiled, read-only view of a labels tree
+    """
+
+    def __init__(self, labelsTree):
+        if isinstance(labelsTree, ArrayTree):
+            ids, parents, names, acronyms, colors = self._columnsFromArrayTree(labelsTree)
+        else:
+            ids, parents, names, acronyms, colors = self._columnsFromTree(labelsTree)
+
+        order = np.argsort(ids, kind='mergesort')
+        self.ids = np.array(ids, dtype=np.int64)[order]
+        self.parents = np.array(parents, dtype=np.int64)[order]
+        self.names = np.array(names, dtype=object)[order]
+        self.acronyms = np.array(acronyms, dtype=object)[order]
+        self.colors = np.array(colors, dtype=object)[order]
+
+        # Label id to row
+        self._rowOfId = None
+        self._rowDict = None
+        if len(self.ids) and 0 <= self.ids[0] and self.ids[-1] < DENSE_ID_LIMIT:
+            self._rowOfId = np.full(self.ids[-1] + 1, -1, dtype=np.int32)
+            self._rowOfId[self.ids] = np.arange(len(self.ids))
+        else:
+            self._rowDict = {label_id: row for row, label_id in enumerate(self.ids.tolist())}
+
+        # Name to id. If two areas share a name the first one in the tree wins, as with a tree walk.
+        self._idOfName = {}
+        for label_id, name in zip(ids, names):
+            self._idOfName.setdefault(name, label_id)
+
+        # Sorted lower case names for prefix searches, and all of them joined for substring searches
+        lower_names = [name.lower() for name in self.names]
+        self._sortedNames = sorted(zip(lower_names, self.ids.tolist()))
+        self._sortedNameKeys = [name for name, _ in self._sortedNames]
+        self._joinedNames = '\n'.join(lower_names) + '\n'
+        self._nameStarts = np.cumsum([0] + [len(name) + 1 for name in lower_names])
+
+    @staticmethod
+    def _columnsFromTree(labelsTree):
+        """
+        Gather the ids, parents, names, acronyms and colours of the nodes of a Tree
+        """
+        ids, parents, names, acronyms, colors = [], [], [], [], []
+        for node_id, node in labelsTree.nodes.items():
+            if not isinstance(node.data, dict):  # e.g. the tree's own root node
+                continue
+            ids.append(node_id)
+            parents.append(node.parent if node.parent is not None else 0)
+            names.append(str(node.data.get('name', '')))
+            acronyms.append(str(node.data.get('acronym', '')))
+            colors.append(str(node.data.get('color', '')))
+        return ids, parents, names, acronyms, colors
+
+    @staticmethod
+    def _columnsFromArrayTree(labelsTree):
+        """
+        Gather the ids, parents, names, acronyms and colours of the nodes of an ArrayTree straight
+        from its arrays
+        """
+        rows = np.flatnonzero(labelsTree.has_data)
+        parent_rows = labelsTree.parent_index[rows]
+        parents = np.where(parent_rows >= 0, labelsTree.ids[parent_rows], 0)
+
+        fields = labelsTree.data.dtype.names if labelsTree.data is not None else ()
+        columns = []
+        for name in ('name', 'acronym', 'color'):
+            if name in fields:
+                columns.append([str(value) for value in labelsTree.data[name][rows].tolist()])
+            else:
+                columns.append([''] * len(rows))
+        return [labelsTree.ids[rows].tolist(), parents.tolist()] + columns
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, labelId):
+        return self.row(labelId) >= 0
+
+    def row(self, labelId):
+        """
+        Return the row of label labelId in the arrays, or -1 if there is no such label
+        """
+        labelId = int(labelId)
+        if self._rowOfId is not None:
+            if 0 <= labelId < len(self._rowOfId):
+                return int(self._rowOfId[labelId])
+            return -1
+        return self._rowDict.get(labelId, -1)
+
+    def name(self, labelId):
+        """
+        Return the name of label labelId, or None if there is no such label
+        """
+        row = self.row(labelId)
+        return self.names[row] if row >= 0 else None
+
+    def acronym(self, labelId):
+        row = self.row(labelId)
+        return self.acronyms[row] if row >= 0 else None
+
+    def color(self, labelId):
+        row = self.row(labelId)
+        return self.colors[row] if row >= 0 else None
+
+    def parent(self, labelId):
+        row = self.row(labelId)
+        return int(self.parents[row]) if row >= 0 else None
+
+    def idOfName(self, name):
+        """
+        Return the label id of the area called name, or None if there is none
+        """
+        return self._idOfName.get(name)
+
+    def idsStartingWith(self, prefix):
+        """
+        Return the ids of the areas whose names start with prefix (ignoring case), ordered by name
+        """
+        prefix = prefix.lower()
+        first = bisect.bisect_left(self._sortedNameKeys, prefix)
+        last = bisect.bisect_left(self._sortedNameKeys, prefix + '\uffff')
+        return [label_id for _, label_id in self._sortedNames[first:last]]
+
+    def idsContaining(self, text):
+        """
+        Return the ids of the areas whose names contain text (ignoring case), in label id order
+        """
+        text = text.lower()
+        if not text or '\n' in text:
+            return []
+
+        rows = []
+        position = self._joinedNames.find(text)
+        while position >= 0:
+            row = int(np.searchsorted(self._nameStarts, position, side='right')) - 1
+            rows.append(row)
+            position = self._joinedNames.find(text, self._nameStarts[row + 1])  # Next name
+        return self.ids[rows].tolist()
@@ -13,6 +13,7 @@ from lasagna.io_libs import image_stack_loader
 from lasagna.plugins.ara import area_namer_UI
 # For contour drawing
 from lasagna.plugins.ara.ara_plugin_base import AraPluginBase
+from lasagna.plugins.ara.contour_cache import load_contour_sidecar
 from lasagna.utils import preferences
 
 
@@ -74,10 +75,11 @@ class plugin(AraPluginBase, area_namer_UI.Ui_area_namer):
         paths = self.paths[selected_name]
 
         # Load the labels (this associates brain area index values with brain area names)
-        self.data['labels'] = self.loadLabels(paths['labels'])
+        self.setLabels(self.loadLabels(paths['labels']))
 
         # Load the raw image data but do not display it.
         self.data['atlas'] = image_stack_loader.load_stack(paths['atlas'])
+        self.contourCache.useSidecar(self.data['atlas'], load_contour_sidecar(paths['atlas']))
 
         self.data['currentlyLoadedAtlasName'] = paths['atlas'].split(os.path.sep)[-1]
 
@@ -97,10 +99,11 @@ class plugin(AraPluginBase, area_namer_UI.Ui_area_namer):
         # re-load labels
         selected_name = str(self.araName_comboBox.itemText(self.araName_comboBox.currentIndex()))
         paths = self.paths[selected_name]
-        self.data['labels'] = self.loadLabels(paths['labels'])
+        self.setLabels(self.loadLabels(paths['labels']))
 
         # load the selected atlas (without displaying it)
         self.data['atlas'] = image_stack_loader.load_stack(fnameToLoad)
+        self.contourCache.useSidecar(self.data['atlas'], load_contour_sidecar(fnameToLoad))
 
         self.data['currentlyLoadedAtlasName'] = fnameToLoad.split(os.path.sep)[-1]
 
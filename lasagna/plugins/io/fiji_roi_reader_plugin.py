@@ -20,6 +20,8 @@ except ImportError:
 import numpy as np
 
 from lasagna.plugins.io.io_plugin_base import IoBasePlugin
+from lasagna.utils.point_series import split_series
+from lasagna.utils.profiler import profiled
 
 
 class loaderClass(IoBasePlugin):
@@ -31,6 +33,7 @@ class loaderClass(IoBasePlugin):
         super(loaderClass, self).__init__(lasagna_serving)
 
     # Slots follow
+    @profiled(category="loader")
     def showLoadDialog(self, fname=None):
         """
         This slot brings up the load dialog and retrieves the file name.
@@ -49,66 +52,54 @@ class loaderClass(IoBasePlugin):
             if fname.endswith('.zip'):
                 rois = ijroi.read_roi_zip(fname)
             else:
-                rois = []
-
-            # a list of strings with each string being one line from the file
-            as_list = contents.split('\n')
-            data = []
-            for i in range(len(as_list)):
-                if len(as_list[i]) == 0:
-                    continue
-                data.append([float(x) for x in as_list[i].split(',')])
-
-            # A point series should be a list of lists where each list has a length of 3,
-            # corresponding to the position of each point in 3D space. However, point
-            # series could also have a length of 4. If this is the case, the fourth
-            # value is the index of the series. This allows a single file to hold multiple
-            # different point series. We handle these two cases differently. First we deal
-            # with the the standard case:
-            if len(data[1]) == 3:
-                # Create an ingredient with the same name as the file name
-                objName = fname.split(os.path.sep)[-1]
-                self.lasagna.addIngredient(object_name=objName,
+                with open(fname, 'rb') as fid:
+                    rois = [(os.path.basename(fname), ijroi.read_roi(fid))]
+
+            data = self.roisToPoints(rois)
+            if not len(data):
+                print("No ROIs found in {}".format(fname))
+                return
+
+            # Each ROI is a point series. Files with a single ROI make a single ingredient named after
+            # the file, others one ingredient per ROI.
+            for idx, tmp in split_series(data[:, :3], data[:, 3]):
+                if len(rois) == 1:
+                    obj_name = fname.split(os.path.sep)[-1]
+                else:
+                    obj_name = "%s #%d" % (fname.split(os.path.sep)[-1], idx)
+                    print("Adding point series %d with %d points" % (idx, len(tmp)))
+
+                self.lasagna.addIngredient(objectName=obj_name,
                                            kind=self.kind,
-                                           data=np.asarray(data),
+                                           data=tmp,
                                            fname=fname
                                            )
 
                 # Add this ingredient to all three plots
                 self.lasagna.returnIngredientByName(obj_name).addToPlots()
 
-                # Update the plots
-                self.lasagna.initialiseAxes()
-            elif len(data[1]) == 4:
-                # What are the unique data series values?
-                d_series = [x[3] for x in data]
-                d_series = list(set(d_series))
-
-                # Loop through these unique series and add as separate sparse point objects
-
-                for idx in d_series:
-                    tmp = []
-                    for thisRow in data:
-                        if thisRow[3] == idx:
-                            tmp.append(thisRow[:3])
-
-                    print("Adding point series %d with %d points" % (idx, len(tmp)))
-
-                    # Create an ingredient with the same name as the file name
-                    obj_name = "%s #%d" % (fname.split(os.path.sep)[-1], idx)
-
-                    self.lasagna.addIngredient(object_name=objName,
-                                               kind=self.kind,
-                                               data=np.asarray(tmp),
-                                               fname=fname
-                                               )
-
-                    # Add this ingredient to all three plots
-                    self.lasagna.returnIngredientByName(obj_name).addToPlots()
-
-                    # Update the plots
-                    self.lasagna.initialiseAxes()
-            else:
-                print(("Point series has %d columns. Only 3 or 4 columns are supported" % len(data[1])))
+            # Update the plots
+            self.lasagna.initialiseAxes()
         else:
             self.lasagna.statusBar.showMessage("Unable to find " + str(fname))
+
+    @staticmethod
+    def roisToPoints(rois):
+        """
+        Make an n by 4 array of points (Z, X, Y and ROI number) from a list of (name, points) ROIs
+        as returned by ijroi. ijroi gives the points of a ROI as (Y, X) but not its slice, which is
+        read from the ROI name when it follows the ImageJ convention "slice-y-x" (slices counting
+        from 1). Otherwise Z is 0.
+        """
+        points = []
+        for n, (name, yx) in enumerate(rois):
+            yx = np.asarray(yx, dtype=float).reshape(-1, 2)
+            fields = os.path.splitext(name)[0].split('-')
+            z = float(fields[0]) - 1 if len(fields) == 3 and fields[0].isdigit() else 0
+            roi = np.empty((len(yx), 4))
+            roi[:, 0] = z
+            roi[:, 1] = yx[:, 1]
+            roi[:, 2] = yx[:, 0]
+            roi[:, 3] = n
+            points.append(roi)
+        return np.concatenate(points) if points else np.empty((0, 4))
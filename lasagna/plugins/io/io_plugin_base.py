@@ -7,6 +7,14 @@ class IoBasePlugin(LasagnaPlugin):
     def __init__(self, lasagna_serving):
         super(IoBasePlugin, self).__init__(lasagna_serving)
         self.lasagna = lasagna_serving
+        stand_in = getattr(self.lasagna, 'loadActions', {}).get(self.objectName)
+        if isinstance(stand_in, LazyIoPlugin):
+            # Take over the menu action of the stand-in that was made before the plugin was imported
+            self.loadAction = stand_in.loadAction
+            self.loadAction.triggered.disconnect()
+            self.loadAction.triggered.connect(lambda: self.showLoadDialog())
+            return
+
         # Construct the QActions and other stuff required to integrate the load dialog into the menu
         self.loadAction = QtWidgets.QAction(self.lasagna)  # Instantiate the menu action
 
@@ -38,4 +46,53 @@ class IoBasePlugin(LasagnaPlugin):
         self.lasagna.menuLoad_ingredient.addAction(self.loadAction)
         self.loadAction.setText(self.objectName.title().replace('_', ' ')[:-2])
 
-        self.loadAction.triggered.connect(self.showLoadDialog)  # Link the action to the slot
+        # Link the action to the slot. The lambda drops the checked flag of triggered: PyQt can not
+        # trim it itself for slots wrapped by decorators such as profiled.
+        self.loadAction.triggered.connect(lambda: self.showLoadDialog())
+
+
+class LazyIoPlugin(IoBasePlugin):
+    """
+    Stand-in for an IO plugin that has not been imported yet. It adds the plugin's menu action using
+    the attributes listed in the plugin manifest (see plugin_handler.plugin_manifest) and imports
+    the plugin the first time it is used. The plugin's loader then replaces the stand-in in
+    lasagna.loadActions and takes over the menu action.
+    """
+
+    def __init__(self, lasagna_serving, module_name, attributes):
+        self.module_name = module_name
+        self.objectName = attributes['objectName']
+        self.kind = attributes.get('kind')
+        self.icon_name = attributes['icon_name']
+        self.actionObjectName = attributes.get('actionObjectName')
+        self.loader = None
+        super(LazyIoPlugin, self).__init__(lasagna_serving)
+
+    def load_plugin(self):
+        """
+        Import the plugin and return its loader, or None if it can not be imported
+        """
+        if self.loader is None:
+            from lasagna.plugins import plugin_handler
+            loader_class, _ = plugin_handler.get_plugin_instance_from_file_name(
+                self.module_name + '.py', attribute_to_import='loaderClass')
+            if loader_class is None:
+                self.lasagna.statusBar.showMessage("Could not load plugin {}".format(self.module_name))
+                return None
+            self.loader = loader_class(self.lasagna)
+            self.lasagna.loadActions[self.objectName] = self.loader
+        return self.loader
+
+    # Slots follow
+    def showLoadDialog(self, fname=None):
+        """
+        Import the plugin and show its load dialog. fname is only passed on if given, as some
+        loaders take no arguments.
+        """
+        loader = self.load_plugin()
+        if loader is None:
+            return
+        if fname:
+            loader.showLoadDialog(fname)
+        else:
+            loader.showLoadDialog()
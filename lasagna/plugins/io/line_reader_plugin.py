@@ -9,6 +9,9 @@ lineseries_id,z_position,x_position,y_position\n
 
 No header. 
 
+Lines can also be read from lasagna's binary point cloud format (.npy files, see
+sparse_point_io.write_point_cloud), where the series numbers are the lineseries_id.
+
 The loader creates a list of lists, where all points within each list are linked. 
 All points bearing the same lineseries_id are grouped into the same list. 
 """
@@ -17,7 +20,10 @@ import os
 
 import numpy as np
 
+from lasagna.io_libs.sparse_point_io import read_lasagna_pts, read_point_cloud
 from lasagna.plugins.io.io_plugin_base import IoBasePlugin
+from lasagna.utils.point_series import join_series
+from lasagna.utils.profiler import profiled
 
 
 class loaderClass(IoBasePlugin):
@@ -29,6 +35,7 @@ class loaderClass(IoBasePlugin):
         super(loaderClass, self).__init__(lasagna_serving)
 
     # Slots follow
+    @profiled(category="loader")
     def showLoadDialog(self, fname=None):
         """
         This slot brings up the load dialog and retrieves the file name.
@@ -36,47 +43,34 @@ class loaderClass(IoBasePlugin):
         If the file name is valid, it loads the image stack using the load method.
         """
         if not fname:
-            fname = self.lasagna.showFileLoadDialog(fileFilter="Text Files (*.txt *.csv)")
+            fname = self.lasagna.showFileLoadDialog(fileFilter="Text Files (*.txt *.csv);; Point clouds (*.npy)")
     
         if not fname:
             return
 
         if os.path.isfile(fname): 
-            with open(str(fname), 'r') as fid:
-                contents = fid.read()
-
-            # a list of strings with each string being one line from the file
-            # add nans between lineseries
-            as_list = contents.split('\n')
-
-            data = []
-            last_line_series = None
-            n = 0
-            expected_cols = 4
-            for i in range(len(as_list)):
-                if not as_list[i]:
-                    continue
-
-                line_as_floats = [float(x) for x in as_list[i].split(',')]
-                if len(line_as_floats) != expected_cols:
+            if fname.endswith('.npy'):
+                coords, series, _ = read_point_cloud(fname)
+                if series is None:
+                    series = np.zeros(len(coords))
+            else:
+                try:
+                    contents = read_lasagna_pts(fname)
+                except ValueError:  # Rows of different lengths
+                    contents = np.empty((0, 0))
+                if contents.shape[1] != 4:
                     # Check that all rows have a length of 4, since this is what a line series needs
                     print("Lines data file {} appears corrupt".format(fname))
-                    return                     
-
-                if last_line_series is None:
-                    last_line_series = line_as_floats[0]
-
-                if last_line_series != line_as_floats[0]:
-                    n += 1
-                    data.append([np.nan, np.nan, np.nan])
+                    return
+                series, coords = contents[:, 0], contents[:, 1:]
 
-                last_line_series = line_as_floats[0]
-                data.append(line_as_floats[1:])
+            # add nans wherever the lineseries changes, keeping the points in file order
+            data = join_series(coords, series)
 
             obj_name = fname.split(os.path.sep)[-1]
             self.lasagna.addIngredient(objectName=obj_name,
                                        kind=self.kind,
-                                       data=np.asarray(data),
+                                       data=data,
                                        fname=fname,
                                        )
             self.lasagna.returnIngredientByName(obj_name).addToPlots()  # Add item to all three 2D plots
@@ -8,6 +8,7 @@ import tifffile
 
 from lasagna.plugins.io.io_plugin_base import IoBasePlugin
 from lasagna.utils import preferences
+from lasagna.utils.profiler import profiled
 
 
 class loaderClass(IoBasePlugin):
@@ -19,6 +20,7 @@ class loaderClass(IoBasePlugin):
         super(loaderClass, self).__init__(lasagna_serving)
 
     # Slots follow
+    @profiled(category="loader")
     def showLoadDialog(self):
         """
         This slot brings up the load dialog and retrieves the file name.
@@ -19,6 +19,9 @@ z_position,x_position,y_position,data_series_number\n
 z_position,x_position,y_position,data_series_number\n
 ...
 
+Points can also be read from lasagna's binary point cloud format (.npy files, see
+sparse_point_io.write_point_cloud), with or without series numbers.
+
 
 In the second format, each data point is associated with a scalar value.
 All points with the same scalar value are grouped together as one ingredient. 
@@ -29,15 +32,22 @@ image and have their properties changed together.
 """
 
 import os
-from PyQt5.QtWidgets import QDialog
+import time
+
+from PyQt5.QtWidgets import QApplication, QDialog
 import numpy as np
 
-from lasagna.io_libs.sparse_point_io import read_pts_file, read_masiv_roi, read_lasagna_pts, read_cell_xml
+from lasagna.io_libs.sparse_point_io import read_pts_file, read_masiv_roi, read_lasagna_pts, iter_cell_xml, \
+    read_point_cloud
 from lasagna.plugins.io.io_plugin_base import IoBasePlugin
 from lasagna.loader_dialog import LoaderDialog
+from lasagna.utils.point_series import split_series
+from lasagna.utils.profiler import profiled
 
 
 class loaderClass(IoBasePlugin):
+    REFRESH_INTERVAL = 0.5  # Seconds between showing the points read so far from a large file
+
     def __init__(self, lasagna_serving):
         self.objectName = 'sparse_point_reader'
         self.kind = 'sparsepoints'
@@ -46,6 +56,7 @@ class loaderClass(IoBasePlugin):
         super(loaderClass, self).__init__(lasagna_serving)
 
     # Slots follow
+    @profiled(category="loader")
     def showLoadDialog(self, fnames=None):
         """
         This slot brings up the load dialog and retrieves the file name.
@@ -53,11 +64,12 @@ class loaderClass(IoBasePlugin):
         If the file name is valid, it loads the image stack using the load method.
         """
 
+        res = dict(xy_scale=1, z_scale=1, first_slice=0, last_slice=-1)  # Load as is unless a dialog says otherwise
         if not fnames:
             # don't use the lasagna.showFileLoadDialog for now. First it clutters the list of recently loaded files with
             # sparse point and lasagna try then to read them as stacks and fails. Second, downsampling is implemented
             # for points only
-            load_dial = LoaderDialog(fileFilter="Text Files (*.txt *.csv *.pts *.yml, *.xml);; All Files (*.*)")
+            load_dial = LoaderDialog(fileFilter="Text Files (*.txt *.csv *.pts *.yml, *.xml);; Point clouds (*.npy);; All Files (*.*)")
             if load_dial.exec_() != QDialog.Accepted:
                 return
             res = load_dial.get_results()
@@ -65,89 +77,149 @@ class loaderClass(IoBasePlugin):
 
         if not fnames:
             return
+        if isinstance(fnames, str):
+            fnames = [fnames]
 
         for fname in fnames:
             if os.path.isfile(fname):
-                if fname.endswith('.pts'):
-                    data, roi_type = read_pts_file(fname)
-                    if roi_type == 'point':
-                        print('!!! WARNING points are set in real world coordinates. I assume a pixel size of 1')
-                elif fname.endswith('.yml'):
-                    data = read_masiv_roi(fname)
-                    # re-order in lasagna order Z X Y
-                    data = [[d[2], d[0], d[1], d[3]] for d in data]
-                elif fname.endswith('.xml'):
-                    data = read_cell_xml(fname)
-                else:
-                    data = read_lasagna_pts(fname)
-
-                # Downsample the data according to the what was entered in the dialog
-                rescaled_data = []
-                for d in data:
-                    if d[0] < res['first_slice']:
-                        continue
-                    if (res['last_slice'] != -1) and (d[1] > res['last_slice']):
-                        continue
-                    d[1] *= res['xy_scale']
-                    d[2] *= res['xy_scale']
-                    d[0] *= res['z_scale']
-                    rescaled_data.append(d)
-                data = rescaled_data
-                if not len(data):
+                # Downsample the data according to the what was entered in the dialog. Large files
+                # come in chunks. The points read so far are shown every REFRESH_INTERVAL seconds.
+                added = {}
+                pending = {}
+                last_refresh = time.time()
+                for coords, series in self.readChunks(fname):
+                    coords, series = self.rescale(coords, series, res)
+                    self.collectPoints(fname, coords, series, pending)
+                    if time.time() - last_refresh > self.REFRESH_INTERVAL:
+                        self.addPoints(fname, pending, added)
+                        last_refresh = time.time()
+                self.addPoints(fname, pending, added)
+                if not added:
                     print('No data in this file for this slice range')
-                    continue
-                # A point series should be a list of lists where each list has a length of 3,
-                # corresponding to the position of each point in 3D space. However, point
-                # series could also have a length of 4. If this is the case, the fourth
-                # value is the index of the series. This allows a single file to hold multiple
-                # different point series. We handle these two cases differently. First we deal
-                # with the the standard case:
-                if len(data[0]) == 3:
-                    # Create an ingredient with the same name as the file name
-
-                    obj_name = fname.split(os.path.sep)[-1]
-                    self.lasagna.addIngredient(objectName=obj_name,
-                                               kind=self.kind,
-                                               data=np.asarray(data),
-                                               fname=fname
-                                               )
-                    # Add this ingredient to all three plots
-                    self.lasagna.returnIngredientByName(obj_name).addToPlots()
-                    # Update the plots
-                    self.lasagna.initialiseAxes()
-
-                elif len(data[0]) == 4:
-                    # What are the unique data series values?
-                    d_series = [x[3] for x in data]
-                    d_series = list(set(d_series))
-
-                    # Loop through these unique series and add as separate sparse point objects
-
-                    for idx in d_series:
-                        tmp = []
-                        for row in data:
-                            if row[3] == idx:
-                                tmp.append(row[:3])
-
-                        print("Adding point series %d with %d points" % (idx, len(tmp)))
-
-                        # Create an ingredient with the same name as the file name
-                        obj_name = "%s #%d" % (fname.split(os.path.sep)[-1], idx)
-
-                        self.lasagna.addIngredient(objectName=obj_name,
-                                                   kind=self.kind,
-                                                   data=np.asarray(tmp),
-                                                   fname=fname
-                                                   )
-
-                        # Add this ingredient to all three plots
-                        self.lasagna.returnIngredientByName(obj_name).addToPlots()
-
-                        # Update the plots
-                        self.lasagna.initialiseAxes()
-
-                else:
-                    print(("Point series has %d columns. Only 3 or 4 columns are supported" % len(data[1])))
 
             else:
                 self.lasagna.statusBar.showMessage("Unable to find {}".format(fname))
+
+    @classmethod
+    def readChunks(cls, fname):
+        """
+        Yield the points in file fname as (coords, series) tuples: an array with one row per point,
+        in lasagna order Z X Y, and the series number of each point or None if the file has none.
+        Point clouds are yielded as the memory-mapped arrays read_point_cloud returns.
+        """
+        if fname.endswith('.pts'):
+            data, roi_type = read_pts_file(fname)
+            if roi_type == 'point':
+                print('!!! WARNING points are set in real world coordinates. I assume a pixel size of 1')
+            yield cls.splitSeriesColumn(data)
+        elif fname.endswith('.yml'):
+            data = np.asarray(read_masiv_roi(fname), dtype=float)
+            # re-order in lasagna order Z X Y
+            if len(data):
+                data = data[:, [2, 0, 1, 3]]
+            yield cls.splitSeriesColumn(data)
+        elif fname.endswith('.xml'):
+            for data in iter_cell_xml(fname):
+                yield cls.splitSeriesColumn(data)
+        elif fname.endswith('.npy'):
+            coords, series, _ = read_point_cloud(fname)
+            yield coords, series
+        else:
+            yield cls.splitSeriesColumn(read_lasagna_pts(fname))
+
+    @staticmethod
+    def splitSeriesColumn(data):
+        """
+        Return the coordinates and the series numbers (or None) of an n by 3 or 4 array of points.
+        A point series should be an n by 3 array where each row is the position of
+        a point in 3D space. However, point series could also have 4 columns. If this
+        is the case, the fourth value is the index of the series. This allows a single
+        file to hold multiple different point series.
+        """
+        if data.ndim == 2 and data.shape[1] == 4:
+            return data[:, :3], data[:, 3]
+        return data, None
+
+    @staticmethod
+    def collectPoints(fname, coords, series, pending):
+        """
+        Sort the points in coords (an n by 3 array) read from fname into their series (n series
+        numbers, or None if all points belong to one series). The points of each series are
+        appended to its list in pending, a dictionary keyed by ingredient name.
+        """
+        if not len(coords):
+            return
+        if coords.shape[1] != 3:
+            print(("Point series has %d columns. Only 3 or 4 columns are supported" % coords.shape[1]))
+            return
+
+        if series is None:
+            # Create an ingredient with the same name as the file name
+            pending.setdefault(fname.split(os.path.sep)[-1], []).append(coords)
+        else:
+            # Loop through the unique data series values and add each as a separate sparse point object
+            for idx, tmp in split_series(coords, series):
+                # Create an ingredient with the same name as the file name
+                pending.setdefault("%s #%d" % (fname.split(os.path.sep)[-1], idx), []).append(tmp)
+
+    def addPoints(self, fname, pending, added):
+        """
+        Add the points collected in pending (see collectPoints) to lasagna and empty it. Points of a
+        series already in added (a dictionary of ingredients keyed by name) are appended to its
+        ingredient, others make a new ingredient which is put in added. Each ingredient's data are
+        replaced once, however many chunks were collected for it.
+        """
+        if not pending:
+            return
+
+        for obj_name, chunks in pending.items():
+            if obj_name in added:
+                added[obj_name]._data = np.concatenate([added[obj_name].raw_data()] + chunks)
+                continue
+            print("Adding point series %s" % obj_name)
+            self.lasagna.addIngredient(objectName=obj_name,
+                                       kind=self.kind,
+                                       data=chunks[0] if len(chunks) == 1 else np.concatenate(chunks),
+                                       fname=fname
+                                       )
+            # Add this ingredient to all three plots
+            added[obj_name] = self.lasagna.returnIngredientByName(obj_name)
+            added[obj_name].addToPlots()
+        pending.clear()
+
+        # Update the plots
+        self.lasagna.initialiseAxes()
+        QApplication.processEvents()
+
+    @staticmethod
+    def rescale(coords, series, res):
+        """
+        Keep the points (rows of coords, in Z X Y order) between res['first_slice'] and res['last_slice']
+        and scale their coordinates by res['z_scale'] and res['xy_scale']. Returns the coordinates and
+        series numbers of the points kept. If there is nothing to do coords and series are returned as
+        they are, so memory-mapped point clouds are not read. Otherwise only the points kept are copied.
+        """
+        coords = np.asanyarray(coords)
+        if not coords.size:
+            return np.empty((0, 3)), None
+        if coords.ndim != 2:
+            coords = coords.reshape(1, -1)
+
+        keep = None
+        if res['first_slice'] > 0:
+            keep = coords[:, 0] >= res['first_slice']
+        if res['last_slice'] != -1:
+            below_last = coords[:, 0] <= res['last_slice']
+            keep = below_last if keep is None else keep & below_last
+        if keep is None and res['xy_scale'] == 1 and res['z_scale'] == 1:
+            return coords, series
+
+        if keep is None:
+            coords = np.array(coords, dtype=float)
+        else:
+            coords = coords[keep].astype(float, copy=False)
+            if series is not None:
+                series = np.asarray(series)[keep]
+        coords[:, 1:3] *= res['xy_scale']
+        coords[:, 0] *= res['z_scale']
+        return coords, series
@@ -19,6 +19,7 @@ import numpy as np
 
 from lasagna.plugins.io.io_plugin_base import IoBasePlugin
 from lasagna.tree import tree_parser
+from lasagna.utils.profiler import profiled
 
 
 class loaderClass(IoBasePlugin):
@@ -31,22 +32,13 @@ class loaderClass(IoBasePlugin):
 
     def dataFromPath(self, tree, path):
         """
-        Get the data from the tree given a path.
+        Get the data from the tree given a path, as an n by 3 array of z, x, y
         """
-
-        z = []
-        x = []
-        y = []
-
-        for node in path:
-            if node == 0:
-                continue
-            z.append(tree.nodes[node].data['z'])
-            x.append(tree.nodes[node].data['x'])
-            y.append(tree.nodes[node].data['y'])
-        return z, x, y
+        rows = tree.rows([node for node in path if node != 0])
+        return np.column_stack([tree.data[axis][rows] for axis in ('z', 'x', 'y')]).astype(float)
 
     # Slots follow
+    @profiled(category="loader")
     def showLoadDialog(self, fname=None):
         """
         This slot brings up the load dialog and retrieves the file name.
@@ -69,51 +61,29 @@ class loaderClass(IoBasePlugin):
                 if verbose:
                     print("tree_reader_plugin.showLoadDialog - importing %s" % fname)
 
-                data_tree = tree_parser.parse_file(fname, header_line=['id', 'parent', 'z', 'x', 'y'], verbose=verbose)
+                data_tree = tree_parser.parse_file(fname, header_line=['id', 'parent', 'z', 'x', 'y'], verbose=verbose,
+                                                   compact=True)
                 if not data_tree:
                     print("No data loaded from %s" % fname)
                     return
 
                 # We now have an array of unique paths (segments)
-                paths = []
-                for thisSegment in data_tree.find_segments():
-                    paths.append(thisSegment)
-
-                as_list = []  # list of list data (one item per node)
-                for i, thisPath in enumerate(paths):
-                    data = self.dataFromPath(data_tree, thisPath)
-                    for j in range(len(data[0])):
-                        tmp = [i, data[0][j], data[1][j], data[2][j]]
-                        tmp = [float(x) for x in tmp]
-                        as_list.append(tmp)
+                segments = [self.dataFromPath(data_tree, thisPath) for thisPath in data_tree.find_segments()]
+                segments = [segment for segment in segments if len(segment)]
 
             # add nans between lineseries
-            data = []
-            last_line_series = None
-            n = 0
-            for i in range(len(as_list)):
-                if len(as_list[i]) == 0:
-                    continue
-
-                line = as_list[i]
-                if last_line_series is None:
-                    last_line_series = line[0]
-
-                if last_line_series != line[0]:
-                    n += 1
-                    data.append([np.nan, np.nan, np.nan])
-
-                last_line_series = line[0]
-                data.append(line[1:])
+            nan_row = np.full((1, 3), np.nan)
+            data = [piece for segment in segments for piece in (nan_row, segment)][1:]
+            data = np.concatenate(data) if data else np.empty((0, 3))
 
             if verbose:
-                print("Divided tree into %d segments" % n)
+                print("Divided tree into %d segments" % len(segments))
 
             # print data
             obj_name = fname.split(os.path.sep)[-1]
             self.lasagna.addIngredient(objectName=obj_name,
                                        kind=self.kind,
-                                       data=np.asarray(data),
+                                       data=data,
                                        fname=fname,
                                        )
 
@@ -56,3 +56,122 @@ def get_plugin_instance_from_file_name(file_name, attribute_to_import='plugin'):
         returned_attribute = imported_module
 
     return returned_attribute, module_name  # return the plugin object and optionally the module name
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Plugin manifest
+# Building the menus does not need the plugin modules themselves, only their names and, for IO
+# plugins, a few attributes set in the loader's constructor. These are read from the source
+# without importing it (which would pull in the plugin's dependencies) and cached in a manifest
+# file, so unchanged plugins are not even parsed on the next start.
+
+MANIFEST_VERSION = 1
+
+
+def get_plugin_manifest_file():
+    from lasagna.utils.pref_utils import get_lasagna_pref_dir
+    return get_lasagna_pref_dir() + 'plugin_manifest.json'
+
+
+def plugin_manifest(plugin_paths, manifest_file=None):
+    """
+    Return a list with one dictionary per plugin found in the directory list "pluginPaths" (see
+    find_plugins) holding:
+    file_name - the plugin file name (e.g. myPlugin_plugin.py)
+    module_name - the name to import it by
+    directory - the name of the directory it is in
+    attributes - the constant attributes assigned in the constructor of its loaderClass or plugin
+                 class (e.g. {'objectName': 'tree_reader'}), and under 'hooks' the names of its
+                 hook methods
+    Entries of files whose modification time and size have not changed are taken from the manifest
+    file, which is updated if anything changed.
+    """
+    import json
+
+    if manifest_file is None:
+        manifest_file = get_plugin_manifest_file()
+    try:
+        with open(manifest_file) as fid:
+            cached = json.load(fid)
+        if cached.get('version') != MANIFEST_VERSION:
+            cached = {}
+    except (IOError, OSError, ValueError):
+        cached = {}
+    cached_entries = cached.get('plugins', {})
+
+    plugin_files, _ = find_plugins(plugin_paths)
+    entries = {}
+    for plugin_folder in plugin_paths:
+        if not os.path.isdir(plugin_folder):
+            continue
+        plugin_folder = plugin_folder.rstrip(os.sep)
+        for file_name in sorted(os.listdir(plugin_folder)):
+            if file_name not in plugin_files or not is_plugin_file(plugin_folder, file_name):
+                continue
+            path = os.path.abspath(os.path.join(plugin_folder, file_name))
+            stat = os.stat(path)
+            stamp = [stat.st_mtime_ns, stat.st_size]
+            entry = cached_entries.get(path)
+            if entry is None or entry['stamp'] != stamp:
+                entry = dict(file_name=file_name,
+                             module_name=os.path.splitext(file_name)[0],
+                             directory=plugin_folder.split(os.path.sep)[-1],
+                             stamp=stamp,
+                             attributes=plugin_attributes(path))
+            entries[path] = entry
+
+    if entries != cached_entries:
+        try:
+            tmp_file = manifest_file + '.tmp'
+            with open(tmp_file, 'w') as fid:
+                json.dump(dict(version=MANIFEST_VERSION, plugins=entries), fid, indent=1)
+            os.replace(tmp_file, manifest_file)
+        except (IOError, OSError) as err:
+            print("Could not write plugin manifest {}: {}".format(manifest_file, err))
+
+    # Keep the order of find_plugins
+    by_file = {}
+    for entry in entries.values():
+        by_file.setdefault(entry['file_name'], entry)
+    return [by_file[file_name] for file_name in plugin_files if file_name in by_file]
+
+
+def plugin_attributes(path):
+    """
+    Read the constant attributes (self.x = <literal>) assigned in the __init__ method of the
+    loaderClass or plugin class of the plugin file at path, and the names of the class's methods
+    starting with hook_, without importing the file. Returns a dictionary, which is empty if the
+    file could not be parsed.
+    """
+    import ast
+
+    try:
+        with open(path, 'rb') as fid:
+            tree = ast.parse(fid.read(), filename=path)
+    except (IOError, OSError, SyntaxError, ValueError) as err:
+        print("Could not read plugin {}: {}".format(path, err))
+        return {}
+
+    attributes = {}
+    for node in tree.body:
+        if not isinstance(node, ast.ClassDef) or node.name not in ('loaderClass', 'plugin'):
+            continue
+        methods = [item for item in node.body if isinstance(item, ast.FunctionDef)]
+        attributes['hooks'] = [method.name for method in methods if method.name.startswith('hook_')]
+        for method in methods:
+            if method.name != '__init__':
+                continue
+            for statement in method.body:
+                if not isinstance(statement, ast.Assign) or len(statement.targets) != 1:
+                    continue
+                target = statement.targets[0]
+                if not (isinstance(target, ast.Attribute) and isinstance(target.value, ast.Name)
+                        and target.value.id == 'self'):
+                    continue
+                try:
+                    value = ast.literal_eval(statement.value)
+                except (ValueError, TypeError, SyntaxError):
+                    continue
+                if isinstance(value, (str, int, float, bool)):
+                    attributes[target.attr] = value
+    return attributes
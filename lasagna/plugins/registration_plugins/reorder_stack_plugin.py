@@ -1,6 +1,7 @@
 """
 A simple plugin just to change the order of the slices
 """
+import numpy as np
 from PyQt5 import QtWidgets
 
 from lasagna.plugins.lasagna_plugin import LasagnaPlugin
@@ -113,9 +114,10 @@ class plugin(LasagnaPlugin, QtWidgets.QWidget, reorder_stack_UI.Ui_reorderStack)
 
         order = [self.listWidget.item(i) for i in range(self.listWidget.count())]
         order = [int(l.text().split(' ')[1]) for l in order]
+        moved = np.flatnonzero(np.array(order) != np.arange(len(order)))
         for stck_name in values:
             stk = self.lasagna.returnIngredientByName(str(stck_name))
-            stk._data = stk._data[order, :, :]
+            stk.changeData(stk._data[order, :, :], stk.fnameAbsPath, changedSlices=moved)
         self.initialise()
 
     # The following methods are involved in shutting down the plugin window
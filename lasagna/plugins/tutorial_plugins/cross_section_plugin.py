@@ -63,11 +63,14 @@ class plugin(
         if not image_item:
             return
 
-        # Extract data from base image
-        if image_item is not None:
-            if image_item.image.shape[1] <= y or y < 0:
+        # Extract data from the base stack. The plotted image may be cropped or downsampled, so it is not used.
+        axes = [axis for axis in self.lasagna.axes2D if axis.view is plot_widget]
+        stack = self.lasagna.returnIngredientByName(image_item.objectName)
+        if axes and stack and axes[0].currentSlice is not None:
+            data = stack.data(axes[0].axisToPlot)
+            if data.shape[2] <= y or y < 0 or data.shape[0] <= axes[0].currentSlice:
                 return
-            x_data = image_item.image[:, y]
+            x_data = data[axes[0].currentSlice, :, y]
 
             self.graphicsView.clear()
             self.graphicsView.plot(x_data)
@@ -0,0 +1,112 @@
+"""
+Redraws the axes at most once per display frame.
+
+Dragging a slider or the mouse sends many events per frame, and each used to redraw every
+ingredient on all three axes straight away. Instead, slots ask the RedrawScheduler to redraw the
+ingredients they changed in the axes they affect. These (axis, ingredient) pairs are marked dirty
+and a single-shot QTimer draws them all in one go when the frame is due. Requests arriving in the
+meantime are merged into the same redraw, and ingredients that did not change are not re-plotted.
+"""
+
+from PyQt5 import QtCore, QtWidgets
+
+from lasagna.utils.profiler import profiled
+
+DEFAULT_REFRESH_RATE = 60  # Hz, used if the screen does not report its refresh rate
+
+
+class RedrawScheduler(QtCore.QObject):
+    """
+    Collects redraw requests for the axes of lasagna_serving and draws them once per frame
+    frameInterval - minimum time between redraws in ms. By default one frame of the primary screen.
+    """
+
+    def __init__(self, lasagna_serving, frameInterval=None):
+        super(RedrawScheduler, self).__init__()
+        self.lasagna = lasagna_serving
+        self._dirty = {}  # axis index: set of ingredient names to redraw, or None for all of them
+        self._previousSlices = {}  # axis index: slice shown before the pending slice changes
+
+        if frameInterval is None:
+            screen = QtWidgets.QApplication.primaryScreen()
+            refresh_rate = screen.refreshRate() if screen is not None else 0
+            frameInterval = 1000.0 / (refresh_rate if refresh_rate > 0 else DEFAULT_REFRESH_RATE)
+
+        self._timer = QtCore.QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setTimerType(QtCore.Qt.PreciseTimer)
+        self._timer.setInterval(int(round(frameInterval)))
+        self._timer.timeout.connect(self.flush)
+
+    def requestRedraw(self, ingredients=None, axes=None):
+        """
+        Redraw ingredients (names or ingredient instances, all of them if None) in axes (indices
+        into lasagna.axes2D, all of them if None) at the next frame
+        """
+        if axes is None:
+            axes = range(len(self.lasagna.axes2D))
+        if ingredients is not None:
+            if isinstance(ingredients, str) or not isinstance(ingredients, (list, tuple, set)):
+                ingredients = [ingredients]
+            names = {getattr(ingredient, 'objectName', ingredient) for ingredient in ingredients}
+
+        for axis in axes:
+            if ingredients is None or self._dirty.get(axis, set()) is None:
+                self._dirty[axis] = None
+            else:
+                self._dirty.setdefault(axis, set()).update(names)
+        self._start()
+
+    def requestSlice(self, axis, sliceToPlot):
+        """
+        Show slice sliceToPlot in the axis with index axis at the next frame. The axis' currentSlice
+        changes straight away, so that code running before the redraw (e.g. plugin hooks) sees the
+        slice that is about to be shown.
+        """
+        projection = self.lasagna.axes2D[axis]
+        if axis not in self._previousSlices:
+            self._previousSlices[axis] = projection.currentSlice
+        projection.currentSlice = sliceToPlot
+        self._dirty[axis] = None  # Every ingredient changes with the slice
+        self._start()
+
+    def isPending(self):
+        return bool(self._dirty)
+
+    def cancel(self):
+        """
+        Forget the pending redraws, e.g. because all axes are being redrawn anyway
+        """
+        self._timer.stop()
+        self._dirty = {}
+        self._previousSlices = {}
+
+    @profiled(category="redraw")
+    def flush(self):
+        """
+        Redraw the dirty ingredients now
+        """
+        self._timer.stop()
+        dirty, self._dirty = self._dirty, {}
+        previous_slices, self._previousSlices = self._previousSlices, {}
+
+        for axis_index, names in sorted(dirty.items()):
+            axis = self.lasagna.axes2D[axis_index]
+            if axis.currentSlice is None:
+                continue  # Nothing shown in this axis yet: initialiseAxes will draw it
+
+            if names is None:
+                ingredients = self.lasagna.ingredientList
+            else:
+                ingredients = [ingredient for ingredient in self.lasagna.ingredientList
+                               if ingredient.objectName in names]
+            if not ingredients:
+                continue
+
+            axis.updatePlotItems_2D(ingredients,
+                                    sliceToPlot=axis.currentSlice,
+                                    previousSlice=previous_slices.get(axis_index))
+
+    def _start(self):
+        if not self._timer.isActive():
+            self._timer.start()
@@ -0,0 +1,105 @@
+"""
+Reads image stack slices in worker threads ahead of the user scrolling to them.
+
+Each projection2D axis tells the prefetcher which slices it is likely to show next (the next few
+slices in the direction it is moving through the stack). These are read into a cache with a
+fixed memory budget, so that when the axis gets there plotting the slice is only a cache lookup.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from lasagna.io_libs.chunked_volume import ChunkCache
+
+
+class SlicePrefetcher(object):
+    """
+    Bounded cache of slice images filled by a pool of worker threads.
+    Slices are identified by hashable keys (see imagestack.planeRequest) and read by
+    argument-less functions that return an ndarray.
+    """
+
+    def __init__(self, maxBytes, nThreads=2):
+        self.cache = ChunkCache(maxBytes)
+        self._executor = ThreadPoolExecutor(max_workers=nThreads)
+        self._pending = {}  # key: future of slices that are queued or being read
+        self._owners = {}  # owner: keys last requested by that owner
+        # Workers' done callbacks remove finished reads from _pending. Reentrant because cancelling a
+        # future runs its callbacks straight away in the cancelling thread.
+        self._lock = threading.RLock()
+
+    def get(self, key, read):
+        """
+        Return the slice for key. It comes from the cache if it was prefetched, from its worker
+        if it is still being read, or is read by calling read() now if it was never requested.
+        """
+        image = self.cache.get(key)
+        if image is not None:
+            return image
+
+        with self._lock:
+            future = self._pending.get(key)
+        if future is not None and not future.cancel():
+            try:
+                return future.result()
+            except Exception as err:  # The worker failed, so try again here
+                print("Prefetching slice %s failed (%s). Reading it now" % (str(key), err))
+
+        image = read()
+        self.cache.put(key, image)
+        return image
+
+    def prefetch(self, owner, jobs):
+        """
+        Queue reads of the slices in jobs, a list of (key, read) tuples, on behalf of owner
+        (e.g. a projection2D axis). Queued reads that owner asked for earlier but no longer wants
+        are cancelled, so changing scroll direction does not leave the workers on stale slices.
+        """
+        wanted = [key for key, _ in jobs]
+        with self._lock:
+            for key in self._owners.get(owner, []):
+                future = self._pending.get(key)
+                if key not in wanted and future is not None:
+                    future.cancel()
+            self._owners[owner] = wanted
+
+            for key, read in jobs:
+                if key in self._pending or self.cache.get(key) is not None:
+                    continue
+                future = self._executor.submit(self._read, key, read)
+                self._pending[key] = future
+                future.add_done_callback(lambda f, key=key: self._forget(key, f))
+
+    def _read(self, key, read):
+        """
+        Runs in a worker thread
+        """
+        image = read()
+        self.cache.put(key, image)
+        return image
+
+    def _forget(self, key, future):
+        """
+        Stop tracking a read once it has finished or was cancelled
+        """
+        with self._lock:
+            if self._pending.get(key) is future:
+                del self._pending[key]
+
+    def clear(self):
+        """
+        Cancel all queued reads and empty the cache
+        """
+        with self._lock:
+            for future in list(self._pending.values()):
+                future.cancel()
+            self._pending.clear()
+            self._owners.clear()
+        self.cache.clear()
+
+    def shutdown(self):
+        """
+        Cancel all queued reads and stop the worker threads
+        """
+        self.clear()
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,95 @@
+"""
+Loads image stacks in a worker thread so the GUI stays responsive.
+
+A StackLoadWorker reads the stack, its voxel spacing, its histogram and its default display range
+(estimated from a sample for stacks that are memory-mapped or chunked rather than read in full),
+reporting progress as it goes. Lasagna runs these on the global QThreadPool, so several stacks can
+load at once, and only adds a stack to the axes once its worker has finished.
+"""
+
+from PyQt5 import QtCore
+
+from lasagna.image_processing.histogram import CountCancelled, StackHistogram, isDiskBacked
+from lasagna.io_libs import image_stack_loader
+from lasagna.utils import preferences
+from lasagna.utils.profiler import profiled
+
+
+class StackLoadSignals(QtCore.QObject):
+    """
+    The signals of a StackLoadWorker (QRunnable is not a QObject so can not have its own)
+    """
+
+    progress = QtCore.pyqtSignal(str, str, int)  # file name, what is being done, percent done
+    finished = QtCore.pyqtSignal(str, object)  # file name, dict of results
+    failed = QtCore.pyqtSignal(str, str)  # file name, reason
+
+
+class StackLoadWorker(QtCore.QRunnable):
+    """
+    Loads the image stack fname. On success "finished" is emitted with a dict holding the
+    data, the axis ratios, the histogram and the display range (minMax). If the load fails or
+    is cancelled "failed" is emitted instead.
+    Cancelling takes effect between steps and between the slabs of the histogram count: a file
+    read that has started runs to completion.
+    """
+
+    def __init__(self, fname):
+        super(StackLoadWorker, self).__init__()
+        self.fname = fname
+        self.signals = StackLoadSignals()
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        try:
+            result = self.load()
+        except Exception as err:
+            self.signals.failed.emit(self.fname, "{}: {}".format(type(err).__name__, err))
+            return
+
+        if result is None:
+            self.signals.failed.emit(self.fname, "cancelled" if self.cancelled else "could not read file")
+        else:
+            self.signals.finished.emit(self.fname, result)
+
+    def histogramProgress(self, done):
+        """
+        Report the progress of the histogram count and stop it if the load was cancelled
+        """
+        if self.cancelled:
+            raise CountCancelled()
+        self.signals.progress.emit(self.fname, "calculating histogram", 50 + int(45 * done))
+
+    @profiled(category="loader")
+    def load(self):
+        """
+        Do the work. Returns None if the load was cancelled or no data were read.
+        """
+        self.signals.progress.emit(self.fname, "reading", 0)
+        data = image_stack_loader.load_stack(self.fname)
+        if self.cancelled or data is None or data is False:
+            return None
+
+        self.signals.progress.emit(self.fname, "calculating histogram", 50)
+        try:
+            histogram = StackHistogram(
+                data,
+                nThreads=preferences.readPreference("histogramThreads"),
+                sample=isDiskBacked(data),
+                progress=self.histogramProgress,
+            )
+        except CountCancelled:
+            return None
+        if self.cancelled:
+            return None
+
+        self.signals.progress.emit(self.fname, "done", 100)
+        return {
+            "data": data,
+            "axisRatios": image_stack_loader.get_voxel_spacing(self.fname),
+            "histogram": histogram,
+            "minMax": [0, histogram.defaultRange()],
+        }
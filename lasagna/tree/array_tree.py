@@ -0,0 +1,307 @@
+"""
+A compact, read-only tree held in arrays.
+
+Tree stores one Node object per node in a dictionary, which is convenient for building a tree
+one node at a time but uses a lot of memory and is slow to walk for traced neurons with hundreds
+of thousands of nodes. ArrayTree holds the same information in arrays: the index of each node's
+parent, the children of every node as one list of indices with offsets (compressed sparse rows),
+and the node data as a structured array with one field per data column. It is built in one go
+from those columns (see tree_parser.parse_file) and answers the same queries as Tree: indexing by
+node id returns an object with identifier, parent, children and data attributes, and traverse,
+is_leaf, find_leaves, find_branches, find_segments and path_to_root behave as they do for Tree.
+All of them run in time linear in the number of nodes visited.
+"""
+
+from collections import deque
+from collections.abc import Mapping
+
+import numpy as np
+
+from lasagna.tree.tree import _ROOT, _DEPTH, _WIDTH
+
+
+class ArrayTree(object):
+    """
+    Tree built from a list of node ids and the id of each node's parent (None for the root)
+    data - optional structured array with one row per node holding the node data
+    has_data - optional boolean array saying which rows of data are real. The data of the other
+               nodes are None, as with a node added to a Tree without data.
+    """
+
+    def __init__(self, ids, parents, data=None, has_data=None):
+        n_nodes = len(ids)
+        self.ids = np.asarray(ids)
+        self._id_list = list(ids)
+
+        # Node ids to row indices. Integer ids use a sorted array, anything else a dictionary.
+        if n_nodes and self.ids.dtype.kind in 'iu':
+            self._sorter = np.argsort(self.ids, kind='mergesort')
+            self._sorted_ids = self.ids[self._sorter]
+            self._row_dict = None
+        else:
+            self._row_dict = {node_id: row for row, node_id in enumerate(self._id_list)}
+
+        is_root = np.fromiter((parent is None for parent in parents), dtype=bool, count=n_nodes)
+        self.parent_index = np.full(n_nodes, -1, dtype=np.int64)
+        self.parent_index[~is_root] = self.rows([parent for parent in parents if parent is not None])
+
+        # Children in compressed sparse row form. A stable sort keeps them in the order they were listed.
+        has_parent = self.parent_index >= 0
+        self.n_children = np.bincount(self.parent_index[has_parent], minlength=n_nodes)
+        self.child_start = np.concatenate(([0], np.cumsum(self.n_children)))
+        self.child_index = np.flatnonzero(has_parent)[np.argsort(self.parent_index[has_parent], kind='mergesort')]
+
+        self.data = data
+        self.has_data = np.ones(n_nodes, dtype=bool) if has_data is None else np.asarray(has_data, dtype=bool)
+        self.__nodes = ArrayTreeNodes(self)
+
+    @property
+    def nodes(self):
+        return self.__nodes
+
+    def __len__(self):
+        return len(self._id_list)
+
+    def __getitem__(self, key):
+        return ArrayNode(self, self._row(key))
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    # Indexing helpers
+    def _row(self, identifier):
+        """
+        Return the row of node identifier. Raises KeyError if there is no such node.
+        """
+        if self._row_dict is not None:
+            return self._row_dict[identifier]
+
+        position = np.searchsorted(self._sorted_ids, identifier)
+        if position == len(self._sorted_ids) or self._sorted_ids[position] != identifier:
+            raise KeyError(identifier)
+        return int(self._sorter[position])
+
+    def rows(self, identifiers):
+        """
+        Return the rows of a list of nodes as an array. Raises KeyError if any is missing.
+        """
+        if self._row_dict is not None:
+            return np.array([self._row_dict[identifier] for identifier in identifiers], dtype=np.int64)
+
+        identifiers = np.asarray(identifiers, dtype=self._sorted_ids.dtype)
+        positions = np.minimum(np.searchsorted(self._sorted_ids, identifiers), len(self._sorted_ids) - 1)
+        missing = self._sorted_ids[positions] != identifiers
+        if missing.any():
+            raise KeyError(identifiers[missing][0])
+        return self._sorter[positions]
+
+    def _has_row(self, identifier):
+        try:
+            self._row(identifier)
+        except (KeyError, TypeError, ValueError):
+            return False
+        return True
+
+    def _children_rows(self, row):
+        return self.child_index[self.child_start[row]:self.child_start[row + 1]]
+
+    def _ids_of(self, rows):
+        return [self._id_list[row] for row in rows]
+
+    def node_data(self, row):
+        """
+        Return the data of the node in row as a dictionary, or None if it has none
+        """
+        if self.data is None or not self.has_data[row]:
+            return None
+        record = self.data[row]
+        return {name: record[name].item() if hasattr(record[name], 'item') else record[name]
+                for name in self.data.dtype.names}
+
+    def traverse_rows(self, identifier, mode=_DEPTH):
+        """
+        Return the rows of the nodes under identifier (included) in depth first or width first order
+        """
+        # Python lists are much faster than arrays to index one element at a time
+        child_start, child_index = self.child_start.tolist(), self.child_index.tolist()
+        order = []
+        if mode == _DEPTH:
+            stack = [self._row(identifier)]
+            while stack:
+                row = stack.pop()
+                order.append(row)
+                stack.extend(reversed(child_index[child_start[row]:child_start[row + 1]]))
+        elif mode == _WIDTH:
+            queue = deque([self._row(identifier)])
+            while queue:
+                row = queue.popleft()
+                order.append(row)
+                queue.extend(child_index[child_start[row]:child_start[row + 1]])
+        return np.array(order, dtype=np.int64)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    # The Tree API
+    def display(self, identifier, depth=_ROOT):
+        """
+        Very (very) simple tree display
+        """
+        stack = [(self._row(identifier), depth)]
+        while stack:
+            row, depth = stack.pop()
+            if depth == _ROOT:
+                print(("{0}".format(self._id_list[row])))
+            else:
+                print(("    "*depth, "{0}".format(self._id_list[row])))
+            stack.extend((child, depth + 1) for child in self._children_rows(row)[::-1].tolist())
+
+    def traverse(self, identifier, mode=_DEPTH):
+        """
+        traverse the tree in depth first or width first modes
+        using a yield-based generator
+        """
+        for row in self.traverse_rows(identifier, mode):
+            yield self._id_list[row]
+
+    def is_leaf(self, identifier):
+        """
+        Is the node indexed by 'identifier' a leaf?
+        returns True or False
+        """
+        return bool(self.n_children[self._row(identifier)] == 0)
+
+    def find_leaves(self, from_node=0):
+        """
+        Returns a list of nodes that are leaves, searching from
+        the node "fromNode". To find all leaves, fromNode should
+        be the root node.
+        """
+        rows = self.traverse_rows(from_node)
+        return self._ids_of(rows[self.n_children[rows] == 0])
+
+    def find_branches(self, from_node=0):
+        """
+        Returns a list of the branch nodes (nodes with more than one child)
+        under the node "fromNode". To find all branches, fromNode should be the root node.
+        """
+        rows = self.traverse_rows(from_node)
+        return self._ids_of(rows[self.n_children[rows] > 1])
+
+    def find_segments(self, link_segments=1, node_ids=0):
+        """
+        Return a tuple containing all unique segments of the tree, in the order Tree.find_segments
+        returns them.
+
+        If linkSegments is 1, then the branch node is added to each returned segement. This makes
+        it possible to plot the data without gaps appearing. This is the default.
+        If linksegments is 0, then the no duplicate points are returned.
+        """
+        child_start, child_index = self.child_start.tolist(), self.child_index.tolist()
+        parent_index, ids = self.parent_index.tolist(), self._id_list
+        segments = []
+        stack = [self._row(node_ids)]
+        while stack:
+            row = stack.pop()
+            parent_row = parent_index[row]
+            if link_segments and parent_row >= 0 and _is_positive(ids[row]):
+                _path = [ids[parent_row]]
+            else:
+                _path = []
+
+            rows = [row]
+            while len(rows) == 1:
+                _path.append(ids[rows[0]])
+                rows = child_index[child_start[rows[0]]:child_start[rows[0] + 1]]
+
+            segments.append(_path)
+            stack.extend(reversed(rows))  # Branches in their listed order
+
+        return tuple(segments)
+
+    def path_to_root(self, from_node):
+        """
+        Path from node "fromNode" to the tree's root
+        To achieve this we simply need to follow the tree back by looking
+        each node's parent.
+        """
+        row = self._row(from_node)
+        path = [from_node]
+        while self.parent_index[row] >= 0:
+            row = self.parent_index[row]
+            path.append(self._id_list[row])
+        return path
+
+
+def _is_positive(identifier):
+    """
+    Tree.find_segments only links the starting node to its parent if its id is greater than zero
+    """
+    try:
+        return identifier > 0
+    except TypeError:
+        return True
+
+
+class ArrayNode(object):
+    """
+    View of one node of an ArrayTree, with the attributes of a Node
+    """
+
+    def __init__(self, tree, row):
+        self._tree = tree
+        self._row = row
+
+    @property
+    def identifier(self):
+        return self._tree._id_list[self._row]
+
+    @property
+    def parent(self):
+        parent_row = self._tree.parent_index[self._row]
+        return self._tree._id_list[parent_row] if parent_row >= 0 else None
+
+    @property
+    def children(self):
+        return self._tree._ids_of(self._tree._children_rows(self._row))
+
+    @property
+    def data(self):
+        return self._tree.node_data(self._row)
+
+    def is_branch(self):
+        """
+        Is this node a branch?
+        A branch is defined as a node with more than two children
+        returns True or False
+        """
+        return bool(self._tree.n_children[self._row] > 1)
+
+
+class ArrayTreeNodes(Mapping):
+    """
+    The nodes of an ArrayTree as a read-only dictionary of ArrayNodes keyed by node id
+    """
+
+    def __init__(self, tree):
+        self._tree = tree
+
+    def __getitem__(self, key):
+        return self._tree[key]
+
+    def __contains__(self, key):
+        return self._tree._has_row(key)
+
+    def __iter__(self):
+        return iter(self._tree._id_list)
+
+    def __len__(self):
+        return len(self._tree)
+
+
+def records_from_columns(names, columns):
+    """
+    Return a structured array with one field per column. names are the field names and columns
+    the arrays (all of the same length) holding their values.
+    """
+    dtype = np.dtype([(str(name), np.asarray(column).dtype) for name, column in zip(names, columns)])
+    records = np.empty(len(columns[0]) if columns else 0, dtype=dtype)
+    for name, column in zip(dtype.names, columns):
+        records[name] = column
+    return records
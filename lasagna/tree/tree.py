@@ -1,3 +1,5 @@
+from collections import deque
+
 from lasagna.tree.node import Node
 
 
@@ -47,30 +49,22 @@ class Tree(object):
         """
         # Python generator using yield
         yield identifier  # return the root of this list
-        queue = self[identifier].children
+        queue = deque(self[identifier].children)
         while queue:
-            yield queue[0]
-            expansion = self[queue[0]].children
+            node_id = queue.popleft()
+            yield node_id
+            expansion = self[node_id].children
             if mode == _DEPTH:
-                queue = expansion + queue[1:]  # depth-first
+                queue.extendleft(reversed(expansion))  # depth-first
             elif mode == _WIDTH:
-                queue = queue[1:] + expansion  # width-first
+                queue.extend(expansion)  # width-first
 
     def is_leaf(self, identifier):
         """
         Is the node indexed by 'identifier' a leaf?
         returns True or False
         """
-        n = 0
-        for node_id in self.traverse(identifier):
-            n += 1
-            if n > 1:
-                break
-
-        if n == 1:
-            return True
-        else:
-            return False
+        return len(self[identifier].children) == 0
 
     def find_leaves(self, from_node=0):
         """
@@ -4,11 +4,14 @@ Defines a tree and a node class as well as functions for importing data
 """
 import os
 
+import numpy as np
+
+from lasagna.tree.array_tree import ArrayTree, records_from_columns
 from lasagna.tree.tree import Tree
 from lasagna.utils import data_type_from_string
 
 
-def parse_file(fname, display_tree=False, col_sep=',', header_line=None, verbose=False):
+def parse_file(fname, display_tree=False, col_sep=',', header_line=None, verbose=False, compact=False):
     """
     Import tree data from a CSV (text) file or list. 
 
@@ -19,6 +22,9 @@ def parse_file(fname, display_tree=False, col_sep=',', header_line=None, verbose
 
     The root node must have a parent id of 0 and normally should also have an index of 1
 
+    The file is read in one pass and each data column is converted to a single type: int if all of
+    its values are integers, float if they are all numbers and str otherwise.
+
     From MATLAB one can produce tree structures and dump data in the correct format
     using https://github.com/raacampbell13/matlab-tree and the tree.dumptree method
 
@@ -32,6 +38,9 @@ def parse_file(fname, display_tree=False, col_sep=',', header_line=None, verbose
                 headerLine can also be a CSV string or a list that defines the column headings. Must have the
                 same number of columns as the rest of the file.
     verbose - prints diagnostic info to screen if true
+    compact - if True, return an ArrayTree rather than a Tree. This uses much less memory and is
+              much faster to walk for large trees, such as traced neurons, but can not be added to.
+              Needs column headings.
     """
     if verbose:
         print("tree.tree_parser.parse_file importing file %s" % fname)
@@ -48,8 +57,8 @@ def parse_file(fname, display_tree=False, col_sep=',', header_line=None, verbose
 
     # Get header data if present
     if header_line is None:
-        header = contents.pop(0)
-        header = header.rstrip('\n').split(col_sep)
+        header = contents[0].rstrip('\n').split(col_sep)
+        contents = contents[1:]
     elif isinstance(header_line, str):
         header = header_line.rstrip('\n').split(col_sep)
     elif isinstance(header_line, list):
@@ -57,39 +66,46 @@ def parse_file(fname, display_tree=False, col_sep=',', header_line=None, verbose
     else:
         header = False
 
-    data = []
-    for line in contents:
-        if not line:
-            continue
-
-        data_line = line.split(col_sep)
-        if len(header) != len(data_line):
-            print("\nTree file appears corrupt! header length is %d but data line length is %d."
-                  "\ntree.tree_parser.parse_file is aborting.\n" % (len(header), len(data_line)))
-            return False
-
-        # Add data to the third column. Either as a list or as a dictionary (if header names were provided)
-        if header:  # add as dictionary
-            data_col = dict()
-            for i in range(len(header)-2):
-                i += 2
-                data_col[header[i]] = data_type_from_string.convert_string(data_line[i])
-        else:
-            data_col = data_line[2:]  # add as list of strings
+    # Read all lines into a table of strings in one pass
+    lines = [line for line in contents if line]
+    n_cols = len(header) if header else len(lines[0].split(col_sep)) if lines else 2
+    table = _string_table(lines, col_sep, n_cols)
+    if table is None:
+        bad_length = next(len(line.split(col_sep)) for line in lines if len(line.split(col_sep)) != n_cols)
+        print("\nTree file appears corrupt! header length is %d but data line length is %d."
+              "\ntree.tree_parser.parse_file is aborting.\n" % (n_cols, bad_length))
+        return False
 
-        line_data = [int(d) for d in data_line[0:2]]  # add index and parent to the first two columns
-        line_data.append(data_col)
-        data.append(line_data)
+    ids = table[:, 0].astype(np.int64).tolist()  # index and parent are the first two columns
+    parents = table[:, 1].astype(np.int64).tolist()
 
     if verbose:
-        print("tree.tree_parser.parse_file read %d rows of data from %s" % (len(data), fname))
+        print("tree.tree_parser.parse_file read %d rows of data from %s" % (len(ids), fname))
+
+    # Data columns are converted to one type each: see data_type_from_string.data_type_from_column
+    if header:
+        names = header[2:]
+        data_columns = [data_type_from_string.convert_column(table[:, i]) for i in range(2, n_cols)]
 
     # Build tree
-    tree = Tree()
-    tree.add_node(0)
-    for thisNode in data:
-        tree.add_node(thisNode[0], thisNode[1])
-        tree[thisNode[0]].data = thisNode[2]
+    if compact and header:
+        tree = build_array_tree(ids, parents, names, data_columns)
+    else:
+        if compact:
+            print("tree.tree_parser.parse_file can only make a compact tree from data with column headings")
+
+        # Add data to the third column. Either as a list or as a dictionary (if header names were provided)
+        if header and names:  # add as dictionary
+            data = [dict(zip(names, values)) for values in zip(*[column.tolist() for column in data_columns])]
+        elif header:
+            data = [dict() for _ in ids]
+        else:
+            data = table[:, 2:].tolist()  # add as list of strings
+
+        tree = Tree()
+        tree.add_node(0)
+        for node_id, parent, node_data in zip(ids, parents, data):
+            tree.add_node(node_id, parent).data = node_data
 
     # Optionally dump the tree to screen (unlikely to be useful for large trees)
     if display_tree:
@@ -98,3 +114,38 @@ def parse_file(fname, display_tree=False, col_sep=',', header_line=None, verbose
             print("%s - %s" % (node_id, tree[node_id].data))
 
     return tree
+
+
+def _string_table(lines, col_sep, n_cols):
+    """
+    Split lines at col_sep into an array of strings with n_cols columns, or return None if
+    any line has a different number of columns
+    """
+    if not lines:
+        return np.empty((0, n_cols), dtype=str)
+
+    if len(col_sep) == 1:
+        try:
+            table = np.loadtxt(lines, delimiter=col_sep, dtype=str, comments=None, ndmin=2)
+        except ValueError:
+            return None
+    else:
+        rows = [line.split(col_sep) for line in lines]
+        if set(map(len, rows)) != {n_cols}:
+            return None
+        table = np.array(rows, dtype=str)
+
+    if table.shape[1] != n_cols:
+        return None
+    return table
+
+
+def build_array_tree(ids, parents, names, data_columns):
+    """
+    Build an ArrayTree from node ids, parent ids, and data column names and arrays, as read by
+    parse_file. As with a Tree made by parse_file, a root with id 0 and no data is added.
+    """
+    columns = [np.concatenate((np.zeros(1, dtype=column.dtype), column)) for column in data_columns]
+    has_data = np.ones(len(ids) + 1, dtype=bool)
+    has_data[0] = False
+    return ArrayTree([0] + list(ids), [None] + list(parents), data=records_from_columns(names, columns), has_data=has_data)
@@ -1,5 +1,7 @@
 import re
 
+import numpy as np
+
 """
 Module to infer data type from string or convert a string to a data type. 
 
@@ -36,6 +38,29 @@ def convert_string(input_string):
         return data_type(input_string)
 
 
+def convert_column(input_strings):
+    """
+    Converts a column of strings to a NumPy array of a single type: int if every string is an
+    integer, float if every string is a number and str otherwise. Columns of strings are
+    returned as arrays of Python str objects.
+    input_strings - a list or an array of strings
+    """
+    strings = np.asarray(input_strings, dtype=str)
+    for data_type in (np.int64, np.float64):
+        try:
+            return strings.astype(data_type)
+        except (ValueError, OverflowError):
+            pass
+    return np.array(strings.tolist(), dtype=object)
+
+
+def data_type_from_column(input_strings):
+    """
+    Returns the data type of a whole column of strings: int, float, or str
+    """
+    return {'i': int, 'f': float}.get(convert_column(input_strings).dtype.kind, str)
+
+
 if __name__ == '__main__':
     # testing code
     if data_type_from_string('32423') != int:
@@ -0,0 +1,56 @@
+"""
+Splitting point data into series.
+
+Point and line files may hold many series, with a series number for each point (one series
+per traced cell, for instance). Rather than scanning all points once for every series, the
+points are sorted once by series number and each series is then a contiguous block of rows.
+If the file lists the series one after the other, as is usual, nothing is copied at all.
+"""
+
+import numpy as np
+
+
+def group_by_series(series):
+    """
+    Group the points of an array of series numbers
+
+    Returns the sorted unique series numbers, the row at which each starts and ends once the
+    points are sorted by series, and the sorting order (None if the points are already sorted).
+    The sort is stable, so the points of a series keep their order.
+    """
+    series = np.asarray(series)
+    order = None
+    if len(series) and (series[1:] < series[:-1]).any():
+        order = np.argsort(series, kind="stable")
+        series = series[order]
+    # The series are now sorted, so each starts where the number changes
+    starts = np.flatnonzero(np.concatenate(([len(series) > 0], series[1:] != series[:-1])))
+    ids = series[starts]
+    stops = np.append(starts[1:], len(series))[:len(starts)]
+    return ids, starts, stops, order
+
+
+def split_series(data, series):
+    """
+    Yield the series number and the rows of data (an n by m array) for each series in series
+    (n series numbers), in order of series number. The rows are views of data, or of a sorted
+    copy of it if the series are not listed one after the other.
+    """
+    ids, starts, stops, order = group_by_series(series)
+    data = np.asarray(data)
+    if order is not None:
+        data = data[order]
+    for series_id, start, stop in zip(ids, starts, stops):
+        yield series_id, data[start:stop]
+
+
+def join_series(data, series):
+    """
+    Return the rows of data (an n by 3 array) in file order with a row of NaNs wherever the series
+    number (n series numbers) changes. This is how lines ingredients separate their line series.
+    Unlike split_series nothing is sorted: a series listed in several runs stays several lines.
+    """
+    series = np.asarray(series)
+    data = np.asarray(data, dtype=float)
+    changes = np.flatnonzero(series[1:] != series[:-1]) + 1
+    return np.insert(data, changes, np.nan, axis=0)
@@ -2,9 +2,18 @@
 The following plugin functions by default expect the name and path of the preferences file to be the
 main lasagna preferences file. However, this can be over-ridden so that individual plugins can have
 their own preferences files and still use these functions.
+
+Each preferences file is parsed once into a PreferenceStore, which serves reads from memory and
+re-reads the file only if its modification time changes (i.e. it was edited outside lasagna).
+Changes made with preferenceWriter are written back a moment later, so that a burst of changes
+makes a single write, and files are replaced atomically. Pending changes are written at exit, or
+when flushPreferences is called.
 """
 
+import atexit
+import copy
 import os
+import threading
 
 import yaml
 
@@ -39,9 +48,151 @@ def defaultPreferences():
             'defaultSymbolSize': 8,
             'hideZoomResetButtonOnImageAxes': True,
             'hideAxes': True,
+            'chunkCacheSizeMB': 1024,      # Memory used to cache chunks of out-of-core (chunked) image stacks
+            'prefetchSlices': 4,           # Number of slices ahead of the displayed one read in the background
+            'prefetchCacheSizeMB': 512,    # Memory used to hold prefetched slices
+            'prefetchThreads': 2,          # Number of threads reading prefetched slices
+            'histogramThreads': 2,         # Number of threads counting voxels for image stack histograms
+            'axisCopyCacheSizeMB': 2048,   # Memory used for contiguous copies of image stacks along axes 1 and 2. 0 disables them
             }
 
 
+# Seconds to wait after a change before writing a preferences file
+WRITE_DELAY = 1.0
+
+
+class PreferenceStore(object):
+    """
+    In-memory copy of a preferences file
+    """
+
+    def __init__(self, prefFName, writeDelay=WRITE_DELAY):
+        self.prefFName = prefFName
+        self.writeDelay = writeDelay
+        self._lock = threading.RLock()
+        self._preferences = None
+        self._fileStamp = None  # modification time and size of the file when we last read or wrote it
+        self._pending = {}  # changes not yet written to disk
+        self._timer = None
+
+    def _stamp(self):
+        try:
+            stat = os.stat(self.prefFName)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _refresh(self):
+        """
+        (Re)load the file if we have not read it yet or it changed on disk. Pending changes are
+        applied on top of what was read.
+        """
+        stamp = self._stamp()
+        if self._preferences is not None and stamp in (self._fileStamp, None):
+            return  # Unchanged, or deleted: keep what we have
+        with open(self.prefFName, 'r') as stream:
+            self._preferences = yaml.load(stream, Loader=yaml.FullLoader) or {}
+        self._fileStamp = stamp
+        self._preferences.update(self._pending)
+
+    def exists(self):
+        with self._lock:
+            return self._preferences is not None or self._stamp() is not None
+
+    def all(self):
+        """
+        Return a copy of all preferences as a dictionary
+        """
+        with self._lock:
+            self._refresh()
+            return copy.deepcopy(self._preferences)
+
+    def get(self, preferenceName, default=None):
+        with self._lock:
+            self._refresh()
+            return copy.deepcopy(self._preferences.get(preferenceName, default))
+
+    def __contains__(self, preferenceName):
+        with self._lock:
+            self._refresh()
+            return preferenceName in self._preferences
+
+    def set(self, preferenceName, newValue):
+        """
+        Change one preference. The file is written after writeDelay seconds without other changes.
+        """
+        with self._lock:
+            if self._preferences is None and self._stamp() is not None:
+                self._refresh()
+            elif self._preferences is None:
+                self._preferences = {}
+            newValue = copy.deepcopy(newValue)
+            self._preferences[preferenceName] = newValue
+            self._pending[preferenceName] = newValue
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.writeDelay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def replace(self, preferences):
+        """
+        Replace all preferences and write the file now
+        """
+        with self._lock:
+            self._preferences = copy.deepcopy(preferences)
+            self._pending = {}
+            self._write()
+
+    def flush(self):
+        """
+        Write pending changes to disk, if any
+        """
+        with self._lock:
+            if not self._pending:
+                return
+            self._refresh()  # Keep edits made to the file by others since we last read it
+            self._pending = {}
+            self._write()
+
+    def _write(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        # TODO: check ability to write to the file before proceeding
+        tmpFName = self.prefFName + '.tmp'
+        with open(tmpFName, 'w') as stream:
+            yaml.dump(self._preferences, stream)
+        os.replace(tmpFName, self.prefFName)
+        self._fileStamp = self._stamp()
+
+
+_stores = {}
+_storesLock = threading.Lock()
+
+
+def preferenceStore(prefFName=get_lasagna_pref_file()):
+    """
+    Return the PreferenceStore of file prefFName, shared by the whole process
+    """
+    key = os.path.abspath(prefFName)
+    with _storesLock:
+        if key not in _stores:
+            _stores[key] = PreferenceStore(prefFName)
+        return _stores[key]
+
+
+@atexit.register
+def flushPreferences():
+    """
+    Write the pending changes of all preferences files
+    """
+    with _storesLock:
+        stores = list(_stores.values())
+    for store in stores:
+        store.flush()
+
+
 def loadAllPreferences(prefFName=get_lasagna_pref_file(), defaultPref=defaultPreferences()):
     """
     Load the preferences YAML file. If the file is missing, we create it using the default
@@ -49,19 +200,18 @@ def loadAllPreferences(prefFName=get_lasagna_pref_file(), defaultPref=defaultPre
     """
     # print "loading from pref file %s" % prefFName
     # Generate a default preferences file if no preferences file exists
-    if not os.path.exists(prefFName):
+    store = preferenceStore(prefFName)
+    if not store.exists():
         print("PREF FILE: %s" % prefFName)
         writeAllPreferences(defaultPref, prefFName=prefFName)
         print("Created default preferences file in " + prefFName)
 
-    # Load preferences YAML file as a dictionary
-    with open(prefFName, 'r') as stream:
-        return yaml.load(stream,Loader=yaml.FullLoader)
+    return store.all()
 
 
 def readPreference(preferenceName, prefFName=get_lasagna_pref_file(), preferences=get_lasagna_pref_file()):
     """
-    Read preferences with key "preferenceName" from YAML file prefFName on disk.
+    Read preferences with key "preferenceName" from YAML file prefFName.
     If the key is abstent, call defaultPreferences and search for the key. If it
     is present, add to preferences file and return the value. If absent, raise a
     warning and return None. The caller function needs to decide what to do with
@@ -70,10 +220,12 @@ def readPreference(preferenceName, prefFName=get_lasagna_pref_file(), preference
 
     # TODO: need some sort of check as to whether the preference value is valid
 
-    # Check on disk
-    preferences = loadAllPreferences(prefFName)
-    if preferenceName in preferences:
-        return preferences[preferenceName]
+    # Check in the file's store, which creates the file if needed
+    store = preferenceStore(prefFName)
+    if not store.exists():
+        loadAllPreferences(prefFName)
+    if preferenceName in store:
+        return store.get(preferenceName)
     else:
         print("Did not find preference %s on disk. Looking in defaultPreferencesa" % preferenceName)
 
@@ -93,23 +245,18 @@ def writeAllPreferences(preferences, prefFName=get_lasagna_pref_file()):
     user's home directory.
     """
     assert isinstance(preferences, dict)
-
-    # TODO: check ability to write to the file before proceeding
-    with open(prefFName, 'w') as stream:
-        yaml.dump(preferences, stream)
+    preferenceStore(prefFName).replace(preferences)
 
 
 def preferenceWriter(preferenceName, newValue, prefFName=get_lasagna_pref_file()):
     """
     Overwrite a single key "preferenceName" in self.preferences with the value "newValue"
-    Saves updates dictionary to the preferences file
+    The preferences file is updated shortly after (see PreferenceStore.set)
     """
     print("Writing preference data for: %s\n" % preferenceName)
-    preferences = loadAllPreferences(prefFName)
-    if preferenceName in preferences:
-        preferences[preferenceName] = newValue
-    else:
+    store = preferenceStore(prefFName)
+    if not store.exists():
+        loadAllPreferences(prefFName)
+    if preferenceName not in store:
         print("Adding missing preference %s to preferences file" % preferenceName)
-        preferences[preferenceName] = newValue
-
-    writeAllPreferences(preferences, prefFName)
+    store.set(preferenceName, newValue)
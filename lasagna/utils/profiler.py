@@ -0,0 +1,219 @@
+"""
+Timers for finding out where lasagna spends its time.
+
+Hooks, redraws, ingredient plotting and loaders are wrapped in named timers (see timer and
+profiled). They cost next to nothing unless profiling is enabled, e.g. by starting lasagna with
+--profile. Then each timer records its wall time, so that summary can report call counts and
+percentiles per timer (one per hook, per plugin and per ingredient), and writeChromeTrace can save
+every call as a trace that chrome://tracing or https://ui.perfetto.dev can display.
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+# Durations kept per timer for the percentiles, and calls kept for the trace
+MAX_SAMPLES = 100000
+MAX_EVENTS = 1000000
+
+
+class _NullTimer(object):
+    """
+    Timer that does nothing, used while profiling is disabled
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+    def __init__(self, profiler, name, category, args):
+        self.profiler = profiler
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, self.category, self.start, time.perf_counter() - self.start, self.args)
+        return False
+
+
+class Profiler(object):
+    """
+    Collects the durations of named timers
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self.clear()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def clear(self):
+        with self._lock:
+            self._samples = {}  # name: deque of durations in seconds
+            self._counts = {}  # name: number of calls
+            self._totals = {}  # name: total time in seconds
+            self._categories = {}
+            self._events = deque(maxlen=MAX_EVENTS)
+
+    def timer(self, name, category="lasagna", **args):
+        """
+        Return a context manager that times its block as name. Extra keyword arguments are saved
+        with each call in the trace.
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name, category, args)
+
+    def record(self, name, category, start, duration, args=None):
+        """
+        Record a call to name that started at start (time.perf_counter) and took duration seconds
+        """
+        with self._lock:
+            if name not in self._samples:
+                self._samples[name] = deque(maxlen=MAX_SAMPLES)
+                self._counts[name] = 0
+                self._totals[name] = 0.0
+                self._categories[name] = category
+            self._samples[name].append(duration)
+            self._counts[name] += 1
+            self._totals[name] += duration
+            self._events.append((name, category, start, duration, threading.get_ident(), args))
+
+    def durations(self, name, last=None):
+        """
+        Return the most recent durations (in seconds) of timer name as an array
+        """
+        with self._lock:
+            samples = list(self._samples.get(name, ()))
+        if last is not None:
+            samples = samples[-last:]
+        return np.array(samples)
+
+    def summary(self):
+        """
+        Return a dictionary with, for each timer, the number of calls, the total and mean time and
+        the 50th, 95th and 99th percentiles of the recent calls, all in milliseconds
+        """
+        with self._lock:
+            names = list(self._samples)
+            stats = [(self._categories[name], self._counts[name], self._totals[name],
+                      np.array(self._samples[name])) for name in names]
+        out = {}
+        for name, (category, count, total, samples) in zip(names, stats):
+            p50, p95, p99 = np.percentile(samples, [50, 95, 99]) * 1000
+            out[name] = dict(category=category, count=count, total_ms=total * 1000,
+                             mean_ms=total * 1000 / count, p50_ms=p50, p95_ms=p95, p99_ms=p99)
+        return out
+
+    def printSummary(self):
+        """
+        Print the timers, slowest in total first
+        """
+        summary = self.summary()
+        print("%-60s %8s %10s %8s %8s %8s %8s" % ("timer", "calls", "total ms", "mean", "p50", "p95", "p99"))
+        for name in sorted(summary, key=lambda name: -summary[name]["total_ms"]):
+            s = summary[name]
+            print("%-60s %8d %10.1f %8.2f %8.2f %8.2f %8.2f" % (
+                name[:60], s["count"], s["total_ms"], s["mean_ms"], s["p50_ms"], s["p95_ms"], s["p99_ms"]))
+
+    def writeChromeTrace(self, fname):
+        """
+        Save the recorded calls in the Chrome trace event format
+        """
+        with self._lock:
+            events = list(self._events)
+        pid = os.getpid()
+        trace = []
+        for name, category, start, duration, thread, args in events:
+            event = dict(name=name, cat=category, ph="X", pid=pid, tid=thread,
+                         ts=(start - self._origin) * 1e6, dur=duration * 1e6)
+            if args:
+                event["args"] = {key: str(value) for key, value in args.items()}
+            trace.append(event)
+        with open(fname, "w") as fid:
+            json.dump(dict(traceEvents=trace, displayTimeUnit="ms"), fid)
+        print("Wrote %d timed calls to %s" % (len(trace), fname))
+
+
+# The profiler used throughout lasagna
+profiler = Profiler()
+
+
+def timer(name, category="lasagna", **args):
+    """
+    Time a block of code as name with the lasagna profiler (see Profiler.timer)
+    """
+    return profiler.timer(name, category, **args)
+
+
+def profiled(name=None, category="lasagna"):
+    """
+    Decorator timing each call of a function with the lasagna profiler. The timer is named after
+    the function unless name is given. The name is stored in the timerName attribute of the
+    decorated function.
+    """
+
+    def decorator(function):
+        timer_name = name or "%s.%s" % (function.__module__.split(".")[-1], function.__qualname__)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return function(*args, **kwargs)
+            with _Timer(profiler, timer_name, category, None):
+                return function(*args, **kwargs)
+
+        wrapper.timerName = timer_name
+        return wrapper
+
+    return decorator
+
+
+def showFrameTimeOverlay(parent, timerName, interval=500):
+    """
+    Show the recent durations of timer timerName (e.g. a redraw) in a small label in the corner of
+    the Qt widget parent, updated every interval ms. Returns the label.
+    """
+    from PyQt5 import QtCore, QtWidgets
+
+    label = QtWidgets.QLabel(parent)
+    label.setStyleSheet("background-color: rgba(0, 0, 0, 160); color: white; padding: 2px")
+    label.setAttribute(QtCore.Qt.WA_TransparentForMouseEvents)
+
+    def update():
+        durations = profiler.durations(timerName, last=100) * 1000
+        if len(durations):
+            p50, p95 = np.percentile(durations, [50, 95])
+            label.setText("%s: %.1f ms (p50 %.1f, p95 %.1f)" % (timerName, durations[-1], p50, p95))
+        else:
+            label.setText("%s: no frames yet" % timerName)
+        label.adjustSize()
+        label.move(parent.width() - label.width() - 4, 4)
+        label.raise_()
+
+    label.timer = QtCore.QTimer(label)
+    label.timer.timeout.connect(update)
+    label.timer.start(interval)
+    update()
+    label.show()
+    return label
@@ -0,0 +1,36 @@
+"""
+Index for finding the points of a point cloud that lie close to a plane.
+
+Points and lines are drawn only within a few layers of the displayed slice. Rather than
+rounding and masking every point on each redraw, a SlabIndex sorts the points once by their
+rounded coordinate along each axis, so finding those within a range of layers is a pair of
+binary searches.
+"""
+
+import numpy as np
+
+
+class SlabIndex(object):
+    """
+    Per-axis sorted index of an n by m array of point coordinates
+    """
+
+    def __init__(self, points):
+        points = np.asarray(points, dtype=float)
+        self._order = []
+        self._sortedLayers = []
+        for axis in range(points.shape[1]):
+            layers = np.round(points[:, axis])
+            order = np.argsort(layers, kind="mergesort")  # NaNs (e.g. line separators) sort last
+            self._order.append(order)
+            self._sortedLayers.append(layers[order])
+
+    def query(self, axis, fromLayer, toLayer):
+        """
+        Return the indices of the points whose rounded coordinate along axis is between fromLayer
+        and toLayer (inclusive), and those rounded coordinates. Points are ordered by layer.
+        """
+        layers = self._sortedLayers[axis]
+        start = np.searchsorted(layers, fromLayer, side="left")
+        stop = np.searchsorted(layers, toLayer, side="right")
+        return self._order[axis][start:stop], layers[start:stop]